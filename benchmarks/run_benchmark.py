@@ -0,0 +1,395 @@
+"""
+Offline end-to-end benchmark of a full run.
+
+For each number of sites, a fresh process:
+    1. generates that many synthetic sites (see synthetic_sites.py) and
+       seeds their pages
+    2. starts the local stand-ins for the sites, Moz and Twitter, and puts
+       the sites in an in-memory sites table (see standins.py)
+    3. runs the whole flow against them: the Pipeline (with its ranking),
+       rendering and uploading the pages
+and reports its wall time, throughput, peak memory and a per-stage
+breakdown taken from the run's tracing spans (see functions/tracing.py).
+Nothing leaves the machine, so the results only change when the code does.
+
+Run it from this directory:
+    python run_benchmark.py                        # 100, 1,000, 10,000 sites
+    python run_benchmark.py --sizes 1000 --site-latency 0.2
+    python run_benchmark.py --sizes 100 --keep
+Each run also writes its trace, metrics and rendered pages to --output-dir,
+and appends its results to results.jsonl there.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+FUNCTIONS_DIR = os.path.join(REPO_DIR, 'functions')
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'templates')
+for path in (REPO_DIR, FUNCTIONS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+DEFAULT_SIZES = (100, 1000, 10000)
+# The stages reported, in the order they happen; any other spans are listed
+# after them.
+STAGES = (
+    'dynamodb scan page', 'scan', 'schedule', 'prefetch', 'directive moz',
+    'directive twitter', 'directive scrape_newest', 'parse_site', 'merge',
+    'batch_update_rows', 'save history', 'rank', 'write rankings', 'render',
+    'upload'
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark a full run against local stand-ins.'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help='the numbers of sites to run with')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='refresh_workers (default: app_config.json)')
+    parser.add_argument('--site-latency', type=float, default=0.05,
+                        help='median seconds per page request')
+    parser.add_argument('--moz-latency', type=float, default=0.1,
+                        help='median seconds per Moz request')
+    parser.add_argument('--moz-interval', type=float, default=0.0,
+                        help='seconds between Moz calls (Moz allows 10)')
+    parser.add_argument('--twitter-latency', type=float, default=0.1,
+                        help='median seconds per Twitter search')
+    parser.add_argument('--twitter-limit', type=int, default=180,
+                        help='Twitter searches allowed per window')
+    parser.add_argument('--twitter-window', type=float, default=5.0,
+                        help='seconds per Twitter rate-limit window '
+                             '(Twitter has 900)')
+    parser.add_argument('--dynamo-latency', type=float, default=0.005,
+                        help='median seconds per DynamoDB request')
+    parser.add_argument('--s3-latency', type=float, default=0.02,
+                        help='median seconds per S3 upload')
+    parser.add_argument('--error-rate', type=float, default=0.01,
+                        help='share of page requests which fail with 503')
+    parser.add_argument('--page-bytes', type=int, default=12 * 1024,
+                        help='approximate size of each page')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="also report tracemalloc's peak (slower)")
+    parser.add_argument('--output-dir',
+                        default=os.path.join(BENCHMARK_DIR, 'results'),
+                        help='where to write traces, pages and results')
+    parser.add_argument('--keep', action='store_true',
+                        help="keep each run's seeded pages")
+    parser.add_argument('--run-size', type=int, default=None,
+                        help=argparse.SUPPRESS)  # set in the child process
+    return parser.parse_args(argv)
+
+
+def benchmark_settings(args, run_dir, count):
+    """
+    Make the settings which point a run's files at run_dir and fit its
+    limits to the stand-ins.
+    :param args: the parsed arguments
+    :param run_dir: the directory for the run's files
+    :param count: the number of sites
+    :return: a dict of settings, to update app_config.json's with
+    """
+    settings = {
+        # Moz's results would otherwise be cached between runs.
+        'moz_cache': {'enabled': False},
+        'moz_usage': {'filename': os.path.join(run_dir, 'moz_usage.json')},
+        'rate_limits': {
+            'moz': {'min_interval': args.moz_interval, 'max_concurrent': 1},
+            'twitter': {'min_interval': 0, 'max_concurrent': 1},
+            'scrape_newest': {'min_interval': 0, 'max_concurrent': 16}
+        },
+        'api_budgets': {
+            'twitter': {
+                'limit': args.twitter_limit,
+                'window_seconds': args.twitter_window
+            }
+        },
+        # Let the scheduler plan every site's first refresh.
+        'twitter_windows_per_run': int(math.ceil(count / args.twitter_limit)),
+        'moz_monthly_rows': max(count, 20000),
+        'metrics_files': {
+            'prometheus': os.path.join(run_dir, 'top_sites.prom'),
+            'json': os.path.join(run_dir, 'runs.jsonl')
+        },
+        'error_reporting': {'file': os.path.join(run_dir, 'errors.jsonl')},
+        'tracing': {
+            'enabled': True,
+            'trace_file': os.path.join(run_dir, 'trace.json'),
+            'sample_stacks': False,
+            'cprofile': False,
+            'tracemalloc': args.tracemalloc,
+            'tracemalloc_file': os.path.join(run_dir, 'tracemalloc.txt')
+        }
+    }
+    if args.workers:
+        settings['refresh_workers'] = args.workers
+    return settings
+
+
+def stage_breakdown(trace_file):
+    """
+    Sum the run's spans by stage ('directive' spans by directive type).
+    :param trace_file: the trace written by tracing.stop
+    :return: a dict of stage: {'count', 'seconds', 'p50_ms', 'p95_ms',
+    'max_ms'}, where seconds is the total time in the stage's spans (spans
+    in different threads overlap, so this can exceed the wall time)
+    """
+    with open(trace_file) as f:
+        events = json.load(f)['traceEvents']
+    durations = {}
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        name = event['name']
+        if name == 'directive':
+            name += ' ' + str(event['args'].get('type'))
+        durations.setdefault(name, []).append(event['dur'] / 1e6)
+    stages = {}
+    for name, values in durations.items():
+        values.sort()
+        stages[name] = {
+            'count': len(values),
+            'seconds': round(sum(values), 3),
+            'p50_ms': round(values[len(values) // 2] * 1000, 1),
+            'p95_ms': round(values[int(len(values) * 0.95)] * 1000, 1),
+            'max_ms': round(values[-1] * 1000, 1)
+        }
+    return stages
+
+
+def peak_rss():
+    """
+    :return: this process's peak resident memory, in bytes (None where the
+    resource module isn't available, e.g. on Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_size(args, count):
+    """
+    Run the benchmark for one number of sites (in this process, which should
+    be a fresh one, so that its peak memory is the run's).
+    :param args: the parsed arguments
+    :param count: the number of sites
+    :return: a dict of results
+    """
+    import config
+    from error_handling import get_reporter, report_errors
+    import moz
+    from TwitterSearch import TwitterSearch
+    import tracing
+    from tracing import span
+    from history import History
+    from metrics import get_metrics, write_metrics
+    from pipeline import Pipeline
+    from render import render_sites
+    from standins import (FakeDynamo, FakeDynamoResource, FakeS3,
+                          start_servers)
+    from synthetic_sites import generate_sites, seed_pages
+
+    run_dir = os.path.join(args.output_dir, 'sites-{n}'.format(n=count))
+    shutil.rmtree(run_dir, ignore_errors=True)
+    pages_dir = os.path.join(run_dir, 'pages')
+    output_dir = os.path.join(run_dir, 'output')
+    os.makedirs(output_dir)
+    config.load_config().update(benchmark_settings(args, run_dir, count))
+    # Relative paths in the settings (e.g. the history table's) are relative
+    # to functions/, as when the app is run.
+    os.chdir(FUNCTIONS_DIR)
+
+    server_options = {
+        'pages_dir': pages_dir,
+        'site_latency': args.site_latency,
+        'moz_latency': args.moz_latency,
+        'twitter_latency': args.twitter_latency,
+        'twitter_limit': args.twitter_limit,
+        'twitter_window': args.twitter_window,
+        'error_rate': args.error_rate,
+        'seed': args.seed
+    }
+    servers, netlocs = start_servers(server_options)
+    try:
+        moz.URL = 'http://{h}/linkscape'.format(h=netlocs['moz'])
+        TwitterSearch._base_url = 'http://{h}/1.1/'.format(
+            h=netlocs['twitter']
+        )
+        sites = generate_sites(count, netlocs['sites'], seed=args.seed)
+        page_bytes = seed_pages(sites, pages_dir, args.page_bytes,
+                                seed=args.seed)
+        resource = FakeDynamoResource(latency=args.dynamo_latency)
+        table = resource.Table('sites')
+        for site in sites:
+            table.store(site)
+        del sites
+        dynamo = FakeDynamo(resource)
+        s3 = FakeS3(latency=args.s3_latency)
+        rss_before = peak_rss()
+
+        tracing.start()
+        start = time.perf_counter()
+        schedule = {}
+        writer = FakeDynamo(resource)
+        pipeline = Pipeline(dynamo, writer=writer,
+                            history=History(writer, sites_table='sites'))
+        ranked = pipeline.run(render=False)
+        counts = pipeline.counts
+        if pipeline.scheduler is not None:
+            schedule = pipeline.scheduler.stats
+        fetched = time.perf_counter()
+        pages = render_sites(ranked, output_dir=output_dir,
+                             template_dir=TEMPLATE_DIR)
+        for page in pages:
+            with span('upload', page=page):
+                s3.bucket.upload_file(
+                    Filename=page,
+                    Key=os.path.basename(page),
+                    ExtraArgs={'ACL': 'public-read'}
+                )
+        wall = time.perf_counter() - start
+        tracing_peak = None
+        if args.tracemalloc:
+            import tracemalloc
+            tracing_peak = tracemalloc.get_traced_memory()[1]
+        trace_files = tracing.stop()
+        write_metrics()
+        errors = get_reporter().summary()
+        report_errors()
+    finally:
+        servers.terminate()
+        if not args.keep:
+            shutil.rmtree(pages_dir, ignore_errors=True)
+
+    metrics = get_metrics().to_dict()
+    directives = sum(value['count'] for value in
+                     metrics['latency'].get('type', {}).values())
+    return {
+        'sites': count,
+        'rendered': len(ranked),
+        'directives': directives,
+        'wall_seconds': round(wall, 3),
+        'refresh_seconds': round(fetched - start, 3),
+        'sites_per_second': round(count / wall, 2),
+        'directives_per_second': round(directives / wall, 2),
+        'peak_rss_bytes': peak_rss(),
+        'rss_before_run_bytes': rss_before,
+        'tracemalloc_peak_bytes': tracing_peak,
+        'seeded_page_bytes': page_bytes,
+        'stages': stage_breakdown(trace_files[0]),
+        'outcomes': metrics['outcomes'].get('type', {}),
+        'errors': sum(kind['count'] for kind in errors),
+        'rate_limit_sleep_seconds': metrics['rate_limit_sleep_seconds'],
+        'counts': counts,
+        'schedule': schedule,
+        'write_stats': writer.write_stats,
+        'dynamodb_requests': {name: table.requests for name, table
+                              in resource.tables.items()},
+        'uploads': len(s3.bucket.uploads),
+        'uploaded_bytes': sum(s3.bucket.uploads.values())
+    }
+
+
+def child_argv(argv, count):
+    """
+    :param argv: this process's arguments
+    :param count: the number of sites for the child to run
+    :return: the arguments for a child process which runs one size
+    """
+    argv = list(argv)
+    if '--sizes' in argv:
+        i = argv.index('--sizes') + 1
+        while i < len(argv) and not argv[i].startswith('--'):
+            del argv[i]
+        argv.remove('--sizes')
+    return [sys.executable, os.path.abspath(__file__)] + argv + \
+        ['--run-size', str(count)]
+
+
+def megabytes(value):
+    return '-' if value is None else '{m:.1f}'.format(m=value / 2 ** 20)
+
+
+def print_report(result):
+    """
+    Print one run's results as a readable summary.
+    :param result: a dict, as returned by run_size
+    :return: doesn't return anything
+    """
+    print()
+    print('{n} sites: {w:.2f} s wall, {s} sites/s, {d} directives/s, '
+          'peak RSS {m} MiB'.format(
+              n=result['sites'], w=result['wall_seconds'],
+              s=result['sites_per_second'],
+              d=result['directives_per_second'],
+              m=megabytes(result['peak_rss_bytes'])))
+    if result['tracemalloc_peak_bytes'] is not None:
+        print('  tracemalloc peak: {m} MiB'.format(
+            m=megabytes(result['tracemalloc_peak_bytes'])))
+    print('  {s:<26}{c:>8}{t:>11}{p:>10}{q:>10}{x:>10}'.format(
+        s='stage', c='spans', t='total s', p='p50 ms', q='p95 ms',
+        x='max ms'))
+    stages = result['stages']
+    names = [name for name in STAGES if name in stages]
+    names += sorted(name for name in stages if name not in STAGES)
+    for name in names:
+        stage = stages[name]
+        print('  {s:<26}{c:>8}{t:>11.3f}{p:>10}{q:>10}{x:>10}'.format(
+            s=name, c=stage['count'], t=stage['seconds'],
+            p=stage['p50_ms'], q=stage['p95_ms'], x=stage['max_ms']))
+    print('  outcomes:', json.dumps(result['outcomes'], sort_keys=True))
+    print('  rate limit sleeps (s):',
+          json.dumps(result['rate_limit_sleep_seconds'], sort_keys=True))
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.run_size is not None:
+        # In the child process: run one size and print its results last.
+        print(json.dumps(run_size(args, args.run_size), default=str))
+        return 0
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = []
+    for count in args.sizes:
+        print('running {n} sites...'.format(n=count), flush=True)
+        process = subprocess.run(child_argv(argv, count),
+                                 stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+        lines = process.stdout.strip().splitlines()
+        if process.returncode != 0 or not lines:
+            print('benchmark of {n} sites failed (exit code {c})'.format(
+                n=count, c=process.returncode))
+            return 1
+        result = json.loads(lines[-1])
+        results.append(result)
+        print_report(result)
+    with open(os.path.join(args.output_dir, 'results.jsonl'), 'a') as f:
+        for result in results:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+    print()
+    print('{s:>8}{w:>10}{t:>10}{m:>10}'.format(s='sites', w='wall s',
+                                              t='sites/s', m='peak MiB'))
+    for result in results:
+        print('{s:>8}{w:>10.2f}{t:>10}{m:>10}'.format(
+            s=result['sites'], w=result['wall_seconds'],
+            t=result['sites_per_second'],
+            m=megabytes(result['peak_rss_bytes'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
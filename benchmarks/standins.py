@@ -0,0 +1,541 @@
+"""
+Local stand-ins for everything a run talks to, so that it can be benchmarked
+offline and repeatably:
+    - a site server, which serves the pages written by
+      synthetic_sites.seed_pages (with ETags, for conditional requests)
+    - a fake Moz url-metrics endpoint (GET for one target, POST for a batch
+      of up to moz.MAX_BATCH_SIZE targets)
+    - a fake Twitter search endpoint, which sends Twitter's rate-limit
+      headers and answers 429 once a window's calls are used up
+    - FakeDynamo and FakeS3, which keep tables and uploads in memory
+The servers add a random, long-tailed latency to each response (its median
+is the configured latency), and run in their own process (see
+start_servers), so that serving doesn't compete with the run being measured
+for the GIL.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import copy
+import email.utils
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlsplit
+from dynamodb import Dynamo, approximate_size
+from s3 import S3
+from synthetic_sites import page_filename
+
+# DynamoDB returns at most 1 MB of items per scan page.
+SCAN_PAGE_BYTES = 1024 * 1024
+# The number of items batch_writer sends per BatchWriteItem.
+BATCH_WRITE_ITEMS = 25
+# The key schema of the sites table; other tables are keyed like the
+# history table (see history.py).
+SITES_KEY_SCHEMA = [
+    {'AttributeName': 'project', 'KeyType': 'HASH'},
+    {'AttributeName': 'title', 'KeyType': 'RANGE'}
+]
+HISTORY_KEY_SCHEMA = [
+    {'AttributeName': 'series', 'KeyType': 'HASH'},
+    {'AttributeName': 'accessed', 'KeyType': 'RANGE'}
+]
+MAX_MOZ_BATCH = 10
+TWEETS_PER_PAGE = 100
+TWEETERS = 5000  # the number of distinct fake twitter users
+
+
+def delay(median, rng):
+    """
+    Sleep for a random, long-tailed time (log-normally distributed).
+    :param median: the median time to sleep, in seconds
+    :param rng: a random.Random
+    :return: doesn't return anything
+    """
+    if median > 0:
+        time.sleep(median * rng.lognormvariate(0, 0.5))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server on 127.0.0.1 with the stand-ins' options.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, handler, options):
+        """
+        Initialize the StandInServer on a free port.
+        :param handler: a StandInHandler subclass
+        :param options: a dict of options (see run_benchmark.py's arguments)
+        """
+        super().__init__(('127.0.0.1', 0), handler)
+        self.options = options
+        self.rng = random.Random(options.get('seed', 0))
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_calls = 0
+
+    @property
+    def netloc(self):
+        return '127.0.0.1:{p}'.format(p=self.server_address[1])
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Shared behaviour of the stand-ins' request handlers.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real servers
+    latency_option = None
+
+    def log_message(self, format, *args):
+        pass  # the benchmark's output is its report
+
+    def wait(self):
+        with self.server.lock:
+            rng = random.Random(self.server.rng.random())
+        delay(self.server.options[self.latency_option], rng)
+
+    def send_body(self, status, body, content_type='application/json',
+                  headers=None):
+        """
+        Send a complete response.
+        :param status: the HTTP status code
+        :param body: the body (bytes, str, or anything JSON-serializable)
+        :param content_type: the Content-Type header
+        :param headers: an optional dict of extra headers
+        :return: doesn't return anything
+        """
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+
+class SiteHandler(StandInHandler):
+    """
+    Serves the seeded pages, answering conditional requests with 304 and a
+    share of requests ("error_rate") with 503.
+    """
+    latency_option = 'site_latency'
+
+    def do_GET(self):
+        self.wait()
+        with self.server.lock:
+            failed = self.server.rng.random() < \
+                self.server.options['error_rate']
+        if failed:
+            self.send_body(503, 'Service Unavailable', 'text/plain')
+            return
+        path = urlsplit(self.path).path
+        filename = os.path.join(self.server.options['pages_dir'],
+                                page_filename(path))
+        try:
+            with open(filename, 'rb') as f:
+                page = f.read()
+            modified = os.path.getmtime(filename)
+        except OSError:
+            self.send_body(404, 'Not Found', 'text/plain')
+            return
+        etag = '"{d}"'.format(d=hashlib.md5(page).hexdigest())
+        headers = {
+            'ETag': etag,
+            'Last-Modified': email.utils.formatdate(modified, usegmt=True)
+        }
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, b'', 'text/html; charset=utf-8', headers)
+            return
+        self.send_body(200, page, 'text/html; charset=utf-8', headers)
+
+
+def moz_metrics(target):
+    """
+    Make the fake url-metrics of a target url, the same every time.
+    :param target: the target url, e.g. 'site00042.com'
+    :return: a dict with Moz's cryptically-named keys
+    """
+    rng = random.Random(target)
+    authority = rng.randint(1, 100)
+    return {
+        'ut': target,
+        'uu': target + '/',
+        'us': 200,
+        'uid': rng.randint(0, 100000),
+        'ueid': rng.randint(0, 10000),
+        'umrp': round(rng.uniform(0, 10), 6),
+        'umrr': rng.random(),
+        'fmrp': round(rng.uniform(0, 10), 6),
+        'fmrr': rng.random(),
+        'upa': rng.randint(1, authority),
+        'pda': authority
+    }
+
+
+class MozHandler(StandInHandler):
+    """
+    A fake Moz url-metrics endpoint.
+    """
+    latency_option = 'moz_latency'
+
+    def do_GET(self):
+        self.wait()
+        target = urlsplit(self.path).path.rsplit('/url-metrics/', 1)[-1]
+        if not target:
+            self.send_body(404, {'error_message': 'not found'})
+            return
+        self.send_body(200, moz_metrics(target))
+
+    def do_POST(self):
+        self.wait()
+        try:
+            targets = json.loads(self.read_body().decode('utf-8'))
+        except ValueError:
+            targets = None
+        if not isinstance(targets, list) or len(targets) > MAX_MOZ_BATCH:
+            self.send_body(400, {'error_message': 'expected a list of up to '
+                                                  '{m} urls'.format(
+                                                      m=MAX_MOZ_BATCH)})
+            return
+        self.send_body(200, [moz_metrics(target) for target in targets])
+
+
+def fake_tweets(name, now):
+    """
+    Make the fake tweets (from the last day) which link to a site, the same
+    every time. Most sites get a few, some get many, and some of them are
+    from the site's own account (which its directive excludes).
+    :param name: the site's name, e.g. 'site00042'
+    :param now: the time of the search (unix time)
+    :return: a list of tweets (dicts), newest first
+    """
+    rng = random.Random(name)
+    count = int(rng.paretovariate(1.2)) - 1
+    number = int(re.sub(r'\D', '', name) or 0)
+    tweets = []
+    for k in range(min(count, 1000)):
+        user_id = rng.randrange(TWEETERS)
+        own = rng.random() < 0.1
+        screen_name = name if own else 'tweeter{u}'.format(u=user_id)
+        created = now - rng.uniform(0, 86400)
+        tweets.append({
+            # Ids only need to be unique and to grow with created_at.
+            'id': (int(created) * 1000 + k) * 100000 + number % 100000,
+            'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y',
+                                        time.gmtime(created)),
+            'text': 'Worth reading: {n} com/blog'.format(n=name),
+            'entities': {'urls': [{
+                'url': 'https://t.co/{u}'.format(u=user_id),
+                'expanded_url': 'http://{n}.com/blog/post-{k}'.format(
+                    n=name, k=k)
+            }]},
+            'user': {
+                'id': user_id,
+                'id_str': str(user_id),
+                'screen_name': screen_name,
+                'followers_count': min(10 ** 8, int(
+                    random.Random(user_id).paretovariate(0.8) * 10
+                ))
+            }
+        })
+    tweets.sort(key=lambda tweet: -tweet['id'])
+    return tweets
+
+
+class TwitterHandler(StandInHandler):
+    """
+    A fake Twitter search endpoint, with a rate limit of "twitter_limit"
+    calls per "twitter_window" seconds.
+    """
+    latency_option = 'twitter_latency'
+
+    def rate_limit(self):
+        """
+        Count a call against the current window.
+        :return: a tuple of (whether the call is allowed, rate-limit headers)
+        """
+        options = self.server.options
+        with self.server.lock:
+            now = time.time()
+            if now >= self.server.window_start + options['twitter_window']:
+                self.server.window_start = now
+                self.server.window_calls = 0
+            self.server.window_calls += 1
+            remaining = options['twitter_limit'] - self.server.window_calls
+            reset = self.server.window_start + options['twitter_window']
+        headers = {
+            'x-rate-limit-limit': str(options['twitter_limit']),
+            'x-rate-limit-remaining': str(max(0, remaining)),
+            'x-rate-limit-reset': str(int(math.ceil(reset)))
+        }
+        return remaining >= 0, headers
+
+    def do_GET(self):
+        self.wait()
+        url = urlsplit(self.path)
+        if url.path.endswith('/account/verify_credentials.json'):
+            self.send_body(200, {'screen_name': 'benchmark'})
+            return
+        if not url.path.endswith('/search/tweets.json'):
+            self.send_body(404, {'errors': [{'code': 34}]})
+            return
+        allowed, headers = self.rate_limit()
+        if not allowed:
+            self.send_body(429, {'errors': [{'code': 88}]}, headers=headers)
+            return
+        query = parse_qs(url.query)
+        since_id = int(query.get('since_id', ['0'])[0])
+        max_id = int(query.get('max_id', [str(2 ** 63)])[0])
+        count = min(int(query.get('count', [TWEETS_PER_PAGE])[0]),
+                    TWEETS_PER_PAGE)
+        now = self.server.options['now']
+        names = re.findall(r'url:"?(\w+) com', query.get('q', [''])[0])
+        statuses = [
+            tweet for name in set(names) for tweet in fake_tweets(name, now)
+            if since_id < tweet['id'] <= max_id
+        ]
+        statuses.sort(key=lambda tweet: -tweet['id'])
+        self.send_body(200, {
+            'statuses': statuses[:count],
+            'search_metadata': {'count': count}
+        }, headers=headers)
+
+
+def serve(options, ready):
+    """
+    Runs in the servers' process: start the stand-in servers and send their
+    host:ports to ready, then serve until the process is terminated.
+    :param options: a dict of options (see run_benchmark.py's arguments)
+    :param ready: a multiprocessing queue
+    :return: doesn't return anything
+    """
+    servers = {
+        'sites': StandInServer(SiteHandler, options),
+        'moz': StandInServer(MozHandler, options),
+        'twitter': StandInServer(TwitterHandler, options)
+    }
+    for name, server in servers.items():
+        threading.Thread(target=server.serve_forever, name=name,
+                         daemon=True).start()
+    ready.put({name: server.netloc for name, server in servers.items()})
+    threading.Event().wait()
+
+
+def start_servers(options):
+    """
+    Start the stand-in servers in their own process.
+    :param options: a dict of options (see run_benchmark.py's arguments)
+    :return: a tuple of (the process, a dict of host:port per server), where
+    the process should be terminated when the benchmark is done
+    """
+    options = dict(options, now=time.time())
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(options, ready),
+                                      name='standins', daemon=True)
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+class FakeBatchWriter(object):
+    """
+    Buffers put_item calls and writes them BATCH_WRITE_ITEMS at a time, like
+    boto3's batch_writer.
+    """
+    def __init__(self, table, overwrite_by_pkeys=None):
+        self.table = table
+        self.buffer = []
+
+    def put_item(self, Item):
+        self.buffer.append(Item)
+        if len(self.buffer) >= BATCH_WRITE_ITEMS:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.table.request()
+            for item in self.buffer:
+                self.table.store(item)
+            self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+
+class FakeTable(object):
+    """
+    An in-memory DynamoDB table, with the parts of boto3's Table which
+    top_sites uses: scan (with segments and 1 MB pages), put_item,
+    update_item (SET and REMOVE of attribute paths) and batch_writer.
+    Every request takes the resource's latency.
+    """
+    def __init__(self, resource, name, key_schema):
+        self.resource = resource
+        self.name = name
+        self.key_schema = key_schema
+        self.items = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def request(self):
+        with self._lock:
+            self.requests += 1
+        delay(self.resource.latency, random.Random())
+
+    def key(self, item):
+        return tuple(item[key['AttributeName']] for key in self.key_schema)
+
+    def store(self, item):
+        item = copy.deepcopy(item)
+        with self._lock:
+            self.items[self.key(item)] = item
+
+    def scan(self, Segment=0, TotalSegments=1, ExclusiveStartKey=None):
+        self.request()
+        with self._lock:
+            keys = [key for key in self.items
+                    if zlib.crc32(repr(key).encode('utf-8')) %
+                    TotalSegments == Segment]
+            start = 0
+            if ExclusiveStartKey is not None:
+                start = keys.index(self.key(ExclusiveStartKey)) + 1
+            page = []
+            size = 0
+            for key in keys[start:]:
+                if size >= SCAN_PAGE_BYTES:
+                    break
+                page.append(copy.deepcopy(self.items[key]))
+                size += approximate_size(page[-1])
+        response = {'Items': page, 'Count': len(page)}
+        if page and start + len(page) < len(keys):
+            response['LastEvaluatedKey'] = {
+                key['AttributeName']: page[-1][key['AttributeName']]
+                for key in self.key_schema
+            }
+        return response
+
+    def put_item(self, Item):
+        self.request()
+        self.store(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues=None):
+        self.request()
+        values = ExpressionAttributeValues or {}
+        actions = re.split(r'\b(SET|REMOVE) ', UpdateExpression)[1:]
+        with self._lock:
+            item = self.items.setdefault(self.key(Key), copy.deepcopy(Key))
+            for action, clauses in zip(actions[::2], actions[1::2]):
+                for clause in clauses.split(','):
+                    path = clause.split('=')[0].strip().split('.')
+                    path = [ExpressionAttributeNames[name] for name in path]
+                    parent = item
+                    for name in path[:-1]:
+                        parent = parent.setdefault(name, {})
+                    if action == 'SET':
+                        value = values[clause.split('=')[1].strip()]
+                        parent[path[-1]] = copy.deepcopy(value)
+                    else:
+                        parent.pop(path[-1], None)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self, overwrite_by_pkeys)
+
+    def wait_until_exists(self):
+        pass
+
+
+class FakeDynamoResource(object):
+    """
+    An in-memory stand-in for a boto3 DynamoDB resource. Tables are created
+    when they're first used.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def Table(self, name):
+        with self._lock:
+            if name not in self.tables:
+                key_schema = SITES_KEY_SCHEMA if name == 'sites' \
+                    else HISTORY_KEY_SCHEMA
+                self.tables[name] = FakeTable(self, name, key_schema)
+            return self.tables[name]
+
+    def create_table(self, TableName, KeySchema, **kwargs):
+        with self._lock:
+            self.tables[TableName] = FakeTable(self, TableName, KeySchema)
+            return self.tables[TableName]
+
+
+class FakeDynamo(Dynamo):
+    """
+    A Dynamo object backed by a FakeDynamoResource, which every thread
+    shares (the fake resource is thread-safe).
+    """
+    def __init__(self, resource, profile_name='benchmark'):
+        # Dynamo.__init__ would create a boto3 session, so the same
+        # attributes are set here without one.
+        self.profile_name = profile_name
+        self.boto_sess = None
+        self.dynamodb = resource
+        self.scan_failed = False
+        self.write_stats = {
+            'puts': 0,
+            'updates': 0,
+            'skipped': 0,
+            'bytes_written': 0,
+            'bytes_saved': 0,
+            'write_units_saved': 0,
+            'attribute_updates': 0
+        }
+
+    def new_resource(self):
+        return self.dynamodb
+
+
+class FakeBucket(object):
+    """
+    An in-memory stand-in for a boto3 S3 Bucket, which records uploads.
+    """
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.uploads = {}  # key: size in bytes
+
+    def upload_file(self, Filename, Key, ExtraArgs=None):
+        delay(self.latency, random.Random())
+        self.uploads[Key] = os.path.getsize(Filename)
+
+
+class FakeS3(S3):
+    """
+    An S3 object whose bucket is a FakeBucket.
+    """
+    def __init__(self, bucket='top-sites-output', latency=0.0):
+        # S3.__init__ would create a boto3 session, so the same attributes
+        # are set here without one.
+        self.profile_name = 'benchmark'
+        self.boto_sess = None
+        self.s3 = None
+        self.bucket = FakeBucket(bucket, latency)
@@ -0,0 +1,158 @@
+"""
+Synthetic sites for the benchmarks.
+
+generate_sites makes site configs in the same shape as functions/sites.json
+and the example in the README (directives, project, title and url), whose
+urls point at the local site server (see standins.py). seed_pages then
+writes a blog page for each site, the way html_cached_files holds cached
+copies of the sites to be scraped.
+"""
+import os
+import random
+import re
+
+# Words for the pages' filler text and the posts' titles.
+WORDS = (
+    'community workshop urban village shared living housing costs ideas '
+    'recap startup founder coding bootcamp python release notes data '
+    'pipeline growth design review open source tutorial guide interview '
+    'retreat batch pairing debugging performance memory network cache '
+    'product launch weekly update lessons learned story team remote'
+).split()
+PROJECTS = 10
+# Most sites nest the newest post's link two levels deep, like sites.json's
+# example; the rest use the README's single level.
+NESTED_PARAMS = [['class', 'post-list'], ['class', 'post-title'], 'a']
+FLAT_PARAMS = [['class', 'public-article__title'], 'a']
+FLAT_SHARE = 0.1
+
+
+def site_name(number):
+    """
+    :param number: the site's number
+    :return: the site's name, e.g. 'site00042', used for its domain, path
+    and twitter account
+    """
+    return 'site{n:05d}'.format(n=number)
+
+
+def generate_sites(count, netloc, seed=0):
+    """
+    Make synthetic site configs, as they're stored in the sites table.
+    :param count: the number of sites
+    :param netloc: the host:port of the local site server
+    :param seed: seeds the random choices, so runs are comparable
+    :return: a list of dicts
+    """
+    rng = random.Random(seed)
+    sites = []
+    for number in range(count):
+        name = site_name(number)
+        params = FLAT_PARAMS if rng.random() < FLAT_SHARE else NESTED_PARAMS
+        sites.append({
+            'directives': {
+                'scrape1': {
+                    'type': 'scrape_newest',
+                    'parameters': params
+                },
+                'twitter1': {
+                    'type': 'twitter',
+                    'parameters': [
+                        'url:"{n} com"'.format(n=name),
+                        '-from:{n}'.format(n=name)
+                    ]
+                },
+                'moz1': {
+                    'type': 'moz',
+                    'parameters': '{n}.com'.format(n=name)
+                }
+            },
+            'project': 'benchmark_{p}'.format(p=number % PROJECTS),
+            'title': '{w} {n}'.format(w=rng.choice(WORDS).title(), n=name),
+            'url': {
+                'protocol': 'http://',
+                'subdomain': '',
+                'domain': netloc,
+                'path': '/{n}/blog'.format(n=name)
+            }
+        })
+    return sites
+
+
+def page_filename(path):
+    """
+    Name a page's file by its url path, as generate_filename does for
+    html_cached_files.
+    :param path: the url path, e.g. '/site00042/blog'
+    :return: the filename, e.g. 'site00042-blog.html'
+    """
+    name = re.sub(r'[^a-zA-Z\d-]', '', '-'.join(path.split('/')))
+    return name.strip('-') + '.html'
+
+
+def make_page(site, rng, page_bytes):
+    """
+    Make a blog page for a site, with its newest post where the site's
+    scrape directive looks for it, among filler of about page_bytes.
+    :param site: a site config from generate_sites
+    :param rng: a random.Random
+    :param page_bytes: the approximate size of the page
+    :return: the page (str)
+    """
+    def sentence(words):
+        return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+    posts = []
+    size = 0
+    number = 0
+    while size < page_bytes or number < 3:
+        title = sentence(rng.randint(4, 9))
+        href = '/{n}/blog/post-{k}'.format(n=site['url']['path'].split('/')[1],
+                                            k=1000 - number)
+        if site['directives']['scrape1']['parameters'] == FLAT_PARAMS:
+            heading = ('<h2 class="public-article__title">'
+                       '<a href="{h}">{t}</a></h2>')
+        else:
+            heading = ('<div class="post-title"><span class="date">'
+                       '2026-10-{d:02d}</span> <a href="{h}">{t}</a></div>')
+        post = ('<article class="post">' + heading +
+                '<p>{p}.</p><p>{q}.</p></article>\n').format(
+            h=href, t=title, d=28 - number % 28,
+            p=sentence(rng.randint(30, 60)), q=sentence(rng.randint(30, 60))
+        )
+        posts.append(post)
+        size += len(post)
+        number += 1
+    nav = ''.join('<li><a href="/{w}">{w}</a></li>'.format(w=word)
+                  for word in rng.sample(WORDS, 8))
+    return (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+        '<title>{t}</title>'
+        '<link rel="stylesheet" href="/static/style.css"></head>\n'
+        '<body><header><h1>{t}</h1><nav><ul>{n}</ul></nav></header>\n'
+        '<main><section class="post-list">\n{p}</section></main>\n'
+        '<footer><p>{f}.</p></footer></body></html>\n'
+    ).format(t=site['title'], n=nav, p=''.join(posts),
+             f=sentence(12))
+
+
+def seed_pages(sites, pages_dir, page_bytes=12 * 1024, seed=0):
+    """
+    Write each site's blog page to pages_dir, for the local site server.
+    :param sites: site configs from generate_sites
+    :param pages_dir: the directory to write the pages to
+    :param page_bytes: the approximate size of each page
+    :param seed: seeds the pages' random text
+    :return: the total size of the pages written, in bytes
+    """
+    os.makedirs(pages_dir, exist_ok=True)
+    rng = random.Random(seed)
+    total = 0
+    for site in sites:
+        page = make_page(site, rng, page_bytes).encode('utf-8')
+        filename = os.path.join(pages_dir,
+                                page_filename(site['url']['path']))
+        with open(filename, 'wb') as f:
+            f.write(page)
+        total += len(page)
+    return total
@@ -0,0 +1,379 @@
+"""
+Record/replay of the HTTP responses which a run receives ("cassettes").
+
+Scraping, Moz and Twitter all send their requests through the shared
+requests.Session (see http_client.py). When the "cassettes" setting in
+app_config.json turns them on, the Session's adapter is a CassetteAdapter,
+which works in one of these modes:
+    - 'record': send every request, and save its response
+    - 'replay': never touch the network; answer every request with its saved
+      response (a request without one fails with a ConnectionError)
+    - 'auto': replay the requests which have a saved response, and record
+      the rest
+Each response is saved gzipped, in its own file named by a SHA-256 hash of
+the request (method, url, body and conditional headers), so different
+requests can't overwrite each other's cassettes. Query parameters which
+change on every call without changing the response (Moz's signature and
+expiry time, and Twitter's "since" date and "since_id") are left out of the
+hash, so that a later run's requests find the cassettes recorded by an
+earlier run.
+
+A run's sites are recorded and replayed too: recording saves the rows of
+the sites table as the pipeline scans them (see record_items), and
+replaying reads them back (see replay_items) instead of scanning DynamoDB.
+A replayed run doesn't write to DynamoDB or upload to S3 (see pipeline.py),
+so every replay starts from the same recorded rows and sends the same
+requests. Recording also saves the time at which the rows were read, and a
+replayed run's clock (see utcnow) is pinned to it, so that whatever depends
+on the day (e.g. which days' tweets are counted, see twitter.py) comes out
+the same however long after the recording it's replayed.
+"""
+import base64
+import datetime
+from decimal import Decimal
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from config import get_setting
+
+MODES = ('off', 'record', 'replay', 'auto')
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Default settings. These can be overridden in app_config.json with a
+# "cassettes" key, e.g. {"cassettes": {"mode": "replay"}}.
+#   - mode: one of MODES
+#   - directory: where cassettes are saved, in a folder per host
+#   - ignore_params: query parameters which aren't part of a request's hash
+#   - match_headers: request headers which are part of a request's hash
+DEFAULT_SETTINGS = {
+    'mode': 'off',
+    'directory': '../cassettes',
+    'ignore_params': ['AccessID', 'Expires', 'Signature', 'since',
+                      'since_id'],
+    'match_headers': ['If-None-Match', 'If-Modified-Since']
+}
+
+
+def get_settings():
+    """
+    :return: the cassette settings, DEFAULT_SETTINGS updated by the
+    "cassettes" setting in app_config.json
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(get_setting('cassettes', {}))
+    if settings['mode'] not in MODES:
+        raise ValueError('cassettes mode must be one of {m}, not {v}'.format(
+            m=MODES, v=settings['mode']
+        ))
+    return settings
+
+
+def replaying():
+    """
+    :return: True if every response is replayed, i.e. no request reaches an
+    api (and so there are no rate limits to wait for)
+    """
+    return get_settings()['mode'] == 'replay'
+
+
+def request_key(method, url, body, headers, ignore_params, match_headers):
+    """
+    Hash the parts of a request which decide its response.
+    :param method: the HTTP method
+    :param url: the full url, with its query string
+    :param body: the request body (bytes, str or None)
+    :param headers: the request headers (dict-like)
+    :param ignore_params: query parameters to leave out
+    :param match_headers: the headers to include (when they're present)
+    :return: the hash as a hex str
+    """
+    parts = urlsplit(url)
+    query = sorted((name, value) for name, value
+                   in parse_qsl(parts.query, keep_blank_values=True)
+                   if name not in ignore_params)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    canonical = {
+        'method': method.upper(),
+        'url': urlunsplit((parts.scheme, parts.netloc.lower(), parts.path,
+                           urlencode(query), '')),
+        'body': hashlib.sha256(body).hexdigest() if body else None,
+        'headers': {name: headers[name] for name in match_headers
+                    if headers.get(name) is not None}
+    }
+    return hashlib.sha256(
+        json.dumps(canonical, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+class CassetteAdapter(HTTPAdapter):
+    """
+    A requests transport adapter which records responses to, and replays
+    them from, cassette files.
+    """
+    def __init__(self, mode, directory, ignore_params=(), match_headers=(),
+                 **kwargs):
+        """
+        Initialize the CassetteAdapter.
+        :param mode: 'record', 'replay' or 'auto' (see the module docstring)
+        :param directory: where cassettes are saved
+        :param ignore_params: query parameters which aren't hashed
+        :param match_headers: request headers which are hashed
+        :param kwargs: HTTPAdapter's arguments (pool sizes and retries)
+        """
+        super().__init__(**kwargs)
+        self.mode = mode
+        self.directory = directory
+        self.ignore_params = tuple(ignore_params)
+        self.match_headers = tuple(match_headers)
+        self.stats = {
+            'replayed': 0,
+            'recorded': 0,
+            'missing': 0
+        }
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def filename(self, request, key):
+        """
+        :param request: a requests.PreparedRequest
+        :param key: the request's hash (see request_key)
+        :return: the filename of the request's cassette
+        """
+        host = urlsplit(request.url).netloc.lower().replace(':', '_')
+        return os.path.join(self.directory, host or 'unknown',
+                            key + '.json.gz')
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        keys = [request_key(request.method, request.url, request.body,
+                            request.headers, self.ignore_params, ())]
+        if any(request.headers.get(name) is not None
+               for name in self.match_headers):
+            # A conditional request prefers a response to the same
+            # conditions, but a full response to the unconditional request
+            # is a valid answer too (servers may ignore the conditions).
+            keys.insert(0, request_key(
+                request.method, request.url, request.body, request.headers,
+                self.ignore_params, self.match_headers
+            ))
+        if self.mode in ('replay', 'auto'):
+            for key in keys:
+                try:
+                    cassette = load_cassette(self.filename(request, key))
+                except FileNotFoundError:
+                    continue
+                self._count('replayed')
+                return self.build_replayed(request, cassette)
+            if self.mode == 'replay':
+                self._count('missing')
+                raise ConnectionError(
+                    'no cassette for {m} {u} (replaying with no network)'
+                    .format(m=request.method, u=request.url),
+                    request=request
+                )
+        # Read the whole body, so that it can be saved.
+        response = super().send(request, stream=False, timeout=timeout,
+                                verify=verify, cert=cert, proxies=proxies)
+        save_cassette(self.filename(request, keys[0]), request, response)
+        self._count('recorded')
+        return response
+
+    def build_replayed(self, request, cassette):
+        """
+        Make a requests.Response from a cassette.
+        :param request: the requests.PreparedRequest being answered
+        :param cassette: a dict, as loaded by load_cassette
+        :return: a requests.Response object
+        """
+        saved = cassette['response']
+        if 'body_text' in saved:
+            body = saved['body_text'].encode('utf-8')
+        else:
+            body = base64.b64decode(saved['body_base64'])
+        response = Response()
+        response.status_code = saved['status']
+        response.reason = saved['reason']
+        response.headers = CaseInsensitiveDict(saved['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        # The body is already read, so iter_content replays it in chunks.
+        response.raw = io.BytesIO(body)
+        response._content = body
+        response._content_consumed = True
+        return response
+
+
+def save_cassette(filename, request, response):
+    """
+    Save a response as a gzipped cassette (written to a temporary file and
+    then renamed, so that a cassette is never read half-written).
+    :param filename: the cassette's filename
+    :param request: the requests.PreparedRequest which was sent
+    :param response: the requests.Response which was received
+    :return: doesn't return anything
+    """
+    saved = {
+        'status': response.status_code,
+        'reason': response.reason,
+        'headers': dict(response.headers)
+    }
+    # Stored bodies are decoded, so they mustn't claim to be compressed (or
+    # to have their encoded length).
+    for header in ('Content-Encoding', 'Transfer-Encoding', 'Content-Length'):
+        saved['headers'].pop(header, None)
+    try:
+        saved['body_text'] = response.content.decode('utf-8')
+    except UnicodeDecodeError:
+        saved['body_base64'] = base64.b64encode(response.content).decode(
+            'ascii'
+        )
+    cassette = {
+        'request': {
+            'method': request.method,
+            'url': request.url
+        },
+        'response': saved
+    }
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temporary = '{f}.{t}.tmp'.format(f=filename, t=threading.get_ident())
+    with gzip.open(temporary, 'wt', encoding='utf-8') as f:
+        json.dump(cassette, f)
+    os.replace(temporary, filename)
+
+
+def load_cassette(filename):
+    """
+    :param filename: a cassette's filename
+    :return: the cassette as a dict; raises FileNotFoundError if there
+    isn't one
+    """
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def items_filename(table_name):
+    """
+    :param table_name: the name of a DynamoDB table
+    :return: the filename of the table's recorded rows
+    """
+    return os.path.join(get_settings()['directory'], 'dynamodb',
+                        table_name + '.jsonl.gz')
+
+
+def encode_decimal(value):
+    """
+    JSON encoding for the Decimals which DynamoDB returns numbers as.
+    :param value: a value which json can't encode
+    :return: a dict which decode_decimal turns back into the Decimal
+    """
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    raise TypeError('{t} is not JSON serializable'.format(
+        t=type(value).__name__))
+
+
+def decode_decimal(obj):
+    """
+    :param obj: a dict decoded from JSON
+    :return: the Decimal which encode_decimal encoded, or obj
+    """
+    if list(obj) == ['__decimal__']:
+        return Decimal(obj['__decimal__'])
+    return obj
+
+
+def clock_filename():
+    """
+    :return: the filename of the time at which the rows were recorded
+    """
+    return os.path.join(get_settings()['directory'], 'dynamodb',
+                        'recorded_at.json')
+
+
+def utcnow():
+    """
+    The clock for anything a run's results depend on the day of.
+    :return: when replaying, the time (UTC datetime) at which the replayed
+    rows were recorded; otherwise (or if that wasn't saved) the time now
+    """
+    if replaying():
+        try:
+            with open(clock_filename(), 'r') as f:
+                return datetime.datetime.strptime(
+                    json.load(f)['recorded_at'], TIME_FORMAT
+                )
+        except FileNotFoundError:
+            pass
+    return datetime.datetime.utcnow()
+
+
+def record_items(items, table_name):
+    """
+    Save a table's rows as they're read, one line of JSON each, and the time
+    at which they were read (see utcnow). The files are only replaced once
+    every row has been read, so a failed scan leaves the previous recording
+    as it was.
+    :param items: an iterable of rows (dicts)
+    :param table_name: the name of the table the rows are from
+    :return: a generator of the same rows
+    """
+    recorded_at = datetime.datetime.utcnow().strftime(TIME_FORMAT)
+    filename = items_filename(table_name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temporary = '{f}.{t}.tmp'.format(f=filename, t=threading.get_ident())
+    try:
+        with gzip.open(temporary, 'wt', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, default=encode_decimal) + '\n')
+                yield item
+        os.replace(temporary, filename)
+        with open(temporary, 'w') as f:
+            json.dump({'recorded_at': recorded_at}, f)
+        os.replace(temporary, clock_filename())
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def replay_items(table_name):
+    """
+    Read back the rows which record_items saved.
+    :param table_name: the name of the table the rows are from
+    :return: a generator of rows (dicts); raises FileNotFoundError if none
+    were recorded
+    """
+    with gzip.open(items_filename(table_name), 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line, object_hook=decode_decimal)
+
+
+def make_adapter(pool_kwargs):
+    """
+    Make the CassetteAdapter which the "cassettes" setting asks for.
+    :param pool_kwargs: HTTPAdapter's arguments (pool sizes and retries)
+    :return: a CassetteAdapter, or None if cassettes are off
+    """
+    settings = get_settings()
+    if settings['mode'] == 'off':
+        return None
+    return CassetteAdapter(
+        mode=settings['mode'],
+        directory=settings['directory'],
+        ignore_params=settings['ignore_params'],
+        match_headers=settings['match_headers'],
+        **pool_kwargs
+    )
@@ -0,0 +1,41 @@
+"""
+Functions to read this package's settings from app_config.json.
+"""
+import json
+import os
+import threading
+
+CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'app_config.json'
+)
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def load_config(filename=CONFIG_FILE):
+    """
+    Read app_config.json once and keep it for the rest of the run.
+    :param filename: the JSON file to read settings from
+    :return: the settings as a dict (empty dict if the file is missing)
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            try:
+                with open(filename, 'r') as f:
+                    _config = json.load(f)
+            except FileNotFoundError:
+                _config = {}
+    return _config
+
+
+def get_setting(name, default=None):
+    """
+    Look up a single setting from app_config.json.
+    :param name: the top-level key of the setting within app_config.json
+    :param default: the value to return if the setting isn't present
+    :return: the setting's value, or default
+    """
+    return load_config().get(name, default)
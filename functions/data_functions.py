@@ -3,6 +3,11 @@ Functions that operate on data structures used within this package.
 """
 import datetime
 from decimal import Decimal
+from config import get_setting
+
+# data_names whose dicts only need their latest value kept (e.g. state which
+# is carried from one run to the next), rather than a history.
+LATEST_ONLY_DATA_NAMES = {'twitter_state'}
 
 
 def make_dict(value, data_name, start_time, status='ok'):
@@ -33,10 +38,28 @@ def make_dict(value, data_name, start_time, status='ok'):
     return formatted_dict
 
 
-def unpack_and_save_list(list_of_dicts, data_dict, location):
+def latest_payload(data_subbranch, data_name):
+    """
+    Returns the most recently saved payload for data_name, if there is one.
+    :param data_subbranch: a directive's data branch (e.g. data['scrape1'])
+    as built by unpack_and_save_list, or None
+    :param data_name: the key of the list within data_subbranch
+    :return: the payload of the first (newest) dict in the list, or None
+    """
+    try:
+        return data_subbranch[data_name][0]['payload']
+    except (TypeError, KeyError, IndexError):
+        return None
+
+
+def unpack_and_save_list(list_of_dicts, data_dict, location,
+                         max_to_keep=None):
     """
     Puts each dict from list_of_dicts in appropriate place in data_structure.
-    Also stores a maximum of max_to_keep dicts (e.g. 30 days' worth).
+    Also stores a maximum of max_to_keep dicts. The full history is also
+    kept in the history table (see history.py); once the history held inline
+    has been copied there, "inline_history" can be lowered (e.g. to 1) to
+    keep site items small.
     data_structure is assumed to look like this:
         {
           '<location/data_subbranch (eg scrape1/twitter1/moz1)>': {
@@ -50,22 +73,27 @@ def unpack_and_save_list(list_of_dicts, data_dict, location):
     :param data_dict: the full (JSON) data structure from database
     :param location: the top-level key within data_structure where each dict
     within list_of_dicts will be stored
+    :param max_to_keep: (int >= 1) number of dicts to store in data_dict
+    lists; defaults to the "inline_history" setting in app_config.json, or 5
     :return: returns revised data_structure
     """
-    max_to_keep = 5  # (int >= 1) number dicts to store in data_dict lists
+    if max_to_keep is None:
+        max_to_keep = get_setting('inline_history', 5)
     data_subbranch = data_dict[location]
     for target_dict in list_of_dicts:
         data_name = target_dict['data_name']  # key where target_list lives
+        # (int >= 1) number dicts to store in data_dict lists
+        keep = 1 if data_name in LATEST_ONLY_DATA_NAMES else max_to_keep
         try:  # see whether the key already exists
             # target_list is which list to save target_dict to
             target_list = data_subbranch[data_name]
         except KeyError:
             data_subbranch[data_name] = []
             target_list = data_subbranch[data_name]
-        if len(target_list) > max_to_keep - 1:
-            sliced_dict = target_list[max_to_keep - 1:]
-            target_list = target_list[:max_to_keep - 1]
-            print('sliced_dict:', sliced_dict)
+        if len(target_list) > keep - 1:
+            # The oldest dicts are dropped (they're in the history table
+            # if it has been backfilled; see history.py).
+            target_list = target_list[:keep - 1]
         target_list = [target_dict] + target_list
         data_dict[location][data_name] = target_list
     return data_dict
@@ -0,0 +1,258 @@
+"""
+Compiled matchers for scrape directives, with pluggable parser backends.
+
+A scrape directive's params (e.g. [["class", "public-article__title"], "a"])
+are compiled once into a DirectiveMatcher, which is cached and reused for
+every later page scraped with the same params. The matcher can be run
+against a page parsed by one of these backends:
+    - 'html.parser': BeautifulSoup with Python's built-in html.parser
+    - 'lxml': lxml's C parser, with each step compiled to an XPath query
+Both backends give the same results: each item of params finds the first
+matching descendant within the element matched by the previous item, an
+attribute value with spaces only matches the whole (whitespace-normalized)
+value of a multi-valued attribute such as class, and the target's text
+leaves out the text of <script>, <style> and <template> elements (as
+BeautifulSoup's get_text does).
+"""
+from functools import lru_cache
+import json
+import re
+import threading
+from bs4 import BeautifulSoup
+from bs4.dammit import UnicodeDammit
+from config import get_setting
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:  # lxml is optional; only needed for the 'lxml' backend
+    etree = None
+    lxml_html = None
+
+BACKENDS = ('html.parser', 'lxml')
+DEFAULT_BACKEND = 'html.parser'
+
+# Attributes whose values are whitespace-separated lists (as in
+# BeautifulSoup, e.g. ["class", "foo"] matches class="foo bar").
+MULTI_VALUED_ATTRIBUTES = {
+    'class', 'rel', 'rev', 'accept-charset', 'headers', 'accesskey',
+    'dropzone'
+}
+# Text within these elements isn't part of an element's text.
+NON_TEXT_ELEMENTS = {'script', 'style', 'template'}
+# Tag and attribute names which can be written directly into an XPath.
+XPATH_NAME = re.compile(r'^[a-zA-Z_][\w-]*$')
+
+
+class MatchedElement(object):
+    """
+    The element found by a directive. It offers the subset of a
+    BeautifulSoup Tag that scrape_newest uses: .text and ['attribute'].
+    """
+    def __init__(self, name, attrs, text):
+        self.name = name
+        self.attrs = attrs
+        self.text = text
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+
+class DirectiveStep(object):
+    """
+    One compiled item of a directive's params: either a tag name (e.g. "a")
+    or an attribute name and value (e.g. ["class", "foo"]).
+    """
+    def __init__(self, param):
+        if isinstance(param, list):
+            if len(param) != 2:
+                raise ValueError('directive param {p} must have exactly two '
+                                 'items'.format(p=param))
+            self.tag = None
+            self.attr = param[0].lower()
+            self.value = param[1]
+            self.multi_valued = self.attr in MULTI_VALUED_ATTRIBUTES
+        else:
+            self.tag = param.lower()
+            self.attr = None
+            self.value = None
+            self.multi_valued = False
+        self.param = param
+        # Compiled XPath objects are kept per thread, since lxml's XPath
+        # evaluators shouldn't be used by two threads at the same time.
+        self._local = threading.local()
+
+    def matches(self, tag, attrs):
+        """
+        Checks whether an element matches this step.
+        :param tag: the element's (lowercase) tag name
+        :param attrs: the element's attributes as a dict
+        :return: True if it matches, False if not
+        """
+        if self.tag is not None:
+            return tag == self.tag
+        value = attrs.get(self.attr)
+        if value is None:
+            return False
+        if value == self.value:
+            return True
+        if not self.multi_valued:
+            return False
+        # A single class matches any of the element's classes, and several
+        # match the element's classes joined by single spaces.
+        values = value.split()
+        return self.value in values or ' '.join(values) == self.value
+
+    def find_soup(self, soup):
+        """
+        Find the first descendant of a BeautifulSoup element matching this
+        step.
+        :param soup: a BeautifulSoup object or Tag
+        :return: the matching Tag, or None
+        """
+        if self.tag is not None:
+            return soup.find(self.tag)
+        return soup.find(attrs={self.attr: self.value})
+
+    def find_lxml(self, element):
+        """
+        Find the first descendant of an lxml element matching this step.
+        :param element: an lxml element
+        :return: the matching lxml element, or None
+        """
+        xpath = getattr(self._local, 'xpath', None)
+        if xpath is None:
+            xpath = self._local.xpath = self.compile_xpath()
+        found = xpath(element, value=self.value or '')
+        return found[0] if found else None
+
+    def compile_xpath(self):
+        """
+        Compile this step to an XPath query for the first matching
+        descendant.
+        :return: an lxml.etree.XPath object, called with a value= variable
+        """
+        if self.tag is not None:
+            if XPATH_NAME.match(self.tag):
+                return etree.XPath('(descendant::{t})[1]'.format(t=self.tag))
+            return etree.XPath('(descendant::*[name()="{t}"])[1]'.format(
+                t=self.tag.replace('"', '')
+            ))
+        if XPATH_NAME.match(self.attr):
+            attr = '@' + self.attr
+        else:
+            attr = '@*[name()="{a}"]'.format(a=self.attr.replace('"', ''))
+        condition = '{a}=$value'.format(a=attr)
+        if self.multi_valued and len(self.value.split()) > 1:
+            condition += ' or normalize-space({a})=$value'.format(a=attr)
+        elif self.multi_valued:
+            condition += (' or contains(concat(" ", normalize-space({a}), '
+                          '" "), concat(" ", $value, " "))'.format(a=attr))
+        return etree.XPath('(descendant::*[{c}])[1]'.format(c=condition))
+
+
+class DirectiveMatcher(object):
+    """
+    A scrape directive's params, compiled once for reuse on many pages.
+    """
+    def __init__(self, params):
+        """
+        Compile params.
+        :param params: a list of str tag names and/or two-item lists of
+        attribute name and value
+        """
+        self.params = params
+        self.steps = [DirectiveStep(param) for param in params]
+
+    def match(self, raw_html, backend=None):
+        """
+        Parse raw_html with backend and find the directive's target element.
+        :param raw_html: the page's HTML (bytes or str)
+        :param backend: 'html.parser' or 'lxml'; defaults to the
+        "parser_backend" setting in app_config.json
+        :return: the target element, which has .text and ['attribute'].
+        """
+        if backend is None:
+            backend = get_setting('parser_backend', DEFAULT_BACKEND)
+        if backend == 'html.parser':
+            return self.match_soup(BeautifulSoup(raw_html, 'html.parser'))
+        if backend == 'lxml':
+            if etree is None:
+                raise ValueError('parser_backend "lxml" needs the lxml '
+                                 'package, which is not installed')
+            if isinstance(raw_html, bytes):
+                # Decode the same way BeautifulSoup does, so that both
+                # backends see the same text.
+                raw_html = UnicodeDammit(raw_html, is_html=True).unicode_markup
+            return self.match_lxml(lxml_html.document_fromstring(raw_html))
+        raise ValueError('unknown parser_backend {b}; expected one of '
+                         '{o}'.format(b=backend, o=BACKENDS))
+
+    def match_soup(self, soup):
+        """
+        Follow the steps through a BeautifulSoup tree.
+        :param soup: a BeautifulSoup object
+        :return: the target Tag
+        """
+        for step in self.steps:
+            soup = step.find_soup(soup)
+            if soup is None:
+                raise ValueError("BeautifulSoup couldn't find params "
+                                 "{p}".format(p=self.params))
+        return soup
+
+    def match_lxml(self, element):
+        """
+        Follow the steps through an lxml tree.
+        :param element: the root lxml element
+        :return: a MatchedElement of the target element
+        """
+        for step in self.steps:
+            element = step.find_lxml(element)
+            if element is None:
+                raise ValueError("lxml couldn't find params {p}".format(
+                    p=self.params
+                ))
+        return MatchedElement(
+            name=element.tag,
+            attrs=dict(element.attrib),
+            text=element_text(element)
+        )
+
+
+def element_text(element):
+    """
+    Join an lxml element's text, leaving out comments and the text of
+    NON_TEXT_ELEMENTS (lxml's text_content includes both).
+    :param element: an lxml element
+    :return: the text (str)
+    """
+    parts = []
+
+    def add_text(current):
+        if current.text:
+            parts.append(current.text)
+        for child in current:
+            # Comments and processing instructions don't have a str tag.
+            if isinstance(child.tag, str) and \
+                    child.tag.lower() not in NON_TEXT_ELEMENTS:
+                add_text(child)
+            if child.tail:
+                parts.append(child.tail)
+
+    add_text(element)
+    return ''.join(parts)
+
+
+@lru_cache(maxsize=4096)
+def _compile(params_key):
+    return DirectiveMatcher(json.loads(params_key))
+
+
+def get_matcher(params):
+    """
+    Return the compiled DirectiveMatcher for params, compiling it only the
+    first time that these params are seen.
+    :param params: a scrape directive's parameters
+    :return: a DirectiveMatcher object
+    """
+    return _compile(json.dumps(params))
@@ -1,9 +1,21 @@
 """
 AWS DynamoDB functions
 """
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import queue
 import boto3
 from botocore.exceptions import ClientError
+from config import get_setting
 from error_handling import handle_error
+from tracing import span
+
+# Attributes which change every time a Site is built (see diff_item).
+VOLATILE_ATTRIBUTES = ('elapsed_seconds',)
+# Fields of each value in 'data' (see make_dict) which change every time the
+# value is retrieved, even when the value itself hasn't changed.
+VOLATILE_FIELDS = ('accessed', 'duration')
 
 
 class Dynamo(object):
@@ -26,19 +38,136 @@ class Dynamo(object):
             profile_name=self.profile_name,
         )
         self.dynamodb = self.boto_sess.resource('dynamodb')
+        self.scan_failed = False
+        self.write_stats = {
+            'puts': 0,
+            'updates': 0,
+            'skipped': 0,
+            'bytes_written': 0,
+            'bytes_saved': 0,
+            'write_units_saved': 0,
+            'attribute_updates': 0
+        }
+
+    def new_resource(self):
+        """
+        Create another DynamoDB resource with this object's profile, for use
+        by another thread.
+        :return: a boto3 DynamoDB resource
+        """
+        return boto3.session.Session(
+            profile_name=self.profile_name,
+        ).resource('dynamodb')
 
-    def get_all_rows(self, table_name):
+    def get_all_rows(self, table_name, total_segments=None):
         """
         Retrieves all rows by scanning a DynamoDB table.
         :param table_name: the name of the table to scan
-        :return: returns all rows as a list of dicts if successful, returns 
+        :param total_segments: the number of segments to scan in parallel
+        (see iter_rows)
+        :return: returns all rows as a list of dicts if successful, returns
         None if unsuccessful
         """
-        table = self.dynamodb.Table(table_name)
+        try:
+            items = list(self.iter_rows(table_name, total_segments))
+        except Exception as e:
+            handle_error(
+                exc=type(e),
+                err=e,
+                msg='could not scan table_name "{t}"'.format(t=table_name)
+            )
+            return None
+        if self.scan_failed:
+            return None
+        return items
+
+    def iter_rows(self, table_name, total_segments=None):
+        """
+        Scans a DynamoDB table and yields its rows as the pages arrive, so
+        that callers can start working on the first rows before the scan has
+        finished. When total_segments is greater than 1, the table is split
+        into that many segments (with scan's Segment/TotalSegments) which are
+        scanned in parallel by a pool of threads.
+        :param table_name: the name of the table to scan
+        :param total_segments: the number of segments to scan in parallel;
+        defaults to the "scan_segments" setting in app_config.json, or 1
+        :return: yields rows as dicts. If the scan fails with a ClientError,
+        the error is handled and scan_failed is set to True; any other error
+        also sets scan_failed, and is raised once the rows of the other
+        segments have been yielded. Either way, the rows yielded are only
+        part of the table.
+        """
+        if total_segments is None:
+            total_segments = get_setting('scan_segments', 1)
+        self.scan_failed = False
+        if total_segments <= 1:
+            try:
+                for page in self._scan_pages(self.dynamodb, table_name):
+                    yield from page
+            except Exception:
+                self.scan_failed = True
+                raise
+            return
+
+        # Each segment's pages are put on pages_queue by its own thread, and
+        # None is put on the queue when a segment is finished. (The queue is
+        # unbounded so that segment threads never block if the caller stops
+        # iterating early.)
+        pages_queue = queue.Queue()
+
+        def scan_segment(segment):
+            # boto3 resources aren't thread-safe, so each thread needs its own.
+            try:
+                dynamodb = self.new_resource()
+                for page in self._scan_pages(
+                        dynamodb, table_name,
+                        Segment=segment, TotalSegments=total_segments):
+                    pages_queue.put(page)
+            except Exception:
+                # Raised again by future.result(), below.
+                self.scan_failed = True
+                raise
+            finally:
+                pages_queue.put(None)
+
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            futures = [executor.submit(scan_segment, segment)
+                       for segment in range(total_segments)]
+            segments_left = total_segments
+            while segments_left:
+                page = pages_queue.get()
+                if page is None:
+                    segments_left -= 1
+                else:
+                    yield from page
+            for future in futures:
+                future.result()
+
+    def _scan_pages(self, dynamodb, table_name, **scan_kwargs):
+        """
+        Scans a DynamoDB table (or one segment of it), following
+        LastEvaluatedKey, and yields each page of rows.
+        :param dynamodb: a boto3 DynamoDB resource
+        :param table_name: the name of the table to scan
+        :param scan_kwargs: extra arguments for scan (e.g. Segment)
+        :return: yields lists of rows (dicts)
+        """
+        table = dynamodb.Table(table_name)
 
         try:
-            response = table.scan()
+            with span('dynamodb scan page', table=table_name):
+                response = table.scan(**scan_kwargs)
+            yield response['Items']
+
+            while 'LastEvaluatedKey' in response:
+                with span('dynamodb scan page', table=table_name):
+                    response = table.scan(
+                        ExclusiveStartKey=response['LastEvaluatedKey'],
+                        **scan_kwargs
+                    )
+                yield response['Items']
         except ClientError as e:
+            self.scan_failed = True
             error = e.response['Error']['Code']
             if error == 'ResourceNotFoundException':
                 handle_error(
@@ -52,31 +181,45 @@ class Dynamo(object):
                     err=e,
                     msg='unknown error'
                 )
-            return None
-
-        items = response['Items']
-
-        while 'LastEvaluatedKey' in response:
-            response = table.scan(
-                ExclusiveStartKey=response['LastEvaluatedKey']
-            )
-            items.extend(response['Items'])
 
-        return items
-
-    def batch_update_rows(self, table_name, items):
+    def batch_update_rows(self, table_name, items, diff_writes=None,
+                          volatile_fields=VOLATILE_FIELDS):
         """
         Takes a list of object(s) and updates those in DynamoDB table_name
+        When diff_writes is True, each object is compared with the item it
+        was loaded from (its _loaded_item) and only the changed parts are
+        written (see update_changed_rows); objects without a _loaded_item are
+        written whole.
         :param table_name: the name of the DynamoDB table to be updated
         :param items: a list of object(s)
+        :param diff_writes: defaults to the "diff_writes" setting in
+        app_config.json, or True
+        :param volatile_fields: the fields of the values in 'data' which
+        aren't compared (see diff_item)
         :return: True if succeeded, false if failed
         """
+        if diff_writes is None:
+            diff_writes = get_setting('diff_writes', True)
+        with span('batch_update_rows', table=table_name, items=len(items)):
+            if diff_writes:
+                return self.update_changed_rows(table_name, items,
+                                                volatile_fields)
+            return self.put_rows(table_name, items)
+
+    def put_rows(self, table_name, items):
+        """
+        Writes each of a list of object(s) whole, with a batch writer.
+        :param table_name: the name of the DynamoDB table to be updated
+        :param items: a list of object(s)
+        :return: True if succeeded, false if failed
+        """
+
         table = self.dynamodb.Table(table_name)
 
         try:
             with table.batch_writer() as batch:
                 for item in items:
-                    item = vars(item)
+                    item = object_to_item(item)
                     batch.put_item(Item=item)
         except ClientError as e:
             handle_error(
@@ -87,3 +230,217 @@ class Dynamo(object):
             return False
 
         return True
+
+    def update_changed_rows(self, table_name, items,
+                            volatile_fields=VOLATILE_FIELDS):
+        """
+        Writes only what has changed in each object since it was loaded.
+        Changed top-level attributes and changed sub-branches of 'data'
+        (e.g. data.scrape1) are set with UpdateItem, one call per object
+        (DynamoDB has no batched UpdateItem); objects which haven't changed
+        at all are skipped, and objects without a _loaded_item are put whole
+        with a batch writer. Counts are kept in write_stats:
+          - puts/updates/skipped: the number of items written each way
+          - bytes_written: the approximate size of what was sent
+          - bytes_saved: the approximate size of what didn't need sending
+          - write_units_saved: the write capacity units of skipped items
+          (DynamoDB charges an UpdateItem for the whole item's size, so
+          partial updates save bandwidth but not write units)
+        :param table_name: the name of the DynamoDB table to be updated
+        :param items: a list of object(s) with a _loaded_item attribute
+        :param volatile_fields: the fields of the values in 'data' which
+        aren't compared (see diff_item)
+        :return: True if succeeded, false if failed
+        """
+        table = self.dynamodb.Table(table_name)
+        key_names = [key['AttributeName'] for key in table.key_schema]
+        stats = self.write_stats
+
+        try:
+            with table.batch_writer() as batch:
+                for obj in items:
+                    item = object_to_item(obj)
+                    loaded = getattr(obj, '_loaded_item', None)
+                    item_size = approximate_size(item)
+                    if loaded is None:
+                        batch.put_item(Item=item)
+                        stats['puts'] += 1
+                        stats['bytes_written'] += item_size
+                        obj._loaded_item = copy.deepcopy(item)
+                        continue
+                    update = diff_item(loaded, item, key_names,
+                                       volatile_fields=volatile_fields)
+                    if update is None:
+                        stats['skipped'] += 1
+                        stats['bytes_saved'] += item_size
+                        stats['write_units_saved'] += \
+                            -(-item_size // 1024)  # rounded up, per 1 KB
+                        continue
+                    table.update_item(
+                        Key={key: item[key] for key in key_names},
+                        **update
+                    )
+                    update_size = approximate_size(
+                        update.get('ExpressionAttributeValues', {})
+                    )
+                    stats['updates'] += 1
+                    stats['bytes_written'] += update_size
+                    stats['bytes_saved'] += max(0, item_size - update_size)
+                    obj._loaded_item = copy.deepcopy(item)
+        except ClientError as e:
+            handle_error(
+                exc=ClientError,
+                err=e,
+                msg="unknown error"
+            )
+            return False
+
+        return True
+
+    def update_attributes(self, table_name, updates):
+        """
+        Sets a few top-level attributes of existing items (e.g. the rank and
+        score, which are only known once every site has been written), one
+        UpdateItem per item. Counted in write_stats['attribute_updates'].
+        :param table_name: the name of the DynamoDB table to be updated
+        :param updates: a list of (key, attributes) tuples of dicts, where
+        key holds the item's key attributes
+        :return: True if succeeded, false if failed
+        """
+        table = self.dynamodb.Table(table_name)
+        try:
+            for key, attributes in updates:
+                update = diff_item({}, attributes, key_names=(), volatile=())
+                if update is None:
+                    continue
+                table.update_item(Key=key, **update)
+                self.write_stats['attribute_updates'] += 1
+        except ClientError as e:
+            handle_error(
+                exc=ClientError,
+                err=e,
+                msg="unknown error"
+            )
+            return False
+
+        return True
+
+
+def object_to_item(obj):
+    """
+    Convert an object (e.g. a Site) to a dict to be saved to DynamoDB.
+    :param obj: an object, using its to_item method if it has one
+    :return: a dict
+    """
+    if hasattr(obj, 'to_item'):
+        return obj.to_item()
+    return vars(obj)
+
+
+def approximate_size(value):
+    """
+    Approximate the number of bytes that value takes up in DynamoDB.
+    :param value: a dict/list/str/number
+    :return: the size in bytes (int)
+    """
+    return len(json.dumps(value, default=str).encode('utf-8'))
+
+
+def without_fields(branch, fields):
+    """
+    Copy a directive's data branch without some fields of its values.
+    :param branch: a data branch, e.g. {'tweets': [{'payload': 3, ...}]}
+    :param fields: the names of the fields to leave out of each value
+    :return: the copied branch (anything not shaped like a data branch is
+    returned as it is)
+    """
+    if not isinstance(branch, dict):
+        return branch
+    return {
+        data_name: [
+            {field: value for field, value in record.items()
+             if field not in fields}
+            if isinstance(record, dict) else record
+            for record in records
+        ] if isinstance(records, list) else records
+        for data_name, records in branch.items()
+    }
+
+
+def diff_item(loaded, item, key_names, volatile=VOLATILE_ATTRIBUTES,
+              volatile_fields=VOLATILE_FIELDS):
+    """
+    Build the UpdateItem arguments which turn loaded into item.
+    :param loaded: the item as it was loaded from DynamoDB
+    :param item: the item as it is now
+    :param key_names: the names of the table's key attributes
+    :param volatile: attributes which change on every run, and so are only
+    written along with other changes
+    :param volatile_fields: fields of the values in 'data' which change on
+    every run; a data branch whose values only differ in these is left as it
+    was loaded
+    :return: a dict of UpdateExpression, ExpressionAttributeNames and
+    ExpressionAttributeValues, or None if nothing has changed
+    """
+    names = {}
+    values = {}
+    set_parts = []
+    remove_parts = []
+
+    def name_ref(name):
+        ref = '#n{i}'.format(i=len(names))
+        names[ref] = name
+        return ref
+
+    def set_value(path, value):
+        ref = ':v{i}'.format(i=len(values))
+        values[ref] = value
+        set_parts.append('{p} = {r}'.format(p=path, r=ref))
+
+    changed = []  # the top-level attributes which have changed
+    for attribute, value in item.items():
+        if attribute in key_names or loaded.get(attribute) == value:
+            continue
+        old_value = loaded.get(attribute)
+        if attribute == 'data' and isinstance(old_value, dict) and \
+                isinstance(value, dict):
+            # Only set the data sub-branches (e.g. data.scrape1) which changed.
+            changed_branches = [
+                branch for branch, branch_value in value.items()
+                if without_fields(old_value.get(branch), volatile_fields) !=
+                without_fields(branch_value, volatile_fields)
+            ]
+            removed_branches = [branch for branch in old_value
+                                if branch not in value]
+            if not changed_branches and not removed_branches:
+                continue
+            changed.append(attribute)
+            data_ref = name_ref('data')
+            for branch in changed_branches:
+                set_value('{d}.{b}'.format(d=data_ref, b=name_ref(branch)),
+                          value[branch])
+            for branch in removed_branches:
+                remove_parts.append('{d}.{b}'.format(d=data_ref,
+                                                     b=name_ref(branch)))
+        else:
+            changed.append(attribute)
+            set_value(name_ref(attribute), value)
+    for attribute in loaded:
+        if attribute not in item:
+            changed.append(attribute)
+            remove_parts.append(name_ref(attribute))
+
+    if all(attribute in volatile for attribute in changed):
+        return None
+    expression = ''
+    if set_parts:
+        expression += 'SET ' + ', '.join(set_parts)
+    if remove_parts:
+        expression += ' REMOVE ' + ', '.join(remove_parts)
+    update = {
+        'UpdateExpression': expression.strip(),
+        'ExpressionAttributeNames': names
+    }
+    if values:
+        update['ExpressionAttributeValues'] = values
+    return update
@@ -1,23 +1,269 @@
 """
 Error handling.
+
+handle_error reports an error to the process-wide ErrorReporter, which:
+    - counts it under its kind: the host and directive it happened for (see
+      error_context), its exception type and message, and the function which
+      called handle_error
+    - writes the first few errors of each kind as lines of JSON to the
+      run's error log, and then only counts them
+    - prints the first error of each kind, and no more than a few errors per
+      second overall
+so that a mass outage (e.g. dozens of sites failing in the same way) isn't
+slowed down further by its own error reporting. At the end of a run,
+report_errors writes a summary line per kind, with its total count.
+The caller is found with sys._getframe, which (unlike inspect.stack) doesn't
+build frame records or read source files for every frame.
 """
-import inspect
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from config import get_setting
+
+# Default settings. These can be overridden in app_config.json with an
+# "error_reporting" key, e.g. {"error_reporting": {"console_per_second": 1}}.
+#   - file: the JSON lines error log (None to not write one)
+#   - records_per_error: errors of each kind written to file
+#   - console_per_error: errors of each kind printed
+#   - console_per_second, console_burst: the overall rate of printed errors
+DEFAULT_SETTINGS = {
+    'file': '../metrics/errors.jsonl',
+    'records_per_error': 5,
+    'console_per_error': 1,
+    'console_per_second': 5,
+    'console_burst': 20
+}
+MAX_STACK_DEPTH = 50
+MAX_TRACEBACK_LINES = 20
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def error_context(host=None, directive=None):
+    """
+    Tag the errors handled within a block (in this thread) with the host and
+    directive being worked on:
+        with error_context(host='recurse.com', directive='scrape1'):
+            ...
+    :param host: the host being requested
+    :param directive: the name of the directive being followed
+    :return: a context manager
+    """
+    previous = getattr(_context, 'tags', (None, None))
+    _context.tags = (host, directive)
+    try:
+        yield
+    finally:
+        _context.tags = previous
+
+
+def caller_info(depth):
+    """
+    Describe the call stack, without inspect.stack's frame records.
+    :param depth: how many frames above this function's caller to start at
+    :return: a tuple of (calling function's name, stack str like
+    "outer:12/inner:34/", outermost first)
+    """
+    frame = sys._getframe(depth + 1)
+    caller = frame.f_code.co_name
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append('{f}:{l}'.format(f=frame.f_code.co_name,
+                                       l=frame.f_lineno))
+        frame = frame.f_back
+    return caller, '/'.join(reversed(frames)) + '/'
+
+
+class ErrorReporter(object):
+    """
+    Counts, logs and prints the errors of a run (see the module docstring).
+    """
+    def __init__(self, settings=None):
+        """
+        Initialize the ErrorReporter.
+        :param settings: a dict like DEFAULT_SETTINGS; defaults to
+        DEFAULT_SETTINGS updated by the "error_reporting" setting in
+        app_config.json
+        """
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings if settings is not None
+                             else get_setting('error_reporting', {}))
+        self.kinds = {}  # kind (tuple): summary dict
+        self.suppressed = 0  # errors not printed since the last print
+        self._tokens = self.settings['console_burst']
+        self._refilled = time.monotonic()
+        self._file = None
+        self._lock = threading.Lock()
 
+    def _take_token(self):
+        """
+        Take one print from the overall console rate limit.
+        :return: True if an error can be printed now
+        """
+        now = time.monotonic()
+        self._tokens = min(
+            self.settings['console_burst'],
+            self._tokens + (now - self._refilled) *
+            self.settings['console_per_second']
+        )
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
 
-def handle_error(exc=Exception, err='UNKNOWN', msg='none'):
+    def _write(self, record):
+        filename = self.settings['file']
+        if not filename:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+            self._file = open(filename, 'a')
+        self._file.write(json.dumps(record, default=str) + '\n')
+        self._file.flush()
+
+    def report(self, exc, err, msg, caller, stack, host=None,
+               directive=None):
+        """
+        Count an error, and write and print it if its kind's limits allow.
+        :param exc: the exception type (or a str naming it)
+        :param err: the error (an exception or a str)
+        :param msg: an additional message
+        :param caller: the name of the function which handled the error
+        :param stack: the call stack, as returned by caller_info
+        :param host: the host it happened for, if any
+        :param directive: the directive it happened for, if any
+        :return: the number of errors of this kind so far
+        """
+        exc_name = getattr(exc, '__name__', str(exc))
+        kind = (host, directive, exc_name, str(err), str(msg), caller)
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        with self._lock:
+            summary = self.kinds.get(kind)
+            if summary is None:
+                summary = self.kinds[kind] = {
+                    'host': host,
+                    'directive': directive,
+                    'exception': exc_name,
+                    'error': str(err),
+                    'msg': str(msg),
+                    'caller': caller,
+                    'count': 0,
+                    'first_seen': now
+                }
+            summary['count'] += 1
+            summary['last_seen'] = now
+            count = summary['count']
+            if count <= self.settings['records_per_error']:
+                record = dict(summary, type='error', stack=stack)
+                tb = getattr(err, '__traceback__', None)
+                if tb is not None:
+                    record['traceback'] = traceback.format_tb(
+                        tb, limit=MAX_TRACEBACK_LINES
+                    )
+                self._write(record)
+            printing = count <= self.settings['console_per_error'] and \
+                self._take_token()
+            if not printing:
+                self.suppressed += 1
+                return count
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            print('({n} more errors not printed; see {f})'.format(
+                n=suppressed, f=self.settings['file']))
+        print('caller: ', caller)
+        print('stack trace:', stack)
+        print('exception:', exc, 'error:', err, 'msg:', msg)
+        if host or directive:
+            print('host:', host, 'directive:', directive)
+        return count
+
+    def summary(self):
+        """
+        :return: a list of each kind of error's summary (dict), the most
+        frequent first
+        """
+        with self._lock:
+            summaries = [dict(summary) for summary in self.kinds.values()]
+        return sorted(summaries, key=lambda summary: -summary['count'])
+
+    def close(self):
+        """
+        Write a summary line per kind of error, print the most frequent
+        kinds, and close the error log.
+        :return: the error log's filename, or None if nothing was written
+        """
+        summaries = self.summary()
+        with self._lock:
+            for summary in summaries:
+                self._write(dict(summary, type='summary'))
+            written = self._file is not None
+            if written:
+                self._file.close()
+                self._file = None
+        if summaries:
+            print('errors: {t} in {k} kinds'.format(
+                t=sum(summary['count'] for summary in summaries),
+                k=len(summaries)))
+            for summary in summaries[:10]:
+                print('  {c:>6}  {h} {d} {e}: {m}'.format(
+                    c=summary['count'], h=summary['host'] or '-',
+                    d=summary['directive'] or '-', e=summary['exception'],
+                    m=summary['error'][:100]))
+        return self.settings['file'] if written else None
+
+
+_reporter = None
+_reporter_lock = threading.Lock()
+
+
+def get_reporter():
+    """
+    Return the process-wide ErrorReporter, creating it if needed.
+    :return: an ErrorReporter object shared by all threads
     """
-    Function to handle errors by printing them.
-    Will eventually expand to local and/or console and/or Dynamo logging.
+    global _reporter
+    with _reporter_lock:
+        if _reporter is None:
+            _reporter = ErrorReporter()
+        return _reporter
+
+
+def handle_error(exc=Exception, err='UNKNOWN', msg='none', host=None,
+                 directive=None):
+    """
+    Function to handle errors by reporting them (see ErrorReporter).
     :param exc: the exception type
     :param err: the error returned
     :param msg: an optional additional message to help with debugging
+    :param host: the host the error happened for; defaults to the host of
+    the enclosing error_context, if any
+    :param directive: the directive the error happened for; defaults to the
+    directive of the enclosing error_context, if any
     :return: doesn't return anything
     """
-    call_stack = inspect.stack()
-    calling_function = call_stack[1][3]
-    stack_str = ''
-    for item in reversed(call_stack[1:]):
-        stack_str += '{f}:{l}/'.format(f=item[3], l=item[2])
-    print('caller: ', calling_function)
-    print('stack trace:', stack_str)
-    print('exception:', exc, 'error:', err, 'msg:', msg)
+    caller, stack = caller_info(1)
+    context_host, context_directive = getattr(_context, 'tags', (None, None))
+    get_reporter().report(
+        exc=exc,
+        err=err,
+        msg=msg,
+        caller=caller,
+        stack=stack,
+        host=host or context_host,
+        directive=directive or context_directive
+    )
+
+
+def report_errors():
+    """
+    Finish the run's error reporting: write and print its summary.
+    :return: the error log's filename, or None if there were no errors
+    """
+    return get_reporter().close()
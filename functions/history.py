@@ -0,0 +1,260 @@
+"""
+A time-series history of every value retrieved for every site.
+
+Site items in the 'sites' table only keep the latest snapshot of each value
+inline (see data_functions.unpack_and_save_list), so that they stay small no
+matter how much history there is. Every snapshot is also written to a
+separate history table, one small item per value, laid out like this:
+    - partition key 'series': "<site key>#<directive>#<data_name>", e.g.
+      "Recurse Center#twitter1#tweets"
+    - sort key 'accessed': the snapshot's accessed timestamp (ISO 8601, so
+      that it sorts in time order)
+    - the rest of the snapshot: data_name, duration, payload and status
+A trend query (e.g. 30 days of one site's tweets) is therefore a single
+Query on one partition with a range condition on 'accessed', which reads
+only the items that it returns.
+
+Before the first run which writes to it, create the history table and copy
+into it the history still held inline in the site items:
+    python history.py
+Only after that is it safe to lower the "inline_history" setting, since the
+values trimmed from the site items are then already in the history table.
+"""
+import datetime
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from config import get_setting
+from data_functions import LATEST_ONLY_DATA_NAMES
+from dynamodb import Dynamo
+from error_handling import handle_error
+
+DEFAULT_TABLE_NAME = 'site_history'
+SERIES_SEPARATOR = '#'
+ACCESSED_FORMAT = '%Y-%m-%dT%H:%M:%S'  # as written by make_dict
+
+
+def series_key(site_key, directive, data_name):
+    """
+    Make the partition key of one site's values for one directive/data_name.
+    :param site_key: the site's key (see History.site_key)
+    :param directive: the directive's name, e.g. 'twitter1'
+    :param data_name: the value's data_name, e.g. 'tweets'
+    :return: a str
+    """
+    return SERIES_SEPARATOR.join([site_key, directive, data_name])
+
+
+def format_accessed(value):
+    """
+    Format a query bound the same way as make_dict's 'accessed' timestamps.
+    :param value: a datetime object (in UTC) or an already-formatted str
+    :return: a str
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime(ACCESSED_FORMAT)
+    return value
+
+
+class History(object):
+    """
+    Class for the time-series history table.
+    """
+    def __init__(self, dynamo_session, table_name=None, sites_table='sites'):
+        """
+        Initialize the History object.
+        :param dynamo_session: a Dynamo object (see dynamodb.py)
+        :param table_name: the name of the history table; defaults to the
+        "history_table" setting in app_config.json, or 'site_history'
+        :param sites_table: the name of the sites table, whose key
+        attributes identify each site's series
+        """
+        if table_name is None:
+            table_name = get_setting('history_table', DEFAULT_TABLE_NAME)
+        self.dynamo = dynamo_session
+        self.table_name = table_name
+        self.table = dynamo_session.dynamodb.Table(table_name)
+        self.sites_table = sites_table
+        self._key_names = None
+
+    @property
+    def key_names(self):
+        """
+        :return: the names of the sites table's key attributes
+        """
+        if self._key_names is None:
+            table = self.dynamo.dynamodb.Table(self.sites_table)
+            self._key_names = [key['AttributeName']
+                               for key in table.key_schema]
+        return self._key_names
+
+    def site_key(self, site):
+        """
+        Make the key which identifies a site within the history table.
+        :param site: a Site object, or a site as a dict
+        :return: the site's key attribute values, joined with '|'
+        """
+        if isinstance(site, dict):
+            values = [site[name] for name in self.key_names]
+        else:
+            values = [getattr(site, name) for name in self.key_names]
+        return '|'.join(str(value) for value in values)
+
+    def create_table(self):
+        """
+        Create the history table, billed per request, and wait until it's
+        ready to use.
+        :return: True if succeeded (or the table already exists), False if
+        failed
+        """
+        try:
+            table = self.dynamo.dynamodb.create_table(
+                TableName=self.table_name,
+                KeySchema=[
+                    {'AttributeName': 'series', 'KeyType': 'HASH'},
+                    {'AttributeName': 'accessed', 'KeyType': 'RANGE'}
+                ],
+                AttributeDefinitions=[
+                    {'AttributeName': 'series', 'AttributeType': 'S'},
+                    {'AttributeName': 'accessed', 'AttributeType': 'S'}
+                ],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            table.wait_until_exists()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceInUseException':
+                return True  # the table already exists
+            handle_error(
+                exc=ClientError,
+                err=e,
+                msg='could not create table "{t}"'.format(t=self.table_name)
+            )
+            return False
+        return True
+
+    def save_records(self, site_key, records):
+        """
+        Write snapshots of one site's values to the history table.
+        :param site_key: the site's key (see site_key)
+        :param records: an iterable of (directive, dict) tuples, where each
+        dict is as made by make_dict
+        :return: the number of items written, or None if failed
+        """
+        written = 0
+        try:
+            with self.table.batch_writer(
+                    overwrite_by_pkeys=['series', 'accessed']) as batch:
+                for directive, record in records:
+                    if record['data_name'] in LATEST_ONLY_DATA_NAMES:
+                        continue  # state, rather than a value to trend
+                    item = dict(record)
+                    item['series'] = series_key(
+                        site_key, directive, record['data_name']
+                    )
+                    batch.put_item(Item=item)
+                    written += 1
+        except ClientError as e:
+            handle_error(
+                exc=ClientError,
+                err=e,
+                msg='could not write history for "{s}"'.format(s=site_key)
+            )
+            return None
+        return written
+
+    def save_sites(self, sites):
+        """
+        Write the snapshots retrieved by each Site during this run (its
+        new_records) to the history table.
+        :param sites: a list of Site objects
+        :return: the number of items written
+        """
+        written = 0
+        for site in sites:
+            records = getattr(site, 'new_records', None)
+            if records:
+                written += self.save_records(self.site_key(site),
+                                             records) or 0
+        return written
+
+    def backfill(self, items):
+        """
+        Copy the history still held inline in site items (from before the
+        history table was used) into the history table. Snapshots already in
+        the table are overwritten with the same values, so it's safe to run
+        again.
+        :param items: sites as dicts, as retrieved from DynamoDB
+        :return: the number of items written
+        """
+        written = 0
+        for item in items:
+            records = [
+                (directive, record)
+                for directive, branch in item.get('data', {}).items()
+                for records in branch.values()
+                for record in records
+            ]
+            written += self.save_records(self.site_key(item), records) or 0
+        return written
+
+    def query(self, site_key, directive, data_name, start=None, end=None,
+              limit=None, newest_first=True):
+        """
+        Retrieve one site's snapshots of a value within a time range.
+        :param site_key: the site's key (see site_key)
+        :param directive: the directive's name, e.g. 'twitter1'
+        :param data_name: the value's data_name, e.g. 'tweets'
+        :param start: the earliest 'accessed' to include (datetime or str)
+        :param end: the latest 'accessed' to include (datetime or str)
+        :param limit: the maximum number of snapshots to return
+        :param newest_first: if True, return the newest snapshots first
+        :return: a list of dicts (as made by make_dict), or None if failed
+        """
+        condition = Key('series').eq(
+            series_key(site_key, directive, data_name)
+        )
+        start = format_accessed(start)
+        end = format_accessed(end)
+        if start is not None and end is not None:
+            condition &= Key('accessed').between(start, end)
+        elif start is not None:
+            condition &= Key('accessed').gte(start)
+        elif end is not None:
+            condition &= Key('accessed').lte(end)
+        query_kwargs = {
+            'KeyConditionExpression': condition,
+            'ScanIndexForward': not newest_first
+        }
+
+        records = []
+        try:
+            while True:
+                if limit is not None:
+                    query_kwargs['Limit'] = limit - len(records)
+                response = self.table.query(**query_kwargs)
+                records.extend(response['Items'])
+                if 'LastEvaluatedKey' not in response or \
+                        (limit is not None and len(records) >= limit):
+                    break
+                query_kwargs['ExclusiveStartKey'] = \
+                    response['LastEvaluatedKey']
+        except ClientError as e:
+            handle_error(
+                exc=ClientError,
+                err=e,
+                msg='could not query table "{t}"'.format(t=self.table_name)
+            )
+            return None
+        for record in records:
+            del record['series']
+        return records
+
+
+if __name__ == '__main__':
+    dynamo = Dynamo(
+        profile_name='top-sites'
+    )
+    history = History(dynamo)
+    if history.create_table():
+        items = dynamo.get_all_rows(table_name='sites')
+        if items is not None:
+            print('history items backfilled:', history.backfill(items))
@@ -1,32 +1,95 @@
 """
 Functions to retrieve and parse the HTML from a url.
 """
-from bs4 import BeautifulSoup
+import hashlib
 from html import escape
-import requests
+import json
 import requests.exceptions as requests_exc
 from traceback import format_exception
-from data_functions import make_dict
+from urllib.parse import urlparse
+from config import get_setting
+from data_functions import latest_payload, make_dict
+from directive_matcher import get_matcher
+from html_stream import stream_parse_response
+from http_client import get_session
+from metrics import get_metrics
+from rate_limit import get_limiter
+from tracing import span
 
 
-def scrape_newest(url, params, test_mode, start_time):
+def scrape_newest(url, params, test_mode, start_time, previous=None):
     """
     Scrape the newest blog post (as specified by params) from url.
-    :param url: 
-    :param params:
-    :param test_mode: 
-    :param start_time:
-    :return: 
+    When previous holds the ETag and/or Last-Modified validators from the
+    last successful scrape, they're sent as If-None-Match/If-Modified-Since.
+    If the server answers 304 Not Modified, the previous a_link_text and
+    a_link_url are reused without downloading or parsing the page again.
+    Otherwise, if the downloaded page's digest matches content_digest from
+    the last scrape, the previous results are also reused without parsing,
+    and are saved with the status 'unchanged'. (In 'stream' mode, the digest
+    is of the bytes read up to the target element, which has already been
+    parsed by then; its results are the same as the previous ones.)
+    :param url: the Site's url dict (see url_functions.tidy_url)
+    :param params: the directive's parameters (see parse_site)
+    :param test_mode: if True, use the locally cached copy of the HTML
+    :param start_time: the UTC time (as a datetime object) at which
+    scraping began, to calculate duration.
+    :param previous: the directive's existing data branch from the Site
+    (e.g. site.data['scrape1']), or None
+    :return: a list of dicts: a_link_text, a_link_url, etag, last_modified,
+    content_digest
     """
     print('starting scrape_newest')
     error = 'ok'
+    a_link_text = None
+    a_link_url = None
+    etag = None
+    last_modified = None
+    raw_html = None
+    soup = None
+    content_digest = None
+    # In 'stream' mode the page is parsed while it downloads, and the
+    # download stops as soon as the target element has been found.
+    stream = get_setting('scrape_mode', 'tree') == 'stream'
     if not test_mode:
-        # When not in testing mode, get the HTML of url.
+        # When not in testing mode, get the HTML of url, unless it hasn't
+        # been modified since the last successful scrape.
+        validators = {
+            'If-None-Match': latest_payload(previous, 'etag'),
+            'If-Modified-Since': latest_payload(previous, 'last_modified')
+        }
+        headers = {
+            header: value for header, value in validators.items()
+            if value is not None
+        }
+        # Only scrape conditionally if there's a previous result to reuse.
+        if latest_payload(previous, 'a_link_url') is None:
+            headers = {}
         try:
-            raw_html = request_site(url['full_url']).content
+            response = request_site(
+                url['full_url'],
+                headers=headers,
+                allowed_statuses=(200, 304) if headers else (200,),
+                stream=stream
+            )
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if response.status_code == 304:
+                error = 'not modified'
+                a_link_text = latest_payload(previous, 'a_link_text')
+                a_link_url = latest_payload(previous, 'a_link_url')
+                etag = etag or validators['If-None-Match']
+                last_modified = (last_modified or
+                                 validators['If-Modified-Since'])
+                response.close()
+            elif stream:
+                digest = new_digest(params)
+                soup = stream_parse_response(response, params, digest=digest)
+                content_digest = digest.hexdigest()
+            else:
+                raw_html = response.content
         except ValueError as e:
             error = e
-            raw_html = None
     else:
         # When in testing mode, avoid repeated requests to url.
         # Instead, get the HTML str from locally cached file if it exists.
@@ -43,32 +106,42 @@ def scrape_newest(url, params, test_mode, start_time):
                     raw_html = read_site_from_file(url['filename'])
             except ValueError as e:
                 error = e
-                raw_html = None
 
     if raw_html is not None:
+        content_digest = page_digest(raw_html, params)
+    elif error == 'not modified':
+        content_digest = latest_payload(previous, 'content_digest')
+    if (raw_html is not None or soup is not None) and \
+            content_digest == latest_payload(previous, 'content_digest') and \
+            latest_payload(previous, 'a_link_url') is not None:
+        # If the page (and params) are byte-identical to the last successful
+        # scrape, carry forward the previous result instead of parsing again.
+        error = 'unchanged'
+        a_link_text = latest_payload(previous, 'a_link_text')
+        a_link_url = latest_payload(previous, 'a_link_url')
+        raw_html = None
+        soup = None
+
+    if raw_html is not None or soup is not None:
         # parse HTML find target element
         try:
-            soup = parse_site(raw_html, params)
-        except ValueError as e:
+            if soup is None:
+                soup = parse_site(raw_html, params)
+            a_link_text = escape(soup.text, quote=True)
+            a_link_url = make_absolute(
+                url_to_check=soup['href'],
+                site_url=url
+            )
+        except (ValueError, KeyError) as e:
             error = e
             a_link_text = None
             a_link_url = None
 
-        a_link_text = soup.text
-        a_link_url = soup['href']
-        a_link_url = make_absolute(
-            url_to_check=a_link_url,
-            site_url=url
-        )
-    else:
-        a_link_text = None
-        a_link_url = None
-
     if isinstance(error, Exception):
         error = format_exception(ValueError, error, error.__traceback__)
 
     a_link_text = make_dict(
-        value=escape(a_link_text, quote=True),
+        value=a_link_text,
         data_name='a_link_text',
         start_time=start_time,
         status=error
@@ -81,31 +154,89 @@ def scrape_newest(url, params, test_mode, start_time):
         status=error
     )
 
-    return [a_link_text, a_link_url]
+    # Save the validators so that the next scrape can be conditional.
+    etag = make_dict(
+        value=etag,
+        data_name='etag',
+        start_time=start_time,
+        status=error
+    )
+
+    last_modified = make_dict(
+        value=last_modified,
+        data_name='last_modified',
+        start_time=start_time,
+        status=error
+    )
+
+    content_digest = make_dict(
+        value=content_digest,
+        data_name='content_digest',
+        start_time=start_time,
+        status=error
+    )
+
+    return [a_link_text, a_link_url, etag, last_modified, content_digest]
+
+
+def page_digest(raw_html, params):
+    """
+    Computes a fast digest of a page's HTML and the params used to parse it.
+    :param raw_html: the page's HTML (bytes or str)
+    :param params: the directive's parameters
+    :return: the digest as a hex str
+    """
+    if isinstance(raw_html, str):
+        raw_html = raw_html.encode('utf-8')
+    digest = new_digest(params)
+    digest.update(raw_html)
+    return digest.hexdigest()
 
 
-def request_site(url):
+def new_digest(params):
     """
-    Uses requests package to get HTML from url.
+    Starts a page digest (see page_digest), to be updated with the page's
+    bytes, e.g. chunk by chunk as they stream.
+    :param params: the directive's parameters
+    :return: a hashlib.blake2b object
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(params).encode('utf-8'))
+    return digest
+
+
+def request_site(url, headers=None, allowed_statuses=(200,), stream=False):
+    """
+    Uses the shared, pooled requests session to get HTML from url.
     :param url: the url to request
-    :return: None if error; raw HTML as a byte string if no error.
+    :param headers: optional dict of extra request headers
+    :param allowed_statuses: the status codes which aren't errors
+    :param stream: if True, don't download the body until it's read (see
+    html_stream.stream_parse_response)
+    :return: the requests.Response object if no error; raises ValueError
+    if there was an error.
     """
     try:
-        response = requests.get(url)
-    except (requests_exc.BaseHTTPError, requests_exc.ConnectionError) as e:
+        with get_limiter('scrape_newest'):
+            response = get_session().get(url, headers=headers,
+                                         stream=stream)
+    except (requests_exc.BaseHTTPError, requests_exc.RequestException) as e:
         raise ValueError('requests package raised an exception when trying '
                          'to get {u}. Message received: {e}'.format(
                             u=url,
                             e=e
                             )
                         )
-    if response.status_code != 200:
+    if response.status_code not in allowed_statuses:
+        response.close()
         raise ValueError('requests package received status code {s} when '
                          'trying to get {u}.'.format(
                             s=response.status_code,
                             u=url
                             )
                         )
+    if not stream:
+        get_metrics().add_bytes(urlparse(url).hostname, len(response.content))
     return response
 
 
@@ -135,24 +266,19 @@ def save_site_to_file(filename, url):
         return True
 
 
-def parse_site(raw_html, params):
+def parse_site(raw_html, params, backend=None):
     """
     Parses HTML str to find target element specified in self.directives.
-    :return: a BeautifulSoup object of the target element.
+    The params are compiled once into a DirectiveMatcher (see
+    directive_matcher.py) and reused for every page with the same params.
+    :param raw_html: the page's HTML (bytes or str)
+    :param params: the directive's parameters
+    :param backend: the parser backend, 'html.parser' or 'lxml'; defaults to
+    the "parser_backend" setting in app_config.json
+    :return: the target element (which has .text and ['attribute']).
     """
-    soup = BeautifulSoup(raw_html, 'html.parser')
-
-    for param in params:
-        if isinstance(param, list):
-            soup = soup.find(attrs={param[0]: param[1]})
-        else:
-            soup = soup.find(param)
-    if soup is None:
-        raise ValueError("BeautifulSoup couldn't find params {p}".format(
-                            p=params
-        ))
-
-    return soup
+    with span('parse_site'):
+        return get_matcher(params).match(raw_html, backend=backend)
 
 
 def make_absolute(url_to_check, site_url):
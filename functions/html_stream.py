@@ -0,0 +1,183 @@
+"""
+Streaming, early-terminating extraction of a scrape directive's target.
+
+parse_site (in html_parse.py) waits for the whole page and builds a complete
+BeautifulSoup tree, only to walk a few find calls down to the first matching
+element. Instead, the functions here feed the response to an incremental
+parser as it downloads, and stop downloading and parsing as soon as the
+directive's target element has been found and closed.
+
+The directive is matched with the same semantics as parse_site: each item of
+params finds the first matching descendant within the element matched by the
+previous item.
+"""
+import codecs
+from html.parser import HTMLParser
+import re
+from urllib.parse import urlparse
+import requests.exceptions as requests_exc
+from config import get_setting
+from directive_matcher import (NON_TEXT_ELEMENTS, MatchedElement,
+                               get_matcher)
+from metrics import get_metrics
+
+# Elements which never have content (and so are never closed).
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr'
+}
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024  # stop reading pages after 2 MiB
+DEFAULT_CHUNK_SIZE = 16 * 1024
+
+
+class DirectiveStreamParser(HTMLParser):
+    """
+    An incremental HTML parser which follows a directive's params and stops
+    as soon as the target element is complete (or can no longer be found).
+    Feed it with feed(); once done is True, there's no need to feed more.
+    """
+    def __init__(self, params):
+        super().__init__(convert_charrefs=True)
+        self.params = params
+        self.steps = get_matcher(params).steps
+        self.done = False
+        self.result = None
+        self._stack = []  # tag names of currently open elements
+        self._step = 0  # index of the item of params being looked for
+        self._scope_depth = 0  # depth of the element matched by last step
+        self._target = None  # (tag, attrs, depth) once the target is found
+        self._text = []
+        self._skip_text_depth = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = {name: (value if value is not None else '')
+                 for name, value in attrs}
+        is_void = tag in VOID_ELEMENTS
+        if not is_void:
+            self._stack.append(tag)
+        if self._target is not None:
+            if tag in NON_TEXT_ELEMENTS and self._skip_text_depth is None \
+                    and not is_void:
+                self._skip_text_depth = len(self._stack)
+            return
+        if self.steps[self._step].matches(tag, attrs):
+            self._step += 1
+            depth = len(self._stack) + (1 if is_void else 0)
+            if self._step == len(self.steps):
+                self._target = (tag, attrs, depth)
+                if is_void:
+                    self._finish()
+            elif is_void:
+                # A void element has no descendants to search within.
+                self._fail()
+            else:
+                self._scope_depth = depth
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.done or tag not in self._stack:
+            return
+        # Close the most recently opened element with this tag name (and any
+        # elements left open within it).
+        while self._stack:
+            if self._stack.pop() == tag:
+                break
+        depth = len(self._stack)
+        if self._skip_text_depth is not None and \
+                depth < self._skip_text_depth:
+            self._skip_text_depth = None
+        if self._target is not None:
+            if depth < self._target[2]:
+                self._finish()
+        elif depth < self._scope_depth:
+            # The element matched by the previous step has closed without
+            # containing the next step's match.
+            self._fail()
+
+    def handle_data(self, data):
+        if self._target is not None and not self.done and \
+                self._skip_text_depth is None:
+            self._text.append(data)
+
+    def _finish(self):
+        tag, attrs, depth = self._target
+        self.result = MatchedElement(tag, attrs, ''.join(self._text))
+        self.done = True
+
+    def _fail(self):
+        self.done = True
+
+
+def response_encoding(response):
+    """
+    Determine a response's character encoding from its Content-Type header.
+    :param response: a requests.Response object
+    :return: the charset given by the server, or 'utf-8'
+    """
+    content_type = response.headers.get('Content-Type', '')
+    match = re.search(r'charset=["\']?([\w-]+)', content_type, re.I)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def stream_parse_response(response, params, max_bytes=None, chunk_size=None,
+                          digest=None):
+    """
+    Parse a streamed response until the directive's target is found.
+    :param response: a requests.Response object, requested with stream=True
+    :param params: the directive's parameters (see html_parse.parse_site)
+    :param max_bytes: the maximum number of bytes to read from the page;
+    defaults to the "scrape_max_bytes" setting in app_config.json
+    :param chunk_size: the number of bytes to read at a time
+    :param digest: an optional hashlib object, updated with each chunk read
+    (see html_parse.new_digest)
+    :return: a MatchedElement of the target element; raises ValueError if
+    it wasn't found, or if the download failed part way (e.g. timed out)
+    """
+    if max_bytes is None:
+        max_bytes = get_setting('scrape_max_bytes', DEFAULT_MAX_BYTES)
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    decoder = codecs.getincrementaldecoder(response_encoding(response))(
+        errors='replace'
+    )
+    parser = DirectiveStreamParser(params)
+    bytes_read = 0
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            bytes_read += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.done or bytes_read >= max_bytes:
+                break
+        else:
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+    except requests_exc.RequestException as e:
+        raise ValueError('requests package raised an exception while '
+                         'reading {u}. Message received: {e}'.format(
+                            u=response.url,
+                            e=e
+                            )
+                        )
+    finally:
+        # Closing the response before it's fully read stops the download.
+        response.close()
+        get_metrics().add_bytes(urlparse(response.url).hostname, bytes_read)
+
+    if parser.result is None:
+        raise ValueError("couldn't find params {p} within the first {b} "
+                         "bytes".format(p=params, b=bytes_read))
+    return parser.result
@@ -0,0 +1,96 @@
+"""
+A shared HTTP client for scraping sites and calling apis.
+
+Calling the module-level requests.get opens a new TCP connection (and TLS
+handshake) for every request. Instead, all of top_sites' requests go through
+one requests.Session whose adapters keep per-host pools of keep-alive
+connections. The Session is created once and shared by all threads of a
+concurrent run (urllib3's connection pools are thread-safe). When the
+"cassettes" setting turns them on, its adapters record and replay responses
+(see cassettes.py).
+
+Every request through the Session has a (connect, read) timeout, unless the
+caller gives its own, so that a host which stops answering can't hold one of
+the run's workers (and a pooled connection) for as long as it hangs.
+"""
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from cassettes import make_adapter
+from config import get_setting
+
+# Default pool sizes. These can be overridden in app_config.json with an
+# "http_pool" key, e.g. {"http_pool": {"pool_maxsize": 32}}.
+#   - pool_connections: the number of per-host pools to keep
+#   - pool_maxsize: the number of connections to keep open per host
+#   - max_retries: how many times to retry failed connections
+DEFAULT_POOL = {
+    'pool_connections': 100,
+    'pool_maxsize': 16,
+    'max_retries': 0
+}
+# The default (connect, read) timeout in seconds, which can be overridden in
+# app_config.json with an "http_timeout" key, e.g. {"http_timeout": [5, 60]}.
+DEFAULT_TIMEOUT = (5, 30)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests.Session which gives every request a default timeout.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Initialize the TimeoutSession.
+        :param timeout: the (connect, read) timeout in seconds for requests
+        which don't set their own
+        """
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def make_session(pool_connections, pool_maxsize, max_retries,
+                 timeout=DEFAULT_TIMEOUT):
+    """
+    Create a requests.Session with pooled, keep-alive connections.
+    :param pool_connections: the number of per-host pools to keep
+    :param pool_maxsize: the number of connections to keep open per host
+    :param max_retries: how many times to retry failed connections
+    :param timeout: the default (connect, read) timeout in seconds
+    :return: a TimeoutSession object
+    """
+    session = TimeoutSession(timeout=timeout)
+    pool_kwargs = {
+        'pool_connections': pool_connections,
+        'pool_maxsize': pool_maxsize,
+        'max_retries': max_retries,
+        'pool_block': False
+    }
+    adapter = make_adapter(pool_kwargs) or HTTPAdapter(**pool_kwargs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the process-wide requests.Session, creating it if needed.
+    :return: a requests.Session object shared by all threads
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool = dict(DEFAULT_POOL)
+            pool.update(get_setting('http_pool', {}))
+            _session = make_session(
+                timeout=tuple(get_setting('http_timeout', DEFAULT_TIMEOUT)),
+                **pool
+            )
+        return _session
@@ -0,0 +1,320 @@
+"""
+Per-run metrics of directive latency and outcomes.
+
+Every directive's values already carry a duration and status (see
+make_dict), but only inside the sites' DynamoDB items. During a run, the
+process-wide RunMetrics collects:
+    - latency histograms per directive type and per host
+    - outcome counts (ok/unchanged/not modified/ok (cached)/error) per
+      directive type and per host
+    - bytes fetched per host
+    - seconds spent sleeping for rate limits, per api
+    - any gauges set by the caller (e.g. the pipeline's counts)
+At the end of the run, write_metrics saves them in the Prometheus textfile
+format (for node_exporter's textfile collector) and appends them as one line
+of JSON to a file of runs, to compare runs and track regressions.
+"""
+import datetime
+from decimal import Decimal
+import json
+import os
+import threading
+from config import get_setting
+
+PREFIX = 'top_sites_'
+# Upper bounds (in seconds) of the latency histograms' buckets.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DEFAULT_FILES = {
+    'prometheus': '../metrics/top_sites.prom',
+    'json': '../metrics/runs.jsonl'
+}
+# The hosts of the apis, for directive types which don't scrape a site. moz.py
+# adds the Moz api's host, from the url it calls (moz.URL), since moz.py
+# imports this module.
+API_HOSTS = {
+    'twitter': 'api.twitter.com'
+}
+# Statuses (see make_dict) which are reported as they are; any other status
+# (e.g. a traceback) is reported as 'error'.
+OUTCOMES = ('ok', 'unchanged', 'not modified', 'ok (cached)')
+
+
+class Histogram(object):
+    """
+    A cumulative histogram of observed values, as Prometheus has them.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # not cumulative; see cumulative()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        :return: a list of (upper bound, count of values <= bound) tuples,
+        ending with ('+Inf', count)
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        result.append(('+Inf', self.count))
+        return result
+
+
+def outcome(status):
+    """
+    :param status: a status as saved by make_dict
+    :return: the status if it's one of OUTCOMES, otherwise 'error'
+    """
+    return status if status in OUTCOMES else 'error'
+
+
+class RunMetrics(object):
+    """
+    The metrics of one run, collected from many threads.
+    """
+    def __init__(self, per_host=True):
+        """
+        Initialize the RunMetrics.
+        :param per_host: if False, skip the per-host series (which there is
+        one of per site)
+        """
+        self.per_host = per_host
+        self.started = datetime.datetime.utcnow()
+        self.latency = {}  # (label name, label value): Histogram
+        self.outcomes = {}  # (label name, label value, outcome): count
+        self.bytes_fetched = {}  # host: bytes
+        self.sleep_seconds = {}  # api: seconds
+        self.gauges = {}  # name: value
+        self._lock = threading.Lock()
+
+    def observe_directive(self, d_type, host, duration, status):
+        """
+        Record one directive's latency and outcome.
+        :param d_type: the directive's type, e.g. 'moz'
+        :param host: the host the directive's data came from
+        :param duration: the directive's duration in seconds
+        :param status: its status, as saved by make_dict
+        :return: doesn't return anything
+        """
+        labels = [('type', d_type)]
+        if self.per_host and host:
+            labels.append(('host', host))
+        with self._lock:
+            for label in labels:
+                if label not in self.latency:
+                    self.latency[label] = Histogram()
+                self.latency[label].observe(float(duration))
+                key = label + (outcome(status),)
+                self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def add_bytes(self, host, count):
+        """
+        Record bytes fetched from a host.
+        :param host: the host name
+        :param count: the number of bytes
+        :return: doesn't return anything
+        """
+        host = host or 'unknown'
+        with self._lock:
+            self.bytes_fetched[host] = self.bytes_fetched.get(host, 0) + count
+
+    def add_sleep(self, api, seconds):
+        """
+        Record time spent sleeping for an api's rate limits.
+        :param api: the api name, e.g. 'moz'
+        :param seconds: the time slept
+        :return: doesn't return anything
+        """
+        if seconds <= 0:
+            return
+        api = api or 'unknown'
+        with self._lock:
+            self.sleep_seconds[api] = self.sleep_seconds.get(api, 0) + seconds
+
+    def set_gauge(self, name, value):
+        """
+        Record a single number about the run (e.g. the number of sites).
+        :param name: the gauge's name, without PREFIX
+        :param value: a number
+        :return: doesn't return anything
+        """
+        with self._lock:
+            self.gauges[name] = float(value)
+
+    def to_dict(self):
+        """
+        :return: the metrics as a JSON-serializable dict
+        """
+        with self._lock:
+            latency = {}
+            for (label, value), histogram in self.latency.items():
+                latency.setdefault(label, {})[value] = {
+                    'count': histogram.count,
+                    'sum': round(histogram.sum, 6),
+                    'buckets': [[str(bound), count] for bound, count
+                                in histogram.cumulative()]
+                }
+            outcomes = {}
+            for (label, value, result), count in self.outcomes.items():
+                outcomes.setdefault(label, {}).setdefault(
+                    value, {})[result] = count
+            return {
+                'started': self.started.strftime('%Y-%m-%dT%H:%M:%S'),
+                'run_seconds': (datetime.datetime.utcnow() -
+                                self.started).total_seconds(),
+                'latency': latency,
+                'outcomes': outcomes,
+                'bytes_fetched': dict(self.bytes_fetched),
+                'rate_limit_sleep_seconds': dict(self.sleep_seconds),
+                'gauges': dict(self.gauges)
+            }
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        data = self.to_dict()
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append('# HELP {p}{n} {h}'.format(p=PREFIX, n=name,
+                                                     h=help_text))
+            lines.append('# TYPE {p}{n} {k}'.format(p=PREFIX, n=name,
+                                                     k=kind))
+
+        def sample(name, labels, value):
+            label_str = ','.join('{k}="{v}"'.format(k=k, v=escape_label(v))
+                                 for k, v in labels)
+            lines.append('{p}{n}{{{l}}} {v}'.format(
+                p=PREFIX, n=name, l=label_str, v=value
+            ) if label_str else '{p}{n} {v}'.format(p=PREFIX, n=name,
+                                                    v=value))
+
+        for label in ('type', 'host'):
+            name = 'directive_duration_seconds_by_' + label
+            if label not in data['latency']:
+                continue
+            header(name, 'histogram',
+                   'Duration of directives, by {l}.'.format(l=label))
+            for value, histogram in sorted(data['latency'][label].items()):
+                for bound, count in histogram['buckets']:
+                    sample(name + '_bucket', [(label, value), ('le', bound)],
+                           count)
+                sample(name + '_sum', [(label, value)], histogram['sum'])
+                sample(name + '_count', [(label, value)], histogram['count'])
+        for label in ('type', 'host'):
+            name = 'directive_outcomes_by_' + label
+            if label not in data['outcomes']:
+                continue
+            header(name, 'gauge',
+                   'Directives run in the last run, by {l} and outcome.'
+                   .format(l=label))
+            for value, results in sorted(data['outcomes'][label].items()):
+                for result, count in sorted(results.items()):
+                    sample(name, [(label, value), ('outcome', result)], count)
+        header('bytes_fetched', 'gauge', 'Bytes fetched in the last run.')
+        for host, count in sorted(data['bytes_fetched'].items()):
+            sample('bytes_fetched', [('host', host)], count)
+        header('rate_limit_sleep_seconds', 'gauge',
+               'Seconds slept for rate limits in the last run.')
+        for api, seconds in sorted(data['rate_limit_sleep_seconds'].items()):
+            sample('rate_limit_sleep_seconds', [('api', api)], seconds)
+        header('run_seconds', 'gauge', 'Duration of the last run.')
+        sample('run_seconds', [], data['run_seconds'])
+        for name, value in sorted(data['gauges'].items()):
+            header(name, 'gauge', name.replace('_', ' ') + '.')
+            sample(name, [], value)
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    """
+    Escape a label value for the Prometheus text format.
+    :param value: a str
+    :return: the escaped str
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+def observe_response(d_type, host, response, duration=None):
+    """
+    Record a directive's latency and outcome from its response (the list of
+    dicts returned by the directive's function).
+    :param d_type: the directive's type
+    :param host: the host the directive's data came from
+    :param response: a list of dicts, as made by make_dict
+    :param duration: the directive's latency in seconds; defaults to the
+    longest duration in response (the results of a batched call instead
+    pass their share of the call's duration, see sites.prefetch_directives)
+    :return: doesn't return anything
+    """
+    if not response:
+        return
+    if duration is None:
+        try:
+            duration = max(Decimal(d.get('duration') or 0) for d in response)
+        except (ArithmeticError, TypeError, ValueError):
+            duration = 0
+    get_metrics().observe_directive(d_type, host, duration,
+                                    response[0].get('status'))
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Return the process-wide RunMetrics, creating it if needed.
+    :return: a RunMetrics object shared by all threads
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = RunMetrics(
+                per_host=get_setting('metrics_per_host', True)
+            )
+        return _metrics
+
+
+def write_metrics(files=None):
+    """
+    Write the run's metrics to a Prometheus textfile (replaced atomically,
+    so the collector never reads half a file) and append them to a JSON
+    lines file of runs.
+    :param files: a dict with 'prometheus' and 'json' filenames; defaults
+    to the "metrics_files" setting in app_config.json
+    :return: a list of the filenames written
+    """
+    if files is None:
+        files = dict(DEFAULT_FILES)
+        files.update(get_setting('metrics_files', {}))
+    metrics = get_metrics()
+    written = []
+    if files.get('prometheus'):
+        filename = files['prometheus']
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename + '.tmp', 'w') as f:
+            f.write(metrics.to_prometheus())
+        os.replace(filename + '.tmp', filename)
+        written.append(filename)
+    if files.get('json'):
+        filename = files['json']
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, 'a') as f:
+            f.write(json.dumps(metrics.to_dict(), sort_keys=True) + '\n')
+        written.append(filename)
+    return written
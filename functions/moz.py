@@ -7,144 +7,279 @@ import hashlib
 import hmac
 import requests
 import time
+from urllib.parse import urlparse
 from credentials import moz_secrets as moz
+from cassettes import replaying
+from config import get_setting
 from data_functions import make_dict
+from http_client import get_session
+from metrics import API_HOSTS, get_metrics
+from moz_cache import get_moz_cache
+from moz_usage import get_moz_usage
+from rate_limit import get_limiter
 
+# URL is the base url for the Moz api
+URL = 'https://lsapi-beta.seomoz.com/linkscape'
+API_HOSTS['moz'] = urlparse(URL).hostname
+# ENDPOINT gets appended to URL. There are multiple endpoints, but this
+# module currently just supports url-metrics.
+ENDPOINT = '/url-metrics/'
+# The maximum number of target urls which Moz accepts in a single batched
+# POST request to url-metrics.
+MAX_BATCH_SIZE = 10
 
-def moz_search(params, start_time):
+# MOZ_FIELDS is the subset of fields from the url-metrics endpoint which
+# don't require a paid plan. Free access is limited to one call every
+# ten seconds, with a limit of 20,000 rows per month. For the
+# url-metrics endpoint, a row is a response about a single target url
+# (e.g. yourdomain.com), regardless of how many MOZ_FIELDS are returned
+# during that response.
+MOZ_FIELDS = {
+    "title": {
+        "bit_flag": 1,
+        "response_fields": {
+            "ut": "Title: The title of the page, if available"
+        },
+    },
+    "canonical": {
+        "bit_flag": 4,
+        "response_fields": {
+            "uu": "Canonical URL: The canonical form of the URL"
+        },
+    },
+    "links_ee": {
+        "bit_flag": 32,
+        "response_fields": {
+            "ueid": "External Equity Links: The number of external equity "
+                    "links to the URL"
+        },
+    },
+    "links": {
+        "bit_flag": 2048,
+        "response_fields": {
+            "uid": "Links: The number of links (equity or nonequity or not"
+                   ", internal or external) to the URL"
+        },
+    },
+    "mozrank_url": {
+        "bit_flag": 16384,
+        "response_fields": {
+            "umrp": "MozRank: The normalized 10-point score MozRank of the"
+                    " URL",
+            "ignored": {
+                "umrr": "MozRank: The raw score MozRank of the URL"
+            }
+        },
+    },
+    "mozrank_subdomain": {
+        "bit_flag": 32768,
+        "response_fields": {
+            "fmrp": "MozRank: The normalized 10-point score MozRank of the"
+                    " URL's subdomain",
+            "ignored": {
+                "fmrr": "MozRank: The raw score MozRank of the URL's "
+                        "subdomain"
+            }
+        },
+    },
+    "http_status": {
+        "bit_flag": 536870912,
+        "response_fields": {
+            "us": "HTTP Status Code: The HTTP status code recorded by "
+                  "Mozscape for this URL, if available"
+        },
+    },
+    "authority_page": {
+        "bit_flag": 34359738368,
+        "response_fields": {
+            "upa": "Page Authority: A normalized 100-point score "
+                   "representing the likelihood of a page to rank well in "
+                   "search engine results"
+        },
+    },
+    "authority_domain": {
+        "bit_flag": 68719476736,
+        "response_fields": {
+            "pda": "Domain Authority: A normalized 100-point score "
+                   "representing the likelihood of a domain to rank well "
+                   "in search engine results"
+        },
+    }
+}
+
+# Which fields from MOZ_FIELDS should be requested?
+FIELDS_TO_GET = [
+    "authority_domain",
+    "mozrank_url",
+    "mozrank_subdomain",
+    "canonical",
+    "authority_page",
+    "title",
+    "http_status",
+    "links",
+    "links_ee"
+]
+
+
+def moz_search(params, start_time, use_cache=True):
     """
     Retrieve and return authority and mozrank from Moz api.
     Authority is a logarithmically-scaled ranking of 1-100 and MozRank
     (similar to Google's PageRank) is a logarithmically-scaled ranking of 1-10.
-    :param params: The url for which authority and mozrank are being 
+    :param params: The url for which authority and mozrank are being
     requested (str), e.g. 'google.com' or 'en.wikipedia.org'.
-    :param start_time: 
+    :param start_time:
+    :param use_cache: if False, call the api even if the result is cached
+    (the result is still cached afterwards)
     :return: Returns two dicts in a list:
     - mozrank (the larger value of mozrank_url or mozrank_subdomain)
     - authority (the larger value of authority_domain or authority_page)
     """
     print('starting moz')
     error = 'ok'
-    # url is the base url for the Moz api
-    url = 'https://lsapi-beta.seomoz.com/linkscape'
-    # endpoint gets appended to url. There are multiple endpoints, but this
-    # module currently just supports url-metrics.
-    endpoint = '/url-metrics/'
+    cols = bit_flags_sum(FIELDS_TO_GET)
 
-    # TODO could make a batched POST request see:
-    # https://moz.com/help/guides/moz-api/mozscape/getting-started-with-mozscape/best-practices
+    # Return the cached result, without calling the api, if there is one.
+    cache = get_moz_cache()
+    if cache is not None and use_cache:
+        entry = cache.get(params, cols)
+        if entry is not None:
+            return cached_moz_dicts(entry, start_time)
 
-    unix_now = int(time.time())
-    # expires is the time, 5 minutes from now, which is used for sending a
-    # signed hash of moz.ACCESS_ID and expiration time, and is hashed using
-    # moz.SECRET_KEY
-    expires = unix_now + 300  # 300 seconds
+    # Assemble request_url and request_params and use these to make a GET
+    # request to the moz api.
+    request_url = URL + ENDPOINT + params
+    request_params = signed_params(cols)
+    request_params["Limit"] = 1
+    # Free access is limited to one call every ten seconds, so wait for the
+    # moz rate limiter before calling (other sites may be calling too).
+    with get_limiter('moz'):
+        response = get_session().get(
+            request_url,
+            params=request_params
+        )
+        count_rows(1)
+        get_metrics().add_bytes(API_HOSTS['moz'], len(response.content))
+        response = response.json()
 
-    # moz_fields is the subset of fields from the url-metrics endpoint which
-    # don't require a paid plan. Free access is limited to one call every
-    # ten seconds, with a limit of 20,000 rows per month. For the
-    # url-metrics endpoint, a row is a response about a single target url
-    # (e.g. yourdomain.com), regardless of how many moz_fields are returned
-    # during that response.
-    moz_fields = {
-        "title": {
-            "bit_flag": 1,
-            "response_fields": {
-                "ut": "Title: The title of the page, if available"
-            },
-        },
-        "canonical": {
-            "bit_flag": 4,
-            "response_fields": {
-                "uu": "Canonical URL: The canonical form of the URL"
-            },
-        },
-        "links_ee": {
-            "bit_flag": 32,
-            "response_fields": {
-                "ueid": "External Equity Links: The number of external equity "
-                        "links to the URL"
-            },
-        },
-        "links": {
-            "bit_flag": 2048,
-            "response_fields": {
-                "uid": "Links: The number of links (equity or nonequity or not"
-                       ", internal or external) to the URL"
-            },
-        },
-        "mozrank_url": {
-            "bit_flag": 16384,
-            "response_fields": {
-                "umrp": "MozRank: The normalized 10-point score MozRank of the"
-                        " URL",
-                "ignored": {
-                    "umrr": "MozRank: The raw score MozRank of the URL"
-                }
-            },
-        },
-        "mozrank_subdomain": {
-            "bit_flag": 32768,
-            "response_fields": {
-                "fmrp": "MozRank: The normalized 10-point score MozRank of the"
-                        " URL's subdomain",
-                "ignored": {
-                    "fmrr": "MozRank: The raw score MozRank of the URL's "
-                            "subdomain"
-                }
-            },
-        },
-        "http_status": {
-            "bit_flag": 536870912,
-            "response_fields": {
-                "us": "HTTP Status Code: The HTTP status code recorded by "
-                      "Mozscape for this URL, if available"
-            },
-        },
-        "authority_page": {
-            "bit_flag": 34359738368,
-            "response_fields": {
-                "upa": "Page Authority: A normalized 100-point score "
-                       "representing the likelihood of a page to rank well in "
-                       "search engine results"
-            },
-        },
-        "authority_domain": {
-            "bit_flag": 68719476736,
-            "response_fields": {
-                "pda": "Domain Authority: A normalized 100-point score "
-                       "representing the likelihood of a domain to rank well "
-                       "in search engine results"
-            },
-        }
-    }
+    moz_dicts = make_moz_dicts(response, start_time, error)
+    if cache is not None:
+        cache_moz_dicts(cache, params, cols, moz_dicts)
+        cache.save()
+    return moz_dicts
 
-    # Which fields from moz_fields should be requested?
-    fields_to_get = [
-        "authority_domain",
-        "mozrank_url",
-        "mozrank_subdomain",
-        "canonical",
-        "authority_page",
-        "title",
-        "http_status",
-        "links",
-        "links_ee"
-    ]
 
-    # If there are any fields which shouldn't be retrieved, move them from
-    # fields_to_get to fields_not_to_get.
-    fields_not_to_get = [
-    ]
+def moz_batch_search(targets, start_time, batch_size=None, use_cache=True):
+    """
+    Retrieve authority and mozrank for many target urls with batched POSTs.
+    Moz's url-metrics endpoint accepts a JSON list of target urls in the body
+    of a POST and returns a list of results in the same order. Batching cuts
+    the number of calls (and therefore the ten second waits between calls)
+    from one per site to one per batch_size sites.
+    :param targets: a list of target urls (str), e.g. ['google.com', ...].
+    Duplicates are only requested once.
+    :param start_time: the UTC time (as a datetime object) at which
+    retrieving began, to calculate duration.
+    :param batch_size: how many targets to send per POST; defaults to the
+    "moz_batch_size" setting in app_config.json, or MAX_BATCH_SIZE
+    :param use_cache: if False, call the api even for cached targets (the
+    results are still cached afterwards)
+    :return: a dict keyed by target url, where each value is the same list
+    of two dicts (mozrank and authority) that moz_search returns
+    """
+    print('starting moz batch')
+    if batch_size is None:
+        batch_size = get_setting('moz_batch_size', MAX_BATCH_SIZE)
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    targets = list(dict.fromkeys(targets))  # de-duplicate but keep order
+    cols = bit_flags_sum(FIELDS_TO_GET)
 
-    # Each of Moz's fields in moz_fields has a bit_flag value. To request a
-    # single field from the api, its bit_flag value is sent as the Cols=
-    # parameter in the api call. To request more than one field from the
-    # api, the sum of all the bit_flag values is sent as the Cols= parameter.
-    bit_flags_sum = 0
+    results = {}
+    # Use cached results where possible, and only request the rest.
+    cache = get_moz_cache()
+    if cache is not None and use_cache:
+        uncached = []
+        for target in targets:
+            entry = cache.get(target, cols)
+            if entry is not None:
+                results[target] = cached_moz_dicts(entry, start_time)
+            else:
+                uncached.append(target)
+        targets = uncached
+
+    for i in range(0, len(targets), batch_size):
+        batch = targets[i:i + batch_size]
+        error = 'ok'
+        try:
+            with get_limiter('moz'):
+                response = get_session().post(
+                    URL + ENDPOINT,
+                    params=signed_params(cols),
+                    json=batch
+                )
+            count_rows(len(batch))
+            get_metrics().add_bytes(API_HOSTS['moz'], len(response.content))
+            if response.status_code != 200:
+                raise ValueError('moz batch received status code {s}'.format(
+                    s=response.status_code
+                ))
+            responses = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error = str(e)
+            responses = [{} for _ in batch]
+        # Moz returns the results in the same order as the targets which
+        # were posted, so zip them back together.
+        for target, target_response in zip(batch, responses):
+            results[target] = make_moz_dicts(target_response, start_time,
+                                             error)
+            if cache is not None:
+                cache_moz_dicts(cache, target, cols, results[target])
+    if cache is not None:
+        cache.save()
+    return results
+
+
+def count_rows(rows):
+    """
+    Count rows sent to the api against the monthly quota (see
+    moz_usage.py). Replayed responses (see cassettes.py) don't use any.
+    :param rows: the number of target urls sent
+    :return: doesn't return anything
+    """
+    if replaying():
+        return
+    usage = get_moz_usage()
+    usage.add(rows)
+    usage.save()
+
+
+def bit_flags_sum(fields_to_get):
+    """
+    Each of Moz's fields in MOZ_FIELDS has a bit_flag value. To request a
+    single field from the api, its bit_flag value is sent as the Cols=
+    parameter in the api call. To request more than one field from the
+    api, the sum of all the bit_flag values is sent as the Cols= parameter.
+    :param fields_to_get: a list of keys from MOZ_FIELDS
+    :return: the sum of the bit_flag values (int)
+    """
+    total = 0
     for field_to_get in fields_to_get:
-        if field_to_get in moz_fields:
-            bit_flags_sum += moz_fields[field_to_get]["bit_flag"]
+        if field_to_get in MOZ_FIELDS:
+            total += MOZ_FIELDS[field_to_get]["bit_flag"]
+    return total
+
+
+def signed_params(cols):
+    """
+    Create the authentication query parameters for a call to the Moz api.
+    :param cols: the Cols= value (see bit_flags_sum)
+    :return: a dict of query parameters
+    """
+    unix_now = int(time.time())
+    # expires is the time, 5 minutes from now, which is used for sending a
+    # signed hash of moz.ACCESS_ID and expiration time, and is hashed using
+    # moz.SECRET_KEY
+    expires = unix_now + 300  # 300 seconds
 
     # The code for generating signature is from Moz's seomoz Python package:
     # https://github.com/seomoz/SEOmozAPISamples/blob/master/python/mozscape.py
@@ -155,45 +290,86 @@ def moz_search(params, start_time):
             str_to_sign.encode('utf-8'),
             hashlib.sha1).digest()
         )
-
-    # Assemble request_url and request_params and use these to make a GET
-    # request to the moz api.
-    request_url = url + endpoint + params
-    request_params = {
-        "Cols": bit_flags_sum,
-        "Limit": 1,
+    return {
+        "Cols": cols,
         "AccessID": moz.ACCESS_ID,
         "Expires": expires,
         "Signature": signature
     }
-    response = requests.get(
-        request_url,
-        params=request_params
-    ).json()
 
+
+def cached_moz_dicts(entry, start_time):
+    """
+    Turn a cached result (see moz_cache.py) into mozrank and authority dicts.
+    The dicts' status is 'ok (cached)' so that cache hits can be counted.
+    :param entry: a cached result from MozCache.get
+    :param start_time: the UTC time (as a datetime object) at which
+    retrieving began, to calculate duration.
+    :return: a list of two dicts: mozrank and authority
+    """
+    return [
+        make_dict(
+            value=Decimal(entry[data_name]),
+            data_name=data_name,
+            start_time=start_time,
+            status='ok (cached)'
+        )
+        for data_name in ('mozrank', 'authority')
+    ]
+
+
+def cache_moz_dicts(cache, target, cols, moz_dicts):
+    """
+    Store a successfully retrieved result in cache.
+    :param cache: a MozCache object
+    :param target: the target url (str)
+    :param cols: the Cols= bit flags sum (int)
+    :param moz_dicts: the list of mozrank and authority dicts
+    :return: doesn't return anything
+    """
+    mozrank, authority = moz_dicts
+    if mozrank['status'] == 'ok' and mozrank['payload'] is not None:
+        cache.set(target, cols, mozrank['payload'], authority['payload'])
+
+
+def make_moz_dicts(response, start_time, error):
+    """
+    Turn one url-metrics result into the mozrank and authority dicts.
+    :param response: a single url-metrics result (dict) from the Moz api
+    :param start_time: the UTC time (as a datetime object) at which
+    retrieving began, to calculate duration.
+    :param error: the status to record with the values
+    :return: a list of two dicts: mozrank and authority
+    """
     # Moz's json response contains cryptically-named keys. Rename the
-    # cryptic keys to the more sensible names used in moz_fields, and stick
+    # cryptic keys to the more sensible names used in MOZ_FIELDS, and stick
     # the new keys and associated values in response_rekeyed.
     response_rekeyed = {}
     for cryptic_key in response:
-        for sensible_key in moz_fields:
-            if cryptic_key in moz_fields[sensible_key]["response_fields"]:
+        for sensible_key in MOZ_FIELDS:
+            if cryptic_key in MOZ_FIELDS[sensible_key]["response_fields"]:
                 response_rekeyed[sensible_key] = response[cryptic_key]
 
     # Take the larger value of authority_domain or authority_page and of
     # mozrank_url or mozrank_subdomain.
-    authority = Decimal(
-        str(
-            max(
-        response_rekeyed['authority_domain'],
-        response_rekeyed['authority_page']
-    )))
-    mozrank = Decimal(
-        str(
-            max(
-        response_rekeyed['mozrank_url'],
-        response_rekeyed['mozrank_subdomain']
-    )))
+    try:
+        authority = Decimal(
+            str(
+                max(
+            response_rekeyed['authority_domain'],
+            response_rekeyed['authority_page']
+        )))
+        mozrank = Decimal(
+            str(
+                max(
+            response_rekeyed['mozrank_url'],
+            response_rekeyed['mozrank_subdomain']
+        )))
+    except KeyError as e:
+        authority = None
+        mozrank = None
+        if error == 'ok':
+            error = 'moz response was missing {k}'.format(k=e)
 
     mozrank = make_dict(
         value=mozrank,
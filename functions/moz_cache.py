@@ -0,0 +1,157 @@
+"""
+A local, on-disk cache of Moz url-metrics results.
+
+The Mozscape index is only updated every few weeks, so re-querying the same
+target every day uses up the monthly row quota without getting new numbers.
+Results are cached per target url and Cols bit flags, and expire after
+ttl_seconds. When the cache holds more than max_entries results, the oldest
+results are evicted first.
+"""
+import json
+import os
+import threading
+import time
+from config import get_setting
+from error_handling import handle_error
+
+DEFAULT_FILENAME = '../cache/moz_cache.json'
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60  # 30 days
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class MozCache(object):
+    """
+    Class for caching Moz results on disk between runs.
+    Each entry is stored like this:
+        "<cols>:<target>": {
+            "stored": <unix time when the result was retrieved>,
+            "mozrank": "<Decimal as str>",
+            "authority": "<Decimal as str>"
+        }
+    """
+    def __init__(self, filename=DEFAULT_FILENAME,
+                 ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Initialize the MozCache, loading any existing entries from filename.
+        :param filename: the JSON file in which the cache is kept
+        :param ttl_seconds: how long a cached result stays valid
+        :param max_entries: the maximum number of results to keep
+        """
+        self.filename = filename
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename, 'r') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+        except ValueError as e:
+            handle_error(
+                exc=ValueError,
+                err=e,
+                msg='moz cache {f} is corrupt, starting empty'.format(
+                    f=self.filename
+                )
+            )
+            self._entries = {}
+
+    @staticmethod
+    def make_key(target, cols):
+        """
+        Make the cache key for a target url and Cols bit flags.
+        :param target: the target url (str), e.g. 'recurse.com'
+        :param cols: the Cols= bit flags sum (int)
+        :return: the key (str)
+        """
+        return '{c}:{t}'.format(c=cols, t=target)
+
+    def get(self, target, cols):
+        """
+        Look up an unexpired cached result.
+        :param target: the target url (str)
+        :param cols: the Cols= bit flags sum (int)
+        :return: a dict with 'stored', 'mozrank' and 'authority' keys, or None
+        if there is no unexpired result
+        """
+        key = self.make_key(target, cols)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry['stored'] > \
+                    self.ttl_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry)
+
+    def set(self, target, cols, mozrank, authority):
+        """
+        Store a result, evicting the oldest results if over max_entries.
+        :param target: the target url (str)
+        :param cols: the Cols= bit flags sum (int)
+        :param mozrank: the mozrank value (Decimal)
+        :param authority: the authority value (Decimal)
+        :return: doesn't return anything
+        """
+        key = self.make_key(target, cols)
+        with self._lock:
+            self._entries[key] = {
+                'stored': time.time(),
+                'mozrank': str(mozrank),
+                'authority': str(authority)
+            }
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                oldest = sorted(
+                    self._entries,
+                    key=lambda k: self._entries[k]['stored']
+                )
+                for old_key in oldest[:overflow]:
+                    del self._entries[old_key]
+
+    def save(self):
+        """
+        Write the cache to disk, dropping expired results.
+        :return: doesn't return anything
+        """
+        now = time.time()
+        with self._lock:
+            self._entries = {
+                key: entry for key, entry in self._entries.items()
+                if now - entry['stored'] <= self.ttl_seconds
+            }
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_filename, self.filename)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_moz_cache():
+    """
+    Return the process-wide MozCache, or None if caching is turned off.
+    The cache is configured by the "moz_cache" setting in app_config.json,
+    e.g. {"moz_cache": {"enabled": true, "ttl_seconds": 2592000}}.
+    :return: a MozCache object shared by all threads, or None
+    """
+    global _cache
+    settings = get_setting('moz_cache', {})
+    if not settings.get('enabled', True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = MozCache(
+                filename=settings.get('filename', DEFAULT_FILENAME),
+                ttl_seconds=settings.get('ttl_seconds', DEFAULT_TTL_SECONDS),
+                max_entries=settings.get('max_entries', DEFAULT_MAX_ENTRIES)
+            )
+        return _cache
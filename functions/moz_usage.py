@@ -0,0 +1,101 @@
+"""
+A local, on-disk count of the Moz rows used per calendar month.
+
+Moz's free access allows 20,000 rows per month (see moz.py), and a row is
+used by every target url sent to the api, whether or not its result is kept
+(e.g. a target sent twice in a month uses two rows, even if the second
+result is then served from moz_cache.py). The calls in moz.py count the rows
+they send here, so that the scheduler (see scheduler.py) can plan against
+the rows actually left this month.
+"""
+import datetime
+import json
+import os
+import threading
+from config import get_setting
+from error_handling import handle_error
+
+DEFAULT_FILENAME = '../cache/moz_usage.json'
+MONTH_FORMAT = '%Y-%m'
+
+
+class MozUsage(object):
+    """
+    Class for counting Moz rows between runs. The file looks like this:
+        {"<YYYY-MM>": <rows sent that month>, ...}
+    """
+    def __init__(self, filename=DEFAULT_FILENAME):
+        """
+        Initialize the MozUsage, loading any existing counts from filename.
+        :param filename: the JSON file in which the counts are kept
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename, 'r') as f:
+                self._months = json.load(f)
+        except FileNotFoundError:
+            self._months = {}
+        except ValueError as e:
+            handle_error(
+                exc=ValueError,
+                err=e,
+                msg='moz usage {f} is corrupt, starting empty'.format(
+                    f=self.filename
+                )
+            )
+            self._months = {}
+
+    def add(self, rows, now=None):
+        """
+        Count rows sent to the api.
+        :param rows: the number of target urls sent
+        :param now: the time (UTC datetime) they were sent; defaults to now
+        :return: doesn't return anything
+        """
+        month = (now or datetime.datetime.utcnow()).strftime(MONTH_FORMAT)
+        with self._lock:
+            self._months[month] = self._months.get(month, 0) + rows
+
+    def rows(self, now=None):
+        """
+        :param now: a time (UTC datetime) in the month; defaults to now
+        :return: the number of rows sent in that calendar month
+        """
+        month = (now or datetime.datetime.utcnow()).strftime(MONTH_FORMAT)
+        with self._lock:
+            return self._months.get(month, 0)
+
+    def save(self):
+        """
+        Write the counts to disk.
+        :return: doesn't return anything
+        """
+        with self._lock:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                json.dump(self._months, f)
+            os.replace(temp_filename, self.filename)
+
+
+_usage = None
+_usage_lock = threading.Lock()
+
+
+def get_moz_usage():
+    """
+    Return the process-wide MozUsage, configured by the "moz_usage" setting
+    in app_config.json, e.g. {"moz_usage": {"filename": "usage.json"}}.
+    :return: a MozUsage object shared by all threads
+    """
+    global _usage
+    with _usage_lock:
+        if _usage is None:
+            _usage = MozUsage(
+                filename=get_setting('moz_usage', {}).get('filename',
+                                                          DEFAULT_FILENAME)
+            )
+        return _usage
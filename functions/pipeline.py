@@ -0,0 +1,361 @@
+"""
+A staged pipeline for refreshing all sites.
+
+The Pipeline runs the work as stages, connected by bounded queues, each in
+its own thread(s):
+    1. load: scan the sites table, plan which directives are due (see
+       scheduler.py), and prefetch each chunk's batchable due directives
+       (see sites.prefetch_directives)
+    2. fetch: run each Site's directives (scraping and api calls), in a pool
+       of workers
+    3. merge: save each Site's results into its data branch
+    4. persist: write the Sites back to DynamoDB, and their new values to the
+       history table, in batches
+    5. render: once every Site is persisted, rank and render them, and write
+       the new ranks and scores back to DynamoDB
+Sites flow on to be persisted while others are still being fetched. When a
+stage falls behind, the queue in front of it fills up and the stages before
+it wait (backpressure), so only a bounded number of Sites are in flight at
+once, however many sites there are. Only a small summary of each persisted
+Site (see sites.SiteSummary) is kept for the render stage.
+
+When cassettes are recording (see cassettes.py), the scanned rows are saved
+along with the responses; when they're replaying, the rows are read back
+from the recording and nothing is written to DynamoDB, so a replayed run
+neither needs the network nor changes the stored sites. Recording and
+replaying refresh every directive, rather than the scheduler's choice.
+"""
+import queue
+import threading
+import cassettes
+from config import get_setting
+from dynamodb import VOLATILE_FIELDS, Dynamo
+from error_handling import get_reporter, handle_error, report_errors
+from history import History
+from http_client import get_session
+from metrics import get_metrics, write_metrics
+from ranking import rank_sites, site_metrics
+from render import render_sites
+from s3 import S3
+from scheduler import Scheduler
+from sites import Site, SiteSummary, chunked, prefetch_directives
+import tracing
+from tracing import span
+
+# Put on a queue to tell the next stage that there's nothing more to come.
+DONE = object()
+
+
+class Pipeline(object):
+    """
+    Refreshes, persists and renders all sites in concurrent stages.
+    """
+    def __init__(self, dynamo_session, writer=None, history=None,
+                 workers=None, queue_size=None, chunk_size=None,
+                 persist_batch_size=None, table_name='sites',
+                 scheduler=None):
+        """
+        Initialize the Pipeline.
+        :param dynamo_session: a Dynamo object, used to scan the sites table
+        :param writer: a Dynamo object used to write the sites (boto3
+        resources shouldn't be shared between threads); defaults to a new
+        Dynamo with dynamo_session's profile
+        :param history: a History object; defaults to History(writer)
+        :param workers: the number of sites to fetch at once; defaults to the
+        "refresh_workers" setting in app_config.json, or 1
+        :param queue_size: the maximum number of items waiting between two
+        stages; defaults to the "pipeline_queue_size" setting, or 32
+        :param chunk_size: the number of rows to prefetch directives for at
+        once; defaults to the "load_chunk_size" setting, or 100
+        :param persist_batch_size: the number of sites written at once;
+        defaults to the "persist_batch_size" setting, or 25
+        :param table_name: the name of the sites table
+        :param scheduler: a Scheduler object, to refresh only the directives
+        which are due; defaults to a new Scheduler if the
+        "schedule_refreshes" setting in app_config.json is true, otherwise
+        every directive is refreshed
+        """
+        mode = cassettes.get_settings()['mode']
+        if scheduler is None and get_setting('schedule_refreshes', False) \
+                and mode not in ('record', 'replay'):
+            scheduler = Scheduler()
+        if writer is None:
+            writer = Dynamo(profile_name=dynamo_session.profile_name)
+        if history is None:
+            history = History(writer, sites_table=table_name)
+        self.dynamo = dynamo_session
+        self.writer = writer
+        self.history = history
+        self.workers = max(1, workers or get_setting('refresh_workers', 1))
+        self.queue_size = queue_size or get_setting('pipeline_queue_size', 32)
+        self.chunk_size = chunk_size or get_setting('load_chunk_size', 100)
+        self.persist_batch_size = persist_batch_size or \
+            get_setting('persist_batch_size', 25)
+        self.table_name = table_name
+        self.scheduler = scheduler
+        self.recording = mode in ('record', 'auto')
+        self.replaying = mode == 'replay'
+        self.load_failed = False
+        # Summaries of the persisted Sites, in the order they were written,
+        # and their metrics, taken before writing.
+        self.sites = []
+        self.metrics = ([], [])
+        self.counts = {
+            'loaded': 0,
+            'fetched': 0,
+            'failed': 0,
+            'persisted': 0,
+            'write_failed': 0,
+            'history_items': 0
+        }
+        self._counts_lock = threading.Lock()
+
+    def _count(self, name, number=1):
+        with self._counts_lock:
+            self.counts[name] += number
+
+    def load(self, fetch_queue):
+        """
+        Stage 1: scan the sites table and queue (item, prefetched, due)
+        tuples, where due is the set of the item's directives to refresh
+        (None for all of them).
+        :param fetch_queue: the queue to the fetch stage
+        :return: doesn't return anything
+        """
+        try:
+            if self.replaying:
+                items = cassettes.replay_items(self.table_name)
+            else:
+                items = self.dynamo.iter_rows(table_name=self.table_name)
+                if self.recording:
+                    items = cassettes.record_items(items, self.table_name)
+            plan = None
+            if self.scheduler is not None:
+                # Planning against the apis' budgets needs every site, so
+                # the (small) items are all read before fetching starts.
+                with span('scan'):
+                    items = list(items)
+                with span('schedule', sites=len(items)):
+                    plan = iter(self.scheduler.plan(items))
+            for chunk in chunked(items, self.chunk_size):
+                due = None if plan is None else [next(plan) for _ in chunk]
+                with span('prefetch', sites=len(chunk)):
+                    prefetched = prefetch_directives(chunk, due=due)
+                for i, item in enumerate(chunk):
+                    fetch_queue.put((item, prefetched,
+                                     None if due is None else due[i]))
+                    self._count('loaded')
+        except Exception as e:
+            self.load_failed = True
+            handle_error(exc=type(e), err=e, msg='pipeline load stage')
+        finally:
+            for _ in range(self.workers):
+                fetch_queue.put(DONE)
+
+    def fetch(self, fetch_queue, merge_queue):
+        """
+        Stage 2 (one per worker): create each Site and run its directives.
+        :param fetch_queue: the queue from the load stage
+        :param merge_queue: the queue to the merge stage
+        :return: doesn't return anything
+        """
+        while True:
+            work = fetch_queue.get()
+            if work is DONE:
+                merge_queue.put(DONE)
+                return
+            item, prefetched, due = work
+            try:
+                site = Site(item)
+                merge_queue.put((site, site.fetch(prefetched, due=due)))
+                self._count('fetched')
+            except Exception as e:
+                self._count('failed')
+                handle_error(exc=type(e), err=e, msg='pipeline fetch stage',
+                             host=item.get('url', {}).get('domain'))
+
+    def merge(self, merge_queue, persist_queue):
+        """
+        Stage 3: save each Site's results into its data branch.
+        :param merge_queue: the queue from the fetch stage
+        :param persist_queue: the queue to the persist stage
+        :return: doesn't return anything
+        """
+        workers_left = self.workers
+        while workers_left:
+            work = merge_queue.get()
+            if work is DONE:
+                workers_left -= 1
+                continue
+            site, responses = work
+            try:
+                with span('merge'):
+                    site.merge(responses)
+                persist_queue.put(site)
+            except Exception as e:
+                self._count('failed')
+                handle_error(exc=type(e), err=e, msg='pipeline merge stage')
+        persist_queue.put(DONE)
+
+    def persist(self, persist_queue):
+        """
+        Stage 4: write Sites to DynamoDB and the history table in batches.
+        :param persist_queue: the queue from the merge stage
+        :return: doesn't return anything
+        """
+        batch = []
+        while True:
+            site = persist_queue.get()
+            if site is not DONE:
+                batch.append(site)
+            if batch and (site is DONE or
+                          len(batch) >= self.persist_batch_size):
+                self.write_batch(batch)
+                batch = []
+            if site is DONE:
+                return
+
+    def write_batch(self, batch):
+        """
+        Write one batch of Sites, keeping their summaries for the render
+        stage. If the batch can't be written, its values aren't saved to the
+        history table either (so they'll be retrieved again next run), but
+        the Sites are still ranked and rendered. Replayed Sites are only
+        summarized.
+        :param batch: a list of Site objects
+        :return: doesn't return anything
+        """
+        try:
+            for site in batch:
+                # Writing replaces a Site's loaded item, so its previous
+                # values must be taken for ranking first.
+                current, previous = site_metrics(site)
+                self.metrics[0].append(current)
+                self.metrics[1].append(previous)
+                self.sites.append(SiteSummary(
+                    site, () if self.replaying else self.history.key_names
+                ))
+            if self.replaying:
+                return
+            written = self.writer.batch_update_rows(
+                table_name=self.table_name,
+                items=batch,
+                # The scheduler finds which directives are due by their
+                # values' accessed times, so those must be written even when
+                # the values haven't changed.
+                volatile_fields=VOLATILE_FIELDS if self.scheduler is None
+                else ('duration',)
+            )
+            if not written:
+                self._count('write_failed', len(batch))
+                return
+            with span('save history', sites=len(batch)):
+                self._count('history_items', self.history.save_sites(batch))
+            self._count('persisted', len(batch))
+            for site in batch:
+                site.new_records = []
+        except Exception as e:
+            handle_error(exc=type(e), err=e, msg='pipeline persist stage')
+
+    def write_rankings(self, sites):
+        """
+        Write the ranks and scores which have changed back to DynamoDB.
+        :param sites: a list of ranked SiteSummary objects
+        :return: doesn't return anything
+        """
+        updates = [
+            (site.key, {'rank': site.rank, 'score': site.score})
+            for site in sites if site.ranking_changed()
+        ]
+        with span('write rankings', sites=len(updates)):
+            self.writer.update_attributes(self.table_name, updates)
+
+    def run(self, render=True):
+        """
+        Run all of the stages until every site is persisted, and then rank
+        the sites and (optionally) render them.
+        :param render: if True, render the ranked sites (see render.py)
+        :return: a list of the persisted Sites' summaries (see SiteSummary),
+        sorted by rank
+        """
+        fetch_queue = queue.Queue(maxsize=self.queue_size)
+        merge_queue = queue.Queue(maxsize=self.queue_size)
+        persist_queue = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self.load, args=(fetch_queue,),
+                             name='pipeline-load'),
+            threading.Thread(target=self.merge,
+                             args=(merge_queue, persist_queue),
+                             name='pipeline-merge'),
+            threading.Thread(target=self.persist, args=(persist_queue,),
+                             name='pipeline-persist')
+        ]
+        threads += [
+            threading.Thread(target=self.fetch,
+                             args=(fetch_queue, merge_queue),
+                             name='pipeline-fetch-{n}'.format(n=n))
+            for n in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        loaded = not (self.dynamo.scan_failed or self.load_failed)
+        if not loaded:
+            # Only part of the table was read, so a rendered table would
+            # silently leave out the other sites.
+            handle_error(
+                exc=RuntimeError,
+                err='the scan of "{t}" failed'.format(t=self.table_name),
+                msg='not rendering a partial table'
+            )
+            render = False
+
+        # Stage 5: ranking needs every site, so it runs at the end.
+        with span('rank', sites=len(self.sites)):
+            sites = rank_sites(self.sites, metrics=self.metrics)
+        if loaded and not self.replaying:
+            # (A partial scan's ranks are only among the sites it read.)
+            self.write_rankings(sites)
+        if render:
+            print('pages rendered:', render_sites(sites))
+        for name, count in self.counts.items():
+            get_metrics().set_gauge('sites_' + name, count)
+        return sites
+
+
+if __name__ == '__main__':
+    dynamo = Dynamo(
+        profile_name='top-sites'
+    )
+    tracing.start()
+    try:
+        pipeline = Pipeline(dynamo)
+        sites = pipeline.run()
+        print('pipeline counts:', pipeline.counts)
+        if pipeline.scheduler is not None:
+            print('schedule:', pipeline.scheduler.stats)
+        for name, count in pipeline.writer.write_stats.items():
+            get_metrics().set_gauge('dynamodb_' + name, count)
+        # Count the responses recorded and replayed, if cassettes are on.
+        cassette_stats = getattr(get_session().get_adapter('https://'),
+                                 'stats', {})
+        for name, count in cassette_stats.items():
+            get_metrics().set_gauge('cassettes_' + name, count)
+        errors = get_reporter().summary()
+        get_metrics().set_gauge('errors',
+                                sum(kind['count'] for kind in errors))
+        get_metrics().set_gauge('error_kinds', len(errors))
+        print('metrics written:', write_metrics())
+        print('write stats:', pipeline.writer.write_stats)
+    finally:
+        # A failed run's trace and errors are the ones most worth keeping.
+        print('error log written:', report_errors())
+        print('trace files written:', tracing.stop())
+
+    if not pipeline.replaying:
+        # Upload file to S3
+        s3 = S3()
+        result = s3.upload_file_public_read(file='foo')
+        print(result)
@@ -0,0 +1,199 @@
+"""
+Composite ranking of sites by their metrics.
+
+The latest value of each ranked metric (e.g. Moz's mozrank and Twitter's
+tweets), and its value from the previous run, are loaded for all sites into
+NumPy arrays (one row per site, one column per metric). Then, in one
+vectorized pass over all sites:
+    - counts with a long tail (e.g. tweets_followers) are log-scaled
+    - each metric is scaled to 0-1 by its min and max across the sites
+    - the composite score is the weighted mean of the scaled metrics
+    - the previous run's values are scaled the same way, giving each
+      metric's and the score's day-over-day deltas
+Missing values (e.g. a failed api call) count as the lowest value.
+"""
+from decimal import Decimal
+import numpy as np
+from config import get_setting
+
+# The metrics which are ranked: name: (directive type, data_name, log-scaled)
+METRICS = {
+    'mozrank': ('moz', 'mozrank', False),
+    'authority': ('moz', 'authority', False),
+    'tweets': ('twitter', 'tweets', True),
+    'tweets_followers': ('twitter', 'tweets_followers', True)
+}
+# Default weights of the metrics in the composite score. These can be
+# overridden in app_config.json with a "ranking_weights" key.
+DEFAULT_WEIGHTS = {
+    'mozrank': 1,
+    'authority': 1,
+    'tweets': 1,
+    'tweets_followers': 1
+}
+
+
+def metric_value(data, directives, d_type, data_name, position=0):
+    """
+    Find a site's value of a metric.
+    :param data: the site's data branch
+    :param directives: the site's directives
+    :param d_type: the type of the directive with the metric, e.g. 'moz'
+    :param data_name: the metric's data_name, e.g. 'mozrank'
+    :param position: 0 for the latest value, 1 for the one before it
+    :return: the value as a float, or nan if the site doesn't have one
+    """
+    for name, directive in directives.items():
+        if directive.get('type') != d_type:
+            continue
+        try:
+            value = data[name][data_name][position]['payload']
+        except (TypeError, KeyError, IndexError):
+            continue
+        if value is not None:
+            return float(value)
+    return np.nan
+
+
+def previous_value(site, d_type, data_name):
+    """
+    Find a metric's value from before this run: the latest value of the
+    item the site was loaded from, or else the second value kept inline.
+    :param site: a Site object
+    :param d_type: the type of the directive with the metric
+    :param data_name: the metric's data_name
+    :return: the value as a float, or nan
+    """
+    loaded = getattr(site, '_loaded_item', None)
+    if loaded:
+        value = metric_value(loaded.get('data', {}),
+                             loaded.get('directives', {}), d_type, data_name)
+        if not np.isnan(value):
+            return value
+    return metric_value(site.data, site.directives, d_type, data_name,
+                        position=1)
+
+
+def site_metrics(site, metrics=METRICS):
+    """
+    Find a site's latest and previous values of each metric. (Sites which
+    are written back to DynamoDB before being ranked, as in pipeline.py,
+    need these taken beforehand, since writing replaces the loaded item.)
+    :param site: a Site object
+    :param metrics: a dict like METRICS
+    :return: a tuple of two lists of floats (nan where missing)
+    """
+    data = getattr(site, 'data', {})
+    directives = getattr(site, 'directives', {})
+    current = []
+    previous = []
+    for d_type, data_name, _ in metrics.values():
+        current.append(metric_value(data, directives, d_type, data_name))
+        previous.append(previous_value(site, d_type, data_name))
+    return current, previous
+
+
+def load_metrics(sites, metrics=METRICS):
+    """
+    Load the sites' latest and previous metric values into arrays.
+    :param sites: a list of Site objects
+    :param metrics: a dict like METRICS
+    :return: a tuple of two float arrays of shape (len(sites), len(metrics))
+    with the latest and previous values (nan where missing)
+    """
+    current = np.full((len(sites), len(metrics)), np.nan)
+    previous = np.full((len(sites), len(metrics)), np.nan)
+    for i, site in enumerate(sites):
+        current[i], previous[i] = site_metrics(site, metrics)
+    return current, previous
+
+
+def composite_scores(current, previous, weights, log_scaled):
+    """
+    Compute the composite scores and deltas of all sites at once.
+    :param current: an array of the latest values, one row per site
+    :param previous: an array of the previous values, the same shape
+    :param weights: an array of each column's weight
+    :param log_scaled: a bool array of which columns to log-scale
+    :return: a tuple of (scores, score_deltas, metric_deltas) arrays; deltas
+    are nan where there's no previous value
+    """
+    def scale(values):
+        values = np.where(values < 0, 0, values)
+        return np.where(log_scaled, np.log1p(values), values)
+
+    scaled = scale(current)
+    scaled_previous = scale(previous)
+    # fmin/fmax skip nans (a column with no values at all gives nan).
+    low = np.fmin.reduce(scaled, axis=0, initial=np.inf)
+    high = np.fmax.reduce(scaled, axis=0, initial=-np.inf)
+    spread = np.where(high > low, high - low, 1.0)
+    low = np.where(np.isfinite(low), low, 0.0)
+
+    def normalize(values):
+        return np.nan_to_num(np.clip((values - low) / spread, 0.0, 1.0))
+
+    total_weight = weights.sum() or 1.0
+    scores = normalize(scaled) @ weights / total_weight
+    previous_scores = normalize(scaled_previous) @ weights / total_weight
+    has_previous = ~np.isnan(previous).all(axis=1)
+    score_deltas = np.where(has_previous, scores - previous_scores, np.nan)
+    metric_deltas = current - previous
+    return scores, score_deltas, metric_deltas
+
+
+def to_decimal(value, places=4):
+    """
+    Convert a float to a Decimal that DynamoDB can store.
+    :param value: a float (or nan)
+    :param places: the number of decimal places to keep
+    :return: a Decimal, or None for nan
+    """
+    if np.isnan(value):
+        return None
+    return Decimal(str(round(float(value), places)))
+
+
+def rank_sites(sites, weights=None, metrics=None):
+    """
+    Rank sites by their composite scores. Each site is given a rank (1 is
+    the highest score), a score (0-1) and deltas: a dict with each metric's
+    and the score's change since the previous run.
+    :param sites: a list of Site objects
+    :param weights: a dict of each metric's weight in the score; defaults to
+    the "ranking_weights" setting in app_config.json
+    :param metrics: optional tuple of the sites' (latest, previous) metric
+    rows, as returned by site_metrics, if they were taken already
+    :return: a list of the sites, sorted by rank
+    """
+    if weights is None:
+        weights = dict(DEFAULT_WEIGHTS)
+        weights.update(get_setting('ranking_weights', {}))
+    names = list(METRICS)
+    weight_array = np.array([float(weights.get(name, 0)) for name in names])
+    log_scaled = np.array([METRICS[name][2] for name in names])
+
+    if metrics is None:
+        current, previous = load_metrics(sites, METRICS)
+    else:
+        shape = (len(sites), len(METRICS))
+        current = np.array(metrics[0], dtype=float).reshape(shape)
+        previous = np.array(metrics[1], dtype=float).reshape(shape)
+    scores, score_deltas, metric_deltas = composite_scores(
+        current, previous, weight_array, log_scaled
+    )
+    # A stable sort keeps the existing order of sites with equal scores.
+    order = np.argsort(-scores, kind='stable')
+
+    ranked = []
+    for rank, i in enumerate(order, start=1):
+        site = sites[i]
+        site.rank = rank
+        site.score = to_decimal(scores[i])
+        site.deltas = {
+            name: to_decimal(metric_deltas[i, j])
+            for j, name in enumerate(names)
+        }
+        site.deltas['score'] = to_decimal(score_deltas[i])
+        ranked.append(site)
+    return ranked
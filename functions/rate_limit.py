@@ -0,0 +1,224 @@
+"""
+Rate limiting for the apis and sites that top_sites sends requests to.
+
+Each api gets its own RateLimiter, so that running many sites at once (see
+pipeline.py) can't exceed any single api's limits. Because the limits
+are separate, a slow api (e.g. Moz's one call every ten seconds) doesn't hold
+up calls to the other apis.
+
+Apis which allow a number of calls per time window (e.g. Twitter) also get an
+ApiBudget, which schedules the calls of all sites against that window.
+"""
+import sys
+import threading
+import time
+from cassettes import replaying
+from config import get_setting
+from metrics import get_metrics
+
+# Default limits per api. These can be overridden in app_config.json with a
+# "rate_limits" key, e.g. {"rate_limits": {"moz": {"min_interval": 10}}}.
+#   - min_interval: minimum number of seconds between the starts of two calls
+#   - max_concurrent: maximum number of calls which can be in flight at once
+DEFAULT_LIMITS = {
+    'moz': {
+        'min_interval': 10,
+        'max_concurrent': 1
+    },
+    'twitter': {
+        'min_interval': 0,
+        'max_concurrent': 1
+    },
+    'scrape_newest': {
+        'min_interval': 0,
+        'max_concurrent': 16
+    }
+}
+
+
+class RateLimiter(object):
+    """
+    Limits how often, and how many at once, calls can be made to an api.
+    Use as a context manager around each call:
+        with get_limiter('moz'):
+            response = requests.get(...)
+    """
+    def __init__(self, min_interval=0, max_concurrent=1, name=None):
+        """
+        Initialize the RateLimiter.
+        :param min_interval: minimum seconds between the starts of two calls
+        :param max_concurrent: maximum number of simultaneous calls
+        :param name: the api name, under which time slept is recorded in the
+        run's metrics
+        """
+        self.name = name
+        self.min_interval = min_interval
+        self.max_concurrent = max_concurrent
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self):
+        """
+        Block until a call is permitted by min_interval.
+        :return: the number of seconds spent sleeping
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.min_interval
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        get_metrics().add_sleep(self.name, self.wait())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._semaphore.release()
+        return False
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """
+    Return the process-wide RateLimiter for name, creating it if needed.
+    :param name: the api name, e.g. 'moz', 'twitter' or 'scrape_newest'
+    :return: a RateLimiter object shared by all threads
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            limits = dict(DEFAULT_LIMITS.get(name, {}))
+            limits.update(get_setting('rate_limits', {}).get(name, {}))
+            if replaying():
+                # Replayed responses don't reach the api, so there's no
+                # need to space the calls out.
+                limits['min_interval'] = 0
+            _limiters[name] = RateLimiter(name=name, **limits)
+        return _limiters[name]
+
+
+class ApiBudget(object):
+    """
+    A process-wide budget of calls to an api which limits calls per time
+    window (e.g. Twitter's search api allows 180 calls per 15 minutes).
+    Every call, from every site, first calls acquire(), which returns at once
+    while there's budget left, and otherwise sleeps exactly until the window
+    resets. After each call, update() syncs the budget with the api's
+    rate-limit headers, which are the source of truth.
+    """
+    def __init__(self, limit, window_seconds, remaining_header,
+                 reset_header, name=None):
+        """
+        Initialize the ApiBudget.
+        :param limit: the number of calls allowed per window
+        :param window_seconds: the length of the window, used until the api
+        reports the actual reset time
+        :param remaining_header: the response header with the number of
+        calls remaining in the window
+        :param reset_header: the response header with the unix time at which
+        the window resets
+        :param name: the api name, under which time slept is recorded in the
+        run's metrics
+        """
+        self.name = name
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.remaining_header = remaining_header
+        self.reset_header = reset_header
+        self.remaining = limit
+        self.reset_at = None  # unix time when the window resets, if known
+        self.slept_seconds = 0.0  # total time spent waiting for resets
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Take one call from the budget, sleeping until the window resets if
+        the budget is used up.
+        :return: the number of seconds spent sleeping
+        """
+        slept = 0.0
+        with self._condition:
+            while True:
+                now = time.time()
+                if self.reset_at is not None and now >= self.reset_at:
+                    # The window has reset, so the full budget is available.
+                    self.remaining = self.limit
+                    self.reset_at = None
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    self.slept_seconds += slept
+                    get_metrics().add_sleep(self.name, slept)
+                    return slept
+                if self.reset_at is None:
+                    # Out of budget without a known reset time (e.g. no
+                    # headers yet), so assume a full window from now.
+                    self.reset_at = now + self.window_seconds
+                delay = self.reset_at - now
+                print('rate limit: sleeping {d:.0f} seconds until the window '
+                      'resets'.format(d=delay))
+                self._condition.wait(delay)
+                slept += time.time() - now
+
+    def update(self, headers):
+        """
+        Sync the budget with an api response's rate-limit headers.
+        :param headers: the response headers (dict-like)
+        :return: doesn't return anything
+        """
+        if self.remaining_header is None:
+            return  # the budget isn't synced with the api (e.g. replaying)
+        try:
+            remaining = int(headers[self.remaining_header])
+            reset_at = float(headers[self.reset_header])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._condition:
+            if self.reset_at is None or reset_at > self.reset_at:
+                # A new window: the api's count is the new budget.
+                self.remaining = remaining
+                self.reset_at = reset_at
+            else:
+                # Other calls may be in flight, so only ever lower the count.
+                self.remaining = min(self.remaining, remaining)
+            self._condition.notify_all()
+
+
+# Default call budgets per api. These can be overridden in app_config.json
+# with an "api_budgets" key, e.g. {"api_budgets": {"twitter": {"limit": 450}}}
+# (the window's actual reset time is always taken from the api's headers).
+DEFAULT_BUDGETS = {
+    'twitter': {
+        'limit': 180,
+        'window_seconds': 900,
+        'remaining_header': 'x-rate-limit-remaining',
+        'reset_header': 'x-rate-limit-reset'
+    }
+}
+
+_budgets = {}
+
+
+def get_budget(name):
+    """
+    Return the process-wide ApiBudget for name, creating it if needed.
+    :param name: the api name, e.g. 'twitter'
+    :return: an ApiBudget object shared by all threads
+    """
+    with _limiters_lock:
+        if name not in _budgets:
+            budget = dict(DEFAULT_BUDGETS[name])
+            budget.update(get_setting('api_budgets', {}).get(name, {}))
+            if replaying():
+                # Replayed calls don't use up the api's budget, and the
+                # replayed rate-limit headers are out of date.
+                budget.update(limit=sys.maxsize, remaining_header=None,
+                              reset_header=None)
+            _budgets[name] = ApiBudget(name=name, **budget)
+        return _budgets[name]
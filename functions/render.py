@@ -0,0 +1,206 @@
+"""
+Rendering of the sites table to static HTML pages.
+
+The templates are read and split once: sites.html is cut at its
+{table_rows} placeholder into a head and a tail, and table_row.html is kept
+for formatting each row (with '-' for missing values, e.g. a failed api
+call's None payloads). Each page is then written straight to its output
+file, row by row, so that no page-sized string is ever built in memory and
+the time to render grows linearly with the number of sites.
+
+When there are thousands of sites, the table can be sharded:
+    - 'page': pages of page_size rows (index.html, page-2.html, ...)
+    - 'project': one page per site.project (project-<project>.html), with an
+      empty index.html linking to each project's page
+"""
+import datetime
+import functools
+import itertools
+import os
+import re
+import string
+from config import get_setting
+from error_handling import handle_error
+from sort_orders import row_sort_keys, sort_orders_json
+from tracing import span
+
+TEMPLATE_DIR = '../templates'
+OUTPUT_DIR = '../output'
+SHARD_MODES = (None, 'page', 'project')
+DEFAULT_PAGE_SIZE = 1000
+ROWS_PLACEHOLDER = '{table_rows}'
+MISSING_VALUE = '-'
+
+
+class RowFormatter(string.Formatter):
+    """
+    Formats a row like str.format, except that None values (which can't take
+    format specs such as ':,') are shown as MISSING_VALUE.
+    """
+    def format_field(self, value, format_spec):
+        if value is None:
+            return MISSING_VALUE
+        return super().format_field(value, format_spec)
+
+
+class Templates(object):
+    """
+    The page and row templates, read and prepared once for many pages.
+    """
+    def __init__(self, template_dir=TEMPLATE_DIR):
+        """
+        Read the templates from template_dir.
+        :param template_dir: the directory with sites.html and table_row.html
+        """
+        with open(os.path.join(template_dir, 'sites.html'), 'r') as fo:
+            page_template = fo.read()
+        with open(os.path.join(template_dir, 'table_row.html'), 'r') as fo:
+            self.format_row = functools.partial(RowFormatter().format,
+                                                fo.read())
+        self.page_head, self.page_tail = page_template.split(ROWS_PLACEHOLDER)
+
+
+def write_page(filename, sites, templates, first_rank=1, page_vars=None,
+               ranks=None):
+    """
+    Write one page of the sites table to filename, one row at a time. The
+    rows' sort keys are collected as they're written, and each column's
+    sort order is embedded after the table (see sort_orders.py).
+    :param filename: the path of the HTML file to write
+    :param sites: an iterable of Site objects, in rank order
+    :param templates: a Templates object
+    :param first_rank: the rank of the first site on the page
+    :param page_vars: the values for the page template's placeholders
+    (last_updated and pages_nav)
+    :param ranks: optional iterable of the sites' ranks, for pages whose
+    ranks aren't consecutive; defaults to counting up from first_rank
+    :return: the number of rows written
+    """
+    if ranks is None:
+        ranks = itertools.count(first_rank)
+    rows_keys = []
+    with open(filename, 'w') as fo:
+        fo.write(templates.page_head.format(**page_vars))
+        for rank, site in zip(ranks, sites):
+            try:
+                row = templates.format_row(site=site, rank=rank)
+            except (AttributeError, KeyError, IndexError, TypeError,
+                    ValueError) as e:
+                # e.g. a site whose directives haven't succeeded yet
+                handle_error(
+                    exc=type(e),
+                    err=e,
+                    msg='could not render row for "{t}"'.format(
+                        t=getattr(site, 'title', None)
+                    )
+                )
+                continue
+            fo.write(row)
+            rows_keys.append(row_sort_keys(site, rank))
+        fo.write(templates.page_tail.format(
+            sort_orders=sort_orders_json(rows_keys),
+            **page_vars
+        ))
+    return len(rows_keys)
+
+
+def pages_nav(links, current=None):
+    """
+    Make the links between a sharded table's pages.
+    :param links: a list of (filename, label) tuples
+    :param current: the filename of the page being written
+    :return: an HTML str (empty if there's only one page)
+    """
+    if len(links) < 2:
+        return ''
+    items = []
+    for filename, label in links:
+        if filename == current:
+            items.append('<strong>{l}</strong>'.format(l=label))
+        else:
+            items.append('<a href="{f}">{l}</a>'.format(f=filename, l=label))
+    return '<p class="pagesNav">' + ' | '.join(items) + '</p>'
+
+
+def project_filename(project):
+    """
+    Make a safe filename for a project's page.
+    :param project: the project name (str)
+    :return: a filename like "project-<project>.html"
+    """
+    return 'project-{p}.html'.format(
+        p=re.sub(r'[^\w-]+', '_', str(project)).strip('_')
+    )
+
+
+def render_sites(sites, output_dir=OUTPUT_DIR, template_dir=TEMPLATE_DIR,
+                 shard_by=None, page_size=None):
+    """
+    Render the sites table to one or more HTML pages.
+    :param sites: a list of Site objects, in rank order (so each site's rank
+    is its position in the list)
+    :param output_dir: the directory to write the pages to
+    :param template_dir: the directory with the templates
+    :param shard_by: None (one page), 'page' or 'project'; defaults to the
+    "render_shard_by" setting in app_config.json
+    :param page_size: the number of rows per page when shard_by is 'page';
+    defaults to the "render_page_size" setting, or 1000
+    :return: a list of the filenames written
+    """
+    if shard_by is None:
+        shard_by = get_setting('render_shard_by', None)
+    if page_size is None:
+        page_size = get_setting('render_page_size', DEFAULT_PAGE_SIZE)
+    if shard_by not in SHARD_MODES:
+        raise ValueError('unknown render_shard_by {s}; expected one of '
+                         '{o}'.format(s=shard_by, o=SHARD_MODES))
+    templates = Templates(template_dir)
+    last_updated = datetime.datetime.utcnow().strftime(
+        '%A %B %-d, %Y at %-I:%M %p GMT (UTC)'
+    )
+
+    # shards is a list of (filename, label, sites, ranks) tuples.
+    if shard_by == 'page':
+        shards = [
+            (
+                'index.html' if start == 0 else
+                'page-{n}.html'.format(n=start // page_size + 1),
+                str(start // page_size + 1),
+                sites[start:start + page_size],
+                range(start + 1, start + page_size + 1)
+            )
+            for start in range(0, max(len(sites), 1), page_size)
+        ]
+    elif shard_by == 'project':
+        projects = {}
+        for rank, site in enumerate(sites, start=1):
+            project = projects.setdefault(getattr(site, 'project', ''),
+                                          ([], []))
+            project[0].append(site)
+            project[1].append(rank)
+        # index.html only links to the projects' pages. Each project's sites
+        # keep their overall ranks.
+        shards = [('index.html', 'projects', [], [])] + [
+            (project_filename(project), project, project_sites, ranks)
+            for project, (project_sites, ranks) in sorted(projects.items())
+        ]
+    else:
+        shards = [('index.html', 'all', sites, itertools.count(1))]
+
+    links = [(filename, label) for filename, label, _, _ in shards]
+    written = []
+    for filename, label, shard_sites, ranks in shards:
+        path = os.path.join(output_dir, filename)
+        with span('render', page=filename, rows=len(shard_sites)):
+            write_page(
+                filename=path,
+                sites=shard_sites,
+                templates=templates,
+                page_vars={
+                    'last_updated': last_updated,
+                    'pages_nav': pages_nav(links, current=filename)
+                },
+                ranks=ranks
+            )
+        written.append(path)
+    return written
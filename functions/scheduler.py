@@ -0,0 +1,265 @@
+"""
+Staleness-driven scheduling of which directives to refresh in a run.
+
+Each directive type has a refresh interval (e.g. Moz's index only changes
+about monthly, while tweets are counted daily), which a directive can
+override with its own "refresh_interval". A directive is due once its newest
+value's 'accessed' timestamp (as saved by make_dict) is older than that, or
+if its last refresh failed.
+
+The due directives are then planned against the apis' budgets:
+    - Moz: the rows left in this month's quota ("moz_monthly_rows", less
+      the rows already sent this month, as counted by moz_usage.py)
+    - Twitter: the calls in the rate-limit windows that the run may use
+      (see rate_limit.DEFAULT_BUDGETS)
+by taking the due directives in order of priority, until a budget runs out.
+Priority is the directive's staleness, weighted up for sites with higher
+composite scores (see ranking.py) and for directives whose values changed
+at their last refresh (volatile ones).
+
+Moz's results are cached between runs (see moz_cache.py), but a scheduled
+Moz refresh is only due once its value is about as old as the cache's TTL,
+so scheduled refreshes skip the cache: otherwise a due directive would get
+the same old result back, with a new 'accessed' time, and real Moz data
+would only be retrieved every other interval.
+"""
+import datetime
+from types import SimpleNamespace
+import numpy as np
+from config import get_setting
+from data_functions import LATEST_ONLY_DATA_NAMES, latest_payload
+from moz_usage import get_moz_usage
+from ranking import DEFAULT_WEIGHTS, METRICS, composite_scores, load_metrics
+from rate_limit import get_budget
+
+# Default refresh intervals per directive type, in seconds. These can be
+# overridden in app_config.json with a "refresh_intervals" key.
+DEFAULT_INTERVALS = {
+    'moz': 30 * 24 * 60 * 60,
+    'twitter': 24 * 60 * 60,
+    'scrape_newest': 24 * 60 * 60
+}
+# Runs are scheduled at about the same time each day, so a directive is due
+# this many seconds before its interval is quite up.
+DEFAULT_SLACK_SECONDS = 60 * 60
+DEFAULT_MOZ_MONTHLY_ROWS = 20000  # see moz.py
+MAX_STALENESS = 10.0  # the staleness of a directive with no values yet
+TWEETS_PER_PAGE = 100
+# Statuses of values which were retrieved, but hadn't changed.
+UNCHANGED_STATUSES = ('unchanged', 'not modified', 'ok (cached)')
+# Statuses of values which were retrieved; any other status (e.g. an error
+# message) means the refresh failed.
+OK_STATUSES = ('ok',) + UNCHANGED_STATUSES
+ACCESSED_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def parse_accessed(accessed):
+    """
+    Parse an 'accessed' timestamp as saved by make_dict.
+    :param accessed: a str like '2018-04-24T03:07:00+0000'
+    :return: a datetime object (in UTC), or None if it can't be parsed
+    """
+    try:
+        return datetime.datetime.strptime(accessed[:19], ACCESSED_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def latest_values(branch):
+    """
+    Find the newest dict of each data_name in a directive's data branch.
+    :param branch: a directive's data branch, or None
+    :return: a list of dicts (as made by make_dict)
+    """
+    values = []
+    for data_name, dicts in (branch or {}).items():
+        if data_name not in LATEST_ONLY_DATA_NAMES and dicts:
+            values.append(dicts[0])
+    return values
+
+
+class Scheduler(object):
+    """
+    Plans which of the sites' directives to refresh in a run.
+    """
+    def __init__(self, intervals=None, slack_seconds=None,
+                 moz_monthly_rows=None, twitter_windows=None, now=None):
+        """
+        Initialize the Scheduler.
+        :param intervals: a dict of refresh intervals per directive type;
+        defaults to DEFAULT_INTERVALS, updated by the "refresh_intervals"
+        setting in app_config.json
+        :param slack_seconds: how long before its interval is up that a
+        directive is due; defaults to the "refresh_slack_seconds" setting
+        :param moz_monthly_rows: the Moz rows allowed per calendar month;
+        defaults to the "moz_monthly_rows" setting, or 20000
+        :param twitter_windows: the number of Twitter rate-limit windows
+        which a run may use; defaults to the "twitter_windows_per_run"
+        setting, or 1
+        :param now: the time (UTC datetime) of the run
+        """
+        self.intervals = dict(DEFAULT_INTERVALS)
+        self.intervals.update(intervals or
+                              get_setting('refresh_intervals', {}))
+        if slack_seconds is None:
+            slack_seconds = get_setting('refresh_slack_seconds',
+                                        DEFAULT_SLACK_SECONDS)
+        if moz_monthly_rows is None:
+            moz_monthly_rows = get_setting('moz_monthly_rows',
+                                           DEFAULT_MOZ_MONTHLY_ROWS)
+        if twitter_windows is None:
+            twitter_windows = get_setting('twitter_windows_per_run', 1)
+        self.slack_seconds = slack_seconds
+        self.moz_monthly_rows = moz_monthly_rows
+        self.twitter_windows = twitter_windows
+        self.now = now or datetime.datetime.utcnow()
+        self.stats = {
+            'directives': 0,
+            'due': 0,
+            'planned': 0,
+            'deferred': 0
+        }
+
+    def interval(self, directive):
+        """
+        :param directive: a directive (dict) from a site's directives
+        :return: the directive's refresh interval, in seconds
+        """
+        try:
+            return int(directive['refresh_interval'])
+        except (KeyError, TypeError, ValueError):
+            return self.intervals.get(directive.get('type'), 0)
+
+    def staleness(self, directive, branch):
+        """
+        Measure how overdue a directive is.
+        :param directive: a directive (dict) from a site's directives
+        :param branch: the directive's data branch
+        :return: the age of its newest value divided by its interval (so 1
+        or more is due), MAX_STALENESS if it has no values or its last
+        refresh failed
+        """
+        values = latest_values(branch)
+        if not values or any(value.get('status') not in OK_STATUSES
+                             for value in values):
+            return MAX_STALENESS  # never refreshed, or failed
+        accessed = [parse_accessed(value.get('accessed'))
+                    for value in values]
+        if None in accessed:
+            return MAX_STALENESS
+        age = (self.now - max(accessed)).total_seconds() + self.slack_seconds
+        interval = self.interval(directive)
+        if interval <= 0:
+            return MAX_STALENESS
+        return min(age / interval, MAX_STALENESS)
+
+    @staticmethod
+    def volatility(branch):
+        """
+        :param branch: a directive's data branch
+        :return: the share (0-1) of its newest values which had changed at
+        their last refresh (1 if there are none)
+        """
+        values = latest_values(branch)
+        if not values:
+            return 1.0
+        changed = sum(1 for value in values
+                      if value.get('status') not in UNCHANGED_STATUSES)
+        return changed / len(values)
+
+    def twitter_cost(self, branch):
+        """
+        Estimate the number of search api calls needed to refresh a twitter
+        directive, from the busiest day in its rolling state.
+        :param branch: the directive's data branch
+        :return: the number of calls (int >= 1)
+        """
+        state = latest_payload(branch, 'twitter_state') or {}
+        tweets_per_day = max(
+            [int(count) for count in state.get('days', {}).values()] or [0]
+        )
+        return 1 + tweets_per_day // TWEETS_PER_PAGE
+
+    def moz_rows_used(self):
+        """
+        :return: the number of Moz rows sent so far in this run's calendar
+        month (see moz_usage.py)
+        """
+        return get_moz_usage().rows(self.now)
+
+    def budgets(self, items):
+        """
+        :param items: sites as dicts, as retrieved from DynamoDB
+        :return: a dict of the calls/rows left per directive type (types
+        which aren't listed are unlimited)
+        """
+        return {
+            'moz': max(0, self.moz_monthly_rows - self.moz_rows_used()),
+            'twitter': get_budget('twitter').limit * self.twitter_windows
+        }
+
+    def site_scores(self, items):
+        """
+        Compute each site's composite score (0-1) from its current data.
+        :param items: sites as dicts, as retrieved from DynamoDB
+        :return: a float array of scores, aligned with items
+        """
+        sites = [SimpleNamespace(data=item.get('data', {}),
+                                 directives=item.get('directives', {}))
+                 for item in items]
+        weights = dict(DEFAULT_WEIGHTS)
+        weights.update(get_setting('ranking_weights', {}))
+        current, previous = load_metrics(sites, METRICS)
+        scores, _, _ = composite_scores(
+            current, previous,
+            np.array([float(weights.get(name, 0)) for name in METRICS]),
+            np.array([log_scaled for _, _, log_scaled in METRICS.values()])
+        )
+        return scores
+
+    def plan(self, items):
+        """
+        Decide which directives of which sites to refresh in this run.
+        :param items: sites as dicts, as retrieved from DynamoDB
+        :return: a list of sets of directive names, aligned with items
+        """
+        scores = self.site_scores(items)
+        budgets = self.budgets(items)
+        # candidates are (priority, item index, directive name, d_type, cost)
+        candidates = []
+        for i, item in enumerate(items):
+            data = item.get('data', {})
+            for name, directive in item.get('directives', {}).items():
+                self.stats['directives'] += 1
+                branch = data.get(name)
+                staleness = self.staleness(directive, branch)
+                if staleness < 1:
+                    continue
+                self.stats['due'] += 1
+                priority = staleness * (1 + scores[i]) * \
+                    (1 + self.volatility(branch))
+                d_type = directive.get('type')
+                if d_type == 'twitter':
+                    cost = self.twitter_cost(branch)
+                else:
+                    cost = 1
+                candidates.append((priority, i, name, d_type, cost))
+
+        plan = [set() for _ in items]
+        moz_targets = set()  # targets in the plan (each costs one row)
+        candidates.sort(key=lambda candidate: -candidate[0])
+        for _, i, name, d_type, cost in candidates:
+            if d_type == 'moz':
+                target = items[i]['directives'][name]['parameters']
+                cost = 0 if target in moz_targets else cost
+            if d_type in budgets:
+                if cost > budgets[d_type]:
+                    self.stats['deferred'] += 1
+                    continue
+                budgets[d_type] -= cost
+            if d_type == 'moz':
+                moz_targets.add(target)
+            plan[i].add(name)
+            self.stats['planned'] += 1
+        return plan
+
@@ -1,15 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import datetime
 from decimal import Decimal
 import json
-from data_functions import (prune_empty_branches, setup_data_branch,
+from traceback import format_exception
+from config import get_setting
+from data_functions import (LATEST_ONLY_DATA_NAMES, make_dict,
+                            prune_empty_branches, setup_data_branch,
                             unpack_and_save_list)
-from dynamodb import Dynamo
-from error_handling import handle_error
+from error_handling import error_context, handle_error
 from html_parse import scrape_newest
 # from json_functions import json_to_object
-from moz import moz_search
-from s3 import S3
-from twitter import twitter_search
+from metrics import API_HOSTS, observe_response, outcome
+from moz import moz_batch_search, moz_search
+from tracing import span
+from twitter import twitter_batch_search, twitter_search
 from url_functions import generate_filename, tidy_url
 
 
@@ -35,12 +40,27 @@ class Site(object):
     # def __getitem__(self, items):
     #     print('{i}'.format(i=items))
 
+    # Attributes which only matter while running, and so aren't saved to
+    # DynamoDB (attributes starting with '_' aren't saved either).
+    RUNTIME_ATTRIBUTES = ('test_mode', 'new_records', 'deltas')
+    # The values which each type of directive's function returns, and which
+    # are saved with an error status if the function raises (see
+    # call_directive). Rolling state (e.g. twitter_state) is left as it was.
+    DATA_NAMES = {
+        'moz': ('mozrank', 'authority'),
+        'scrape_newest': ('a_link_text', 'a_link_url'),
+        'twitter': ('tweets', 'tweets_followers', 'most_followed_name',
+                    'most_followed_count')
+    }
+
     def __init__(self, site_dict):
         """
-        Instantiate a Site object.
+        Instantiate a Site object from its existing config and data. This
+        has no side effects (no scraping or api calls), so a Site can be
+        created for testing or re-rendering; call refresh() (or fetch() and
+        then merge()) to retrieve its latest data.
         :param site_dict: a dict with Site's existing config and data
         """
-        time_start = datetime.datetime.utcnow()
         # Copy site_dict keys to Site keys.
         try:
             self.__dict__.update(site_dict)
@@ -52,7 +72,15 @@ class Site(object):
             raise ValueError('could not create Site with JSON: {j}'.format(
                 j=site_dict
             ))
-        self.test_mode = False  # test_mode caches HTML; False means no cache
+        # Keep an untouched copy of the item this Site was loaded from, so
+        # that only what has changed needs to be written back to DynamoDB.
+        self._loaded_item = copy.deepcopy(site_dict)
+        # test_mode caches each page's HTML in html_cached_files (cassettes.py
+        # records and replays every source's responses instead).
+        self.test_mode = get_setting('test_mode', False)
+        # (directive, dict) tuples of every value retrieved during this run,
+        # to be written to the history table (see history.py).
+        self.new_records = []
 
         # Clean and establish default self.url values if not already present.
         self.url = tidy_url(self.url)
@@ -72,6 +100,33 @@ class Site(object):
             directives_dict=self.directives
         )
 
+    def refresh(self, prefetched=None):
+        """
+        Follow all of the Site's directives and save the results to
+        self.data.
+        :param prefetched: optional dict of directive results which were
+        already retrieved in bulk for many sites (see prefetch_directives).
+        :return: the Site itself
+        """
+        self.merge(self.fetch(prefetched))
+        return self
+
+    def fetch(self, prefetched=None, due=None):
+        """
+        Follow the directives (to scrape and ping apis), without changing
+        self.data. The time this takes is saved as self.elapsed_seconds.
+        :param prefetched: optional dict of directive results which were
+        already retrieved in bulk for many sites (see prefetch_directives).
+        It's keyed by directive type and then by directive_key(params).
+        Directives found in prefetched are not called again. The rest are
+        followed at the same time, up to the "directive_workers" setting in
+        app_config.json at once (1 follows them one at a time).
+        :param due: optional set of the names of the directives to follow
+        (see scheduler.py); by default, all of them are followed
+        :return: a dict of directive name: list of dict(s) returned by the
+        directive's function
+        """
+        time_start = datetime.datetime.utcnow()
         # directives_map holds instructions of how to handle the different
         # types of directives: which function to call and which parameters
         # to pass to that function. This enables, below, to make a single loop
@@ -81,6 +136,9 @@ class Site(object):
                 'func': moz_search,
                 'params_to_pass': {
                     'params': 'this will be replaced with params',
+                    # A scheduled refresh is due because the value is old,
+                    # so a cached copy of it won't do (see scheduler.py).
+                    'use_cache': due is None
                 }
             },
             'scrape_newest': {
@@ -88,37 +146,137 @@ class Site(object):
                 'params_to_pass': {
                     'url': self.url,
                     'params': 'this will be replaced with params',
-                    'test_mode': self.test_mode
+                    'test_mode': self.test_mode,
+                    'previous': 'this will be replaced with data branch'
                 }
             },
             'twitter': {
                 'func': twitter_search,
                 'params_to_pass': {
                     'params': 'this will be replaced with params',
+                    'previous': 'this will be replaced with data branch'
                 }
             }
         }
 
-        # Follow all the directives (to scrape and ping apis) and save all
-        # the collected data into the proper locations within self.data
         # TODO: handle errors here in case of incomplete/incorrect directives
+        responses = {}
+        hosts = {}  # directive name: where its data comes from
+        # calls are (directive, d_type, host, func, params_to_pass) tuples of
+        # the directives which weren't prefetched.
+        calls = []
         for directive in self.directives:
-            start_time = datetime.datetime.utcnow()
+            if due is not None and directive not in due:
+                continue
             params = self.directives[directive]["parameters"]
             # d_type points to the top-level key within directives_map (e.g.
             # 'moz', 'twitter', 'scrape_newest')
             d_type = self.directives[directive]['type']
-            # Save the relevant value from the "parameters" key in
-            # self.directives to the relevant 'params' key in directives_map.
-            directives_map[d_type]['params_to_pass']['params'] = params
+            # host is where the directive's data comes from
+            host = self.url['domain'] if d_type == 'scrape_newest' \
+                else API_HOSTS.get(d_type)
+            hosts[directive] = host
+            # If this directive's results were already retrieved in bulk,
+            # use a copy of those rather than calling func again.
+            try:
+                responses[directive] = [
+                    dict(d) for d in
+                    prefetched[d_type][directive_key(params)]
+                ]
+                continue
+            except (TypeError, KeyError):
+                pass
+            # Copy the relevant params_to_pass from directives_map, with the
+            # value from the "parameters" key in self.directives as 'params'
+            # (a copy, since the directives may run at the same time).
+            params_to_pass = dict(directives_map[d_type]['params_to_pass'],
+                                  params=params)
+            # Functions which build on their previous results (e.g.
+            # conditional scraping) also get the directive's data branch.
+            if 'previous' in params_to_pass:
+                params_to_pass['previous'] = self.data[directive]
             # func is the function to be called
             func = directives_map[d_type]['func']
-            # params_to_pass are the parameters to pass to func
-            params_to_pass = directives_map[d_type]['params_to_pass']
-            # Call func, passing in params_to_pass and start_time, which is
-            # used to calculate how long func took to run. response will be
-            # a list of dict(s).
-            response = func(**params_to_pass, start_time=start_time)
+            calls.append((directive, d_type, host, func, params_to_pass))
+
+        # Each api has its own rate limiter, so the directives can be
+        # followed at the same time without exceeding any api's limits.
+        workers = min(len(calls), get_setting('directive_workers', 1))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for directive, response in executor.map(
+                        lambda call: self.call_directive(*call), calls):
+                    responses[directive] = response
+        else:
+            for call in calls:
+                directive, response = self.call_directive(*call)
+                responses[directive] = response
+        # Keep the responses in the order of the directives.
+        responses = {directive: responses[directive] for directive in hosts}
+        called = {call[0] for call in calls}
+
+        for directive, response in responses.items():
+            # Report a failed directive's error, so that the ErrorReporter
+            # counts it by host and directive (see error_handling.py).
+            report_failure(
+                d_type=self.directives[directive]['type'],
+                directive=directive,
+                host=hosts[directive],
+                response=response
+            )
+            if directive not in called:
+                continue  # observed once per batch, by prefetch_directives
+            # Record the directive's latency and outcome (see metrics.py).
+            observe_response(
+                d_type=self.directives[directive]['type'],
+                host=hosts[directive],
+                response=response
+            )
+        time_end = datetime.datetime.utcnow()
+        self.elapsed_seconds = Decimal(
+            str((time_end - time_start).total_seconds())
+        )
+        return responses
+
+    def call_directive(self, directive, d_type, host, func, params_to_pass):
+        """
+        Follow a single directive, by calling its function. If the function
+        raises, its values are saved with the error as their status (as the
+        directive functions do for the errors they expect), so that the
+        Site's other directives are still saved and rendered.
+        :param directive: the directive's name, e.g. 'scrape1'
+        :param d_type: the directive's type, e.g. 'scrape_newest'
+        :param host: where the directive's data comes from
+        :param func: the function to call
+        :param params_to_pass: the parameters to pass to func
+        :return: a tuple of (directive, list of dict(s) returned by func)
+        """
+        # start_time is passed to func, and is used to calculate how long
+        # func took to run.
+        start_time = datetime.datetime.utcnow()
+        with span('directive', type=d_type, directive=directive,
+                  site=getattr(self, 'title', None)), \
+                error_context(host=host, directive=directive):
+            try:
+                return directive, func(**params_to_pass,
+                                       start_time=start_time)
+            except Exception as e:
+                error = format_exception(type(e), e, e.__traceback__)
+                return directive, [
+                    make_dict(value=None, data_name=data_name,
+                              start_time=start_time, status=error)
+                    for data_name in self.DATA_NAMES.get(d_type, ())
+                ]
+
+    def merge(self, responses):
+        """
+        Save the results of fetch() into the proper locations within
+        self.data.
+        :param responses: a dict as returned by fetch()
+        :return: doesn't return anything
+        """
+        for directive, response in responses.items():
+            self.new_records.extend((directive, d) for d in response)
             # Unpack the list of dicts(s) returned in response and save them
             # to the relevant lists within self.data.
             self.data = unpack_and_save_list(
@@ -131,68 +289,184 @@ class Site(object):
         # exist. This is needed because DynamoDB can't save empty strings
         # as dict values.
         self.data = prune_empty_branches(self.data)
-        time_end = datetime.datetime.utcnow()
-        self.elapsed_seconds = Decimal(
-            str((time_end - time_start).total_seconds())
-        )
+
+    def to_item(self):
+        """
+        Returns the Site as a dict to be saved to DynamoDB, without its
+        runtime and private attributes.
+        :return: a dict
+        """
+        return {
+            key: value for key, value in vars(self).items()
+            if not key.startswith('_') and key not in self.RUNTIME_ATTRIBUTES
+        }
 
 
-def load_sites(dynamo_session):
+class SiteSummary(object):
     """
-    Load Dynamo data and instantiate site objects (with scraping & api calls).
-    :param site_items: sites as a list of dicts
-    :param dynamo_session: a session (connection) to DynamoDB
-    :return: a list of site objects.
+    The small part of a Site which ranking and rendering use, so that a run
+    needn't keep every Site (with its values' history and state) until all
+    of them have been refreshed: its key, title, project, url and the newest
+    payload of each value.
     """
-    site_objects = []
-    items = dynamo_session.get_all_rows(
-        table_name='sites'
-    )
-    # Turn the DynamoDB rows about the sites into a list of Site objects.
-    for item in items:
-        try:
-            site_obj = Site(item)
-        except ValueError as err:
-            handle_error(err=err)
-        site_objects.append(site_obj)
-    return site_objects
-
-# TODO: Move the lines below (for '__main__') to 1 or 2 functions.
-if __name__ == '__main__':
-    dynamo = Dynamo(
-        profile_name='top-sites'
-    )
-    sites = load_sites(dynamo)
-
-    # Format one copy of table_row.html per each Site object in sites and
-    # concatenate all of the table rows into table_rows_html.
-    with open('../templates/table_row.html', 'r') as fo:
-        site_template = fo.read()
-    table_rows_html = ''
-    for position, site in enumerate(sites):
-        table_rows_html += site_template.format(site=site, rank=position + 1)
-
-    # Then format sites.html by inserting all of the table rows into the
-    # appropriate place within sites.html.
-    with open('../templates/sites.html', 'r') as fo:
-        html_page = fo.read()
-    now = datetime.datetime.utcnow().strftime(
-        '%A %B %-d, %Y at %-I:%M %p GMT (UTC)'
-    )
-    html_page = html_page.format(table_rows=table_rows_html, last_updated=now)
-
-    # Finally, save html_page as index.html. Later, instead of saving this
-    # file locally, it will instead be uploaded to an S3 bucket/folder.
-    with open('../output/index.html', 'w') as fo:
-        fo.write(html_page)
-
-    # Upload file to S3
-    s3 = S3()
-    result = s3.upload_file_public_read(file='foo')
-    print(result)
-
-    # Write the site objects back to DynamoDB
-    result = dynamo.batch_update_rows(
-        table_name='sites',
-        items=sites
-    )
+    def __init__(self, site, key_names=()):
+        """
+        Summarize a Site.
+        :param site: a Site object
+        :param key_names: the names of the sites table's key attributes
+        """
+        self.key = {name: getattr(site, name) for name in key_names}
+        self.title = getattr(site, 'title', None)
+        self.project = getattr(site, 'project', None)
+        self.url = site.url
+        # The rank and score as stored, until the summary is ranked.
+        self.rank = getattr(site, 'rank', None)
+        self.score = getattr(site, 'score', None)
+        self.stored_ranking = (self.rank, self.score)
+        self.data = {
+            directive: {
+                data_name: [{'payload': values[0].get('payload')}]
+                for data_name, values in branch.items()
+                if data_name not in LATEST_ONLY_DATA_NAMES and values
+            }
+            for directive, branch in site.data.items()
+        }
+
+    def ranking_changed(self):
+        """
+        :return: True if the rank or score differs from the stored one
+        """
+        return (self.rank, self.score) != self.stored_ranking
+
+
+def directive_key(params):
+    """
+    Make a hashable key from a directive's parameters.
+    :param params: the "parameters" value of a directive (str or list)
+    :return: a str which is the same for identical parameters
+    """
+    return json.dumps(params, sort_keys=True)
+
+
+def report_failure(d_type, directive, host, response):
+    """
+    Report a directive's error status (if it has one) with handle_error.
+    A status which format_exception made is reported as its last line, i.e.
+    the exception's type and message; any other status (e.g. 'moz response
+    was missing pda') is reported as it is.
+    :param d_type: the directive's type, e.g. 'scrape_newest'
+    :param directive: the directive's name, e.g. 'scrape1'
+    :param host: where the directive's data comes from
+    :param response: a list of dicts, as made by make_dict
+    :return: doesn't return anything
+    """
+    if not response or outcome(response[0].get('status')) != 'error':
+        return
+    status = response[0].get('status')
+    exc, err = 'Exception', status
+    if isinstance(status, list):
+        lines = ''.join(status).strip().splitlines() or ['']
+        exc, _, err = lines[-1].partition(': ')
+    handle_error(exc=exc, err=err, msg='{t} directive'.format(t=d_type),
+                 host=host, directive=directive)
+
+
+def observe_batch(d_type, results, start_time):
+    """
+    Record the latency and outcomes of a batched retrieval. Each result
+    carries the whole batch's duration, so each is observed with an equal
+    share of it instead, and the sites which use a copy of a result (see
+    Site.fetch) don't observe it again.
+    :param d_type: the directives' type, e.g. 'moz'
+    :param results: a dict of the batch's results (lists of dicts)
+    :param start_time: the UTC time (as a datetime object) at which the
+    batch began
+    :return: doesn't return anything
+    """
+    if not results:
+        return
+    elapsed = (datetime.datetime.utcnow() - start_time).total_seconds()
+    share = Decimal(str(elapsed / len(results)))
+    for response in results.values():
+        observe_response(d_type=d_type, host=API_HOSTS.get(d_type),
+                         response=response, duration=share)
+
+
+def prefetch_directives(items, due=None):
+    """
+    Retrieve, in bulk, the directive results which can be batched across
+    many sites. All of the sites' moz directives are sent to
+    moz_batch_search, as a few batched POSTs instead of one call per site,
+    and the sites' twitter directives are combined into a few OR'd queries
+    by twitter_batch_search. Twitter directives which can't be combined are
+    left out, so that each Site searches for them itself.
+    :param items: sites as a list of dicts, as retrieved from DynamoDB
+    :param due: optional list (aligned with items) of sets of the names of
+    the directives to retrieve; by default, all of them are retrieved
+    :return: a dict keyed by directive type and then by directive_key(params)
+    whose values are lists of dicts (as returned by the directive functions)
+    """
+    prefetched = {}
+    if get_setting('moz_batch', True):
+        targets = []
+        for i, item in enumerate(items):
+            for name, directive in item.get('directives', {}).items():
+                if due is not None and name not in due[i]:
+                    continue
+                if directive.get('type') == 'moz':
+                    targets.append(directive['parameters'])
+        if targets:
+            start_time = datetime.datetime.utcnow()
+            results = moz_batch_search(
+                targets=targets,
+                start_time=start_time,
+                # (see Site.fetch)
+                use_cache=due is None
+            )
+            observe_batch('moz', results, start_time)
+            prefetched['moz'] = {
+                directive_key(target): response
+                for target, response in results.items()
+            }
+    if get_setting('twitter_batch', True):
+        param_sets = []
+        previous_branches = []
+        for i, item in enumerate(items):
+            for name, directive in item.get('directives', {}).items():
+                if due is not None and name not in due[i]:
+                    continue
+                if directive.get('type') == 'twitter':
+                    param_sets.append(directive['parameters'])
+                    previous_branches.append(
+                        item.get('data', {}).get(name)
+                    )
+        if param_sets:
+            start_time = datetime.datetime.utcnow()
+            results = twitter_batch_search(
+                param_sets=param_sets,
+                start_time=start_time,
+                previous_branches=previous_branches
+            )
+            observe_batch('twitter', results, start_time)
+            prefetched['twitter'] = {
+                directive_key(list(params)): response
+                for params, response in results.items()
+            }
+    return prefetched
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of up to size items, as items arrive.
+    :param iterable: any iterable (e.g. a generator of rows)
+    :param size: the maximum number of items per list
+    :return: yields lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,92 @@
+"""
+Precomputed sort orders for the published sites table.
+
+Rather than having sort_script.js compare the rows' data-* attribute strings
+whenever a column's header is clicked, the render step collects each row's
+sort keys as it writes the row, with numbers kept as numbers. It then embeds
+one permutation per sortable column in the page (as JSON). A permutation
+lists the rows' indices (in the order they were written) in ascending order
+of that column, so sorting in the browser is just applying it (or its
+reverse).
+"""
+import json
+import numpy as np
+from data_functions import latest_payload
+
+# The sortable columns, as (data-* attribute used by sort_script.js, kind,
+# directive, data_name). 'rank' and 'title' come from the row's rank and the
+# Site's title; the rest are the latest payloads in the Site's data.
+SORT_COLUMNS = (
+    ('data-rank', 'number', None, 'rank'),
+    ('data-title', 'text', None, 'title'),
+    ('data-latest-post', 'text', 'scrape1', 'a_link_text'),
+    ('data-mozrank', 'number', 'moz1', 'mozrank'),
+    ('data-authority', 'number', 'moz1', 'authority'),
+    ('data-tweets', 'number', 'twitter1', 'tweets'),
+    ('data-tweets-followers', 'number', 'twitter1', 'tweets_followers'),
+    ('data-most-followed-name', 'text', 'twitter1', 'most_followed_name'),
+    ('data-most-followed-count', 'number', 'twitter1', 'most_followed_count')
+)
+
+
+def row_sort_keys(site, rank):
+    """
+    Find a row's value of each sortable column.
+    :param site: a Site object
+    :param rank: the row's rank
+    :return: a tuple of values, in the order of SORT_COLUMNS (None where the
+    Site doesn't have a value)
+    """
+    data = getattr(site, 'data', {})
+    keys = []
+    for _, kind, directive, data_name in SORT_COLUMNS:
+        if data_name == 'rank':
+            value = rank
+        elif directive is None:
+            value = getattr(site, data_name, None)
+        else:
+            value = latest_payload(data.get(directive), data_name)
+        if kind == 'number':
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                value = None
+        elif value is not None:
+            value = str(value).casefold()
+        keys.append(value)
+    return tuple(keys)
+
+
+def sort_permutations(rows_keys):
+    """
+    Compute each sortable column's ascending sort order. Rows without a
+    value come last, and rows with equal values keep their written order.
+    :param rows_keys: a list of tuples, as returned by row_sort_keys
+    :return: a dict of data-* attribute: list of row indices
+    """
+    permutations = {}
+    columns = list(zip(*rows_keys)) or [()] * len(SORT_COLUMNS)
+    for (attribute, kind, _, _), values in zip(SORT_COLUMNS, columns):
+        if kind == 'number':
+            array = np.array(
+                [np.nan if value is None else value for value in values],
+                dtype=float
+            )
+            # A stable argsort puts nans last.
+            order = np.argsort(array, kind='stable').tolist()
+        else:
+            order = sorted(
+                range(len(values)),
+                key=lambda i: (values[i] is None, values[i] or '')
+            )
+        permutations[attribute] = order
+    return permutations
+
+
+def sort_orders_json(rows_keys):
+    """
+    Format the sort permutations for embedding in a page's <script> tag.
+    :param rows_keys: a list of tuples, as returned by row_sort_keys
+    :return: a JSON str
+    """
+    return json.dumps(sort_permutations(rows_keys), separators=(',', ':'))
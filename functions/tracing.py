@@ -0,0 +1,283 @@
+"""
+Opt-in tracing and profiling of a run.
+
+When the "tracing" setting in app_config.json is enabled, start() begins
+collecting, and stop() writes:
+    - a trace of timed spans (the DynamoDB scan, each directive call,
+      parse_site, rendering and batch_update_rows), per thread, in the
+      Chrome trace event format (open it in chrome://tracing or Perfetto)
+    - optionally, a sampling profile of every thread's stacks, as collapsed
+      stacks ("thread;outer;...;inner count" lines) which flamegraph.pl and
+      speedscope can read
+    - optionally, a cProfile profile of the thread which called start(), as
+      a pstats file (the pipeline's stages run in other threads, which the
+      sampling profile covers)
+    - optionally, tracemalloc's memory use over time (as counters in the
+      trace) and its top allocation sites
+When tracing isn't enabled, span() returns a shared do-nothing context
+manager, so the spans cost almost nothing.
+"""
+import collections
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from config import get_setting
+
+DEFAULT_SETTINGS = {
+    'enabled': False,
+    'trace_file': '../metrics/trace.json',
+    'sample_stacks': True,
+    'stacks_file': '../metrics/stacks.folded',
+    'sample_interval': 0.005,
+    'cprofile': False,
+    'cprofile_file': '../metrics/run.pstats',
+    'tracemalloc': False,
+    'tracemalloc_file': '../metrics/tracemalloc.txt'
+}
+MAX_STACK_DEPTH = 100
+
+
+class NullSpan(object):
+    """
+    The span used when tracing is off: it does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """
+    A timed section of a run, recorded as a Chrome trace "complete" event.
+    """
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_event({
+            'name': self.name,
+            'ph': 'X',
+            'thread': threading.current_thread().name,
+            'ts': self.tracer.microseconds(self.start),
+            'dur': round((end - self.start) * 1e6, 1),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': self.args
+        })
+        return False
+
+
+class Tracer(object):
+    """
+    Collects spans, stack samples and memory samples during a run.
+    """
+    def __init__(self, settings):
+        """
+        Initialize the Tracer.
+        :param settings: a dict like DEFAULT_SETTINGS
+        """
+        self.settings = settings
+        self.origin = time.perf_counter()
+        self.events = []
+        self.stacks = collections.Counter()
+        self.profiler = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def microseconds(self, perf_counter):
+        return round((perf_counter - self.origin) * 1e6, 1)
+
+    def add_event(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def start(self):
+        """
+        Start the profilers and samplers that are enabled in settings.
+        :return: doesn't return anything
+        """
+        if self.settings['tracemalloc']:
+            tracemalloc.start()
+        if self.settings['sample_stacks'] or self.settings['tracemalloc']:
+            self._sampler = threading.Thread(target=self.sample,
+                                             name='tracing-sampler',
+                                             daemon=True)
+            self._sampler.start()
+        if self.settings['cprofile']:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def sample(self):
+        """
+        Runs in its own thread: every sample_interval, count each thread's
+        current stack and, if enabled, record tracemalloc's memory use.
+        :return: doesn't return anything
+        """
+        own_id = threading.get_ident()
+        interval = self.settings['sample_interval']
+        memory_every = max(1, int(0.1 / interval))  # every ~0.1 seconds
+        samples = 0
+        while not self._stop.wait(interval):
+            samples += 1
+            if self.settings['sample_stacks']:
+                names = {thread.ident: thread.name
+                         for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_id:
+                        stack = collapse_stack(frame)
+                        self.stacks[names.get(thread_id, str(thread_id)) +
+                                    ';' + stack] += 1
+            if self.settings['tracemalloc'] and samples % memory_every == 0:
+                current, peak = tracemalloc.get_traced_memory()
+                self.add_event({
+                    'name': 'memory',
+                    'ph': 'C',
+                    'ts': self.microseconds(time.perf_counter()),
+                    'pid': os.getpid(),
+                    'args': {'current': current, 'peak': peak}
+                })
+
+    def stop(self):
+        """
+        Stop collecting, and write the files that are enabled in settings.
+        :return: a list of the filenames written
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        written = []
+
+        filename = self.settings['trace_file']
+        with self._lock:
+            events = list(self.events)
+        # Name each thread's row in the trace (the pipeline's threads have
+        # finished by now, so their names are taken from their spans).
+        names = {event['tid']: event.pop('thread') for event in events
+                 if 'thread' in event}
+        for thread_id, name in names.items():
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                'tid': thread_id, 'args': {'name': name}
+            })
+        write_file(filename, json.dumps({'traceEvents': events},
+                                        default=str))
+        written.append(filename)
+
+        if self.settings['sample_stacks']:
+            filename = self.settings['stacks_file']
+            write_file(filename, ''.join(
+                '{s} {c}\n'.format(s=stack, c=count)
+                for stack, count in self.stacks.most_common()
+            ))
+            written.append(filename)
+        if self.profiler is not None:
+            filename = self.settings['cprofile_file']
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+            self.profiler.dump_stats(filename)
+            written.append(filename)
+        if self.settings['tracemalloc'] and tracemalloc.is_tracing():
+            filename = self.settings['tracemalloc_file']
+            top = tracemalloc.take_snapshot().statistics('lineno')[:50]
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            write_file(filename, 'current: {c} bytes, peak: {p} bytes\n'
+                       .format(c=current, p=peak) +
+                       ''.join('{s}\n'.format(s=stat) for stat in top))
+            written.append(filename)
+        return written
+
+
+def collapse_stack(frame):
+    """
+    Format a thread's stack as collapsed-stack frames, outermost first.
+    :param frame: the thread's current frame
+    :return: a str like "run (pipeline.py);fetch (sites.py)"
+    """
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        frames.append('{f} ({m})'.format(
+            f=code.co_name, m=os.path.basename(code.co_filename)
+        ).replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+def write_file(filename, text):
+    """
+    Write text to filename, creating its directory if needed.
+    :param filename: the file to write
+    :param text: a str
+    :return: doesn't return anything
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+_tracer = None
+
+
+def span(name, **args):
+    """
+    Time a section of the run, if tracing is on:
+        with span('parse_site', url=url):
+            ...
+    :param name: the span's name
+    :param args: details to show with the span (e.g. the site)
+    :return: a context manager
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, args)
+
+
+def start(settings=None):
+    """
+    Start tracing, if the "tracing" setting in app_config.json enables it.
+    :param settings: optional dict to use instead of the setting
+    :return: True if tracing was started, False if not
+    """
+    global _tracer
+    merged = dict(DEFAULT_SETTINGS)
+    merged.update(settings if settings is not None
+                  else get_setting('tracing', {}))
+    if not merged['enabled'] or _tracer is not None:
+        return False
+    _tracer = Tracer(merged)
+    _tracer.start()
+    return True
+
+
+def stop():
+    """
+    Stop tracing and write its files.
+    :return: a list of the filenames written (empty if tracing was off)
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return []
+    return tracer.stop()
@@ -0,0 +1,207 @@
+"""
+Bounded-memory, streaming aggregation of tweets from the search api.
+
+TweetTally (in twitter.py) keeps a dict entry for every unique tweeter, so
+that it can save a rolling state between runs. For very high-volume keywords
+that costs a lot of memory. TweetAggregator instead updates the count, the
+unique tweeters' follower sum and the top tweeter as each tweet arrives, and
+only remembers which user ids it has already seen:
+    - exactly, in an IdSet (an open-addressing hash set of 64-bit ids in a
+      flat array, i.e. 16 bytes per tweeter rather than a dict entry, a str
+      and a list), or
+    - approximately, in a BloomIdSet of fixed size. A false positive means
+      that a new tweeter is taken for one already seen, so the follower sum
+      can be slightly low, but memory never grows.
+For a run without a rolling state, the exact mode gives the same results as
+TweetTally; CheckedTally runs both side by side to verify that.
+"""
+from array import array
+from error_handling import handle_error
+
+GOLDEN = 0x9E3779B97F4A7C15  # 64-bit multiplicative hashing constant
+MASK_64 = (1 << 64) - 1
+DEFAULT_BLOOM_BITS = 1 << 20  # 128 KiB
+DEFAULT_BLOOM_HASHES = 4
+
+
+def mix(value):
+    """
+    Scramble a 64-bit int, so that similar ids spread evenly across a table.
+    :param value: a non-negative int
+    :return: a 64-bit int
+    """
+    value = (value * GOLDEN) & MASK_64
+    return value ^ (value >> 29)
+
+
+class IdSet(object):
+    """
+    An exact set of positive 64-bit ids, backed by a flat array with linear
+    probing (0 marks an empty slot).
+    """
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self._slots = array('q', bytes(8 * size))
+        self._mask = size - 1
+        self.size = 0
+
+    def add(self, item_id):
+        """
+        Add an id to the set.
+        :param item_id: a positive int
+        :return: True if the id is new, False if it was already in the set
+        """
+        slots = self._slots
+        mask = self._mask
+        i = mix(item_id) & mask
+        while slots[i]:
+            if slots[i] == item_id:
+                return False
+            i = (i + 1) & mask
+        slots[i] = item_id
+        self.size += 1
+        if self.size * 2 > mask:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old_slots = self._slots
+        self._slots = array('q', bytes(16 * len(old_slots)))
+        self._mask = len(self._slots) - 1
+        self.size = 0
+        for item_id in old_slots:
+            if item_id:
+                self.add(item_id)
+
+    def __len__(self):
+        return self.size
+
+
+class BloomIdSet(object):
+    """
+    An approximate set of ids in a fixed number of bits. add() can wrongly
+    report a new id as already seen (a false positive), but never the reverse.
+    """
+    def __init__(self, bits=DEFAULT_BLOOM_BITS, hashes=DEFAULT_BLOOM_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self._bytes = bytearray((bits + 7) // 8)
+        self.size = 0  # count of ids reported as new
+
+    def add(self, item_id):
+        """
+        Add an id to the set.
+        :param item_id: a positive int
+        :return: True if the id is (probably) new, False if it was (certainly
+        or probably) already in the set
+        """
+        h1 = mix(item_id)
+        h2 = mix(h1) | 1
+        new = False
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self._bytes[byte] & mask:
+                self._bytes[byte] |= mask
+                new = True
+        if new:
+            self.size += 1
+        return new
+
+    def __len__(self):
+        return self.size
+
+
+class TweetAggregator(object):
+    """
+    Streams tweets into running totals. It has the same interface as
+    twitter.TweetTally, but doesn't keep a rolling state between runs.
+    """
+    def __init__(self, max_tweets, approximate=False,
+                 bloom_bits=DEFAULT_BLOOM_BITS):
+        """
+        Initialize the TweetAggregator.
+        :param max_tweets: the maximum number of tweets to count
+        :param approximate: if True, remember seen tweeters in a fixed-size
+        BloomIdSet instead of an exact IdSet
+        :param bloom_bits: the size of the BloomIdSet, in bits
+        """
+        self.max_tweets = max_tweets
+        self.since_id = 0  # no rolling state, so nothing was counted before
+        self.tweets = 0
+        self.tweets_followers = 0
+        self.max_followers = (0, 'null')
+        if approximate:
+            self._seen = BloomIdSet(bits=bloom_bits)
+        else:
+            self._seen = IdSet()
+
+    @property
+    def full(self):
+        return self.tweets >= self.max_tweets
+
+    def add(self, tweet):
+        """
+        Count a tweet, and its tweeter's followers if it's a new tweeter.
+        :param tweet: a tweet (dict) from the search api
+        :return: doesn't return anything
+        """
+        if self.full:
+            return
+        self.tweets += 1
+        user = tweet["user"]
+        if self._seen.add(int(user.get("id") or user["id_str"])):
+            followers = user["followers_count"]
+            self.tweets_followers += followers
+            if followers > self.max_followers[0]:
+                self.max_followers = (followers, user["screen_name"])
+
+    def results(self):
+        """
+        :return: a tuple of (tweets, tweets_followers, max_followers) where
+        max_followers is a tuple of (followers count, screen_name)
+        """
+        return self.tweets, self.tweets_followers, self.max_followers
+
+    def export_state(self):
+        """
+        :return: None, since a TweetAggregator doesn't keep a rolling state
+        """
+        return None
+
+
+class CheckedTally(object):
+    """
+    Feeds tweets to two tallies (e.g. a TweetAggregator and the exact
+    TweetTally) and reports any difference between their results.
+    The first tally's results and state are the ones which are used.
+    """
+    def __init__(self, primary, exact):
+        self.primary = primary
+        self.exact = exact
+        self.since_id = primary.since_id
+
+    @property
+    def full(self):
+        return self.primary.full and self.exact.full
+
+    def add(self, tweet):
+        self.primary.add(tweet)
+        self.exact.add(tweet)
+
+    def results(self):
+        primary_results = self.primary.results()
+        exact_results = self.exact.results()
+        if primary_results != exact_results:
+            handle_error(
+                exc=ValueError,
+                err='aggregator results {p} differ from exact results '
+                    '{e}'.format(p=primary_results, e=exact_results),
+                msg='twitter aggregation check'
+            )
+        return primary_results
+
+    def export_state(self):
+        return self.primary.export_state()
@@ -2,24 +2,334 @@
 Functions to interact with the Twitter search API.
 """
 import datetime
-import time
+import re
+import threading
 from html import escape
+import requests
+from requests_oauthlib import OAuth1
 from traceback import format_exception
+from urllib.parse import quote_plus
 from TwitterSearch import (TwitterSearch, TwitterSearchOrder,
                            TwitterSearchException)
+import cassettes
 from credentials import twitter_secrets as tw
-from data_functions import make_dict
+from config import get_setting
+from data_functions import latest_payload, make_dict
+from http_client import get_session
+from rate_limit import get_budget, get_limiter
+from tweet_aggregator import (DEFAULT_BLOOM_BITS, CheckedTally,
+                              TweetAggregator)
 
+MAX_TWEETS = 10000  # maximum number of tweets to retrieve per site
+# The search api rejects queries which are longer than this many characters,
+# once url-encoded.
+MAX_QUERY_LENGTH = 500
+DEFAULT_BATCH_SIZE = 20  # maximum number of sites to combine in one query
+# Sites with more unique tweeters than this (within the window) don't save
+# a rolling state, to keep their DynamoDB items small.
+MAX_STATE_TWEETERS = 2000
 
-def twitter_search(params, start_time):
+
+class TweetTally(object):
+    """
+    Counts the tweets matching one site's keywords, and tracks the unique
+    tweeters of those tweets (i.e., if the same person tweets ten times in
+    one day, that person's followers are counted once, not ten times).
+    A tally can be started from the rolling state saved by a previous run
+    (see export_state), so that only tweets newer than that run's since_id
+    need to be retrieved and merged in. The state looks like this:
+        {
+          'since_id': <the highest tweet id seen>,
+          'days': {'<YYYY-MM-DD>': <count of tweets on that day>},
+          'tweeters': {
+            '<user id>': [<followers>, '<YYYY-MM-DD last seen>',
+                          '<screen_name>', <id of their latest tweet>]
+          }
+        }
+    Days and tweeters from before window_start are dropped.
+    """
+    def __init__(self, max_tweets=MAX_TWEETS, state=None, window_start=None):
+        """
+        Initialize the TweetTally.
+        :param max_tweets: the maximum number of new tweets to count
+        :param state: the rolling state from a previous run, or None
+        :param window_start: the first day (a datetime.date) to count tweets
+        from; defaults to yesterday (in UTC, see cassettes.utcnow)
+        """
+        if window_start is None:
+            window_start = yesterday()
+        self.window_start = window_start.isoformat()
+        self.max_tweets = max_tweets
+        self.new_tweets = 0  # count of tweets retrieved during this run
+        self.days = {}  # count of tweets about keywords, per day
+        self.tweeters = {}  # unique tweeters about keywords, by user id
+        self.since_id = 0  # tweets up to this id were counted before
+        if state:
+            self.since_id = int(state.get('since_id', 0))
+            self.days = {
+                day: int(count) for day, count in state['days'].items()
+                if day >= self.window_start
+            }
+            self.tweeters = {
+                user_id: [int(t[0]), t[1], t[2], int(t[3])]
+                for user_id, t in state['tweeters'].items()
+                if t[1] >= self.window_start
+            }
+        self.max_id = self.since_id
+
+    @property
+    def full(self):
+        return self.new_tweets >= self.max_tweets
+
+    def add(self, tweet):
+        """
+        Count a tweet, unless it was counted by a previous run or max_tweets
+        has already been reached.
+        :param tweet: a tweet (dict) from the search api
+        :return: doesn't return anything
+        """
+        if self.full or tweet["id"] <= self.since_id:
+            return  # stop counting/tracking if reached max_tweets
+        self.new_tweets += 1
+        self.max_id = max(self.max_id, tweet["id"])
+        day = tweet_day(tweet)
+        self.days[day] = self.days.get(day, 0) + 1
+        # Can uncomment the following lines to see who is tweeting.
+        # print(str(self.new_tweets) + "\t" + str(tweet["id"])
+        #       + "\t" + tweet["user"]["screen_name"]
+        #       + "\t" + str(tweet["user"]["followers_count"]))
+        user = tweet["user"]
+        user_id = user.get("id_str") or str(user.get("id",
+                                                     user["screen_name"]))
+        tweeter = self.tweeters.get(user_id)
+        if tweeter is None or tweet["id"] > tweeter[3]:
+            # Keep the follower count and screen_name from the tweeter's
+            # latest tweet.
+            last_seen = max(day, tweeter[1]) if tweeter else day
+            self.tweeters[user_id] = [user["followers_count"], last_seen,
+                                      user["screen_name"], tweet["id"]]
+        elif day > tweeter[1]:
+            tweeter[1] = day
+
+    def results(self):
+        """
+        Calculate metrics on the followers of the unique tweeters.
+        :return: a tuple of (tweets, tweets_followers, max_followers) where
+        max_followers is a tuple of (followers count, screen_name)
+        """
+        tweets = min(sum(self.days.values()), self.max_tweets)
+        tweets_followers = 0  # count of followers of unique tweeters
+        max_followers = (0, 'null')  # the tweeter with the most followers
+        for followers, _, screen_name, _ in self.tweeters.values():
+            # Count how many followers there are in all the unique tweeters.
+            tweets_followers += followers
+            # Determine which unique tweeter has the most followers.
+            if followers > max_followers[0]:
+                max_followers = (followers, screen_name)
+        return tweets, tweets_followers, max_followers
+
+    def export_state(self):
+        """
+        Export the rolling state, to be saved and passed to the next run.
+        :return: the state as a dict, or None if it has too many tweeters to
+        be worth saving (in which case the next run retrieves all tweets)
+        """
+        if len(self.tweeters) > MAX_STATE_TWEETERS:
+            return None
+        return {
+            'since_id': self.max_id,
+            'days': self.days,
+            'tweeters': self.tweeters
+        }
+
+
+def make_tally(state):
+    """
+    Create the tally for one site's tweets, as set by the
+    "twitter_aggregation" setting in app_config.json:
+      - 'exact' (default): a TweetTally, which keeps a rolling state
+      - 'streaming': a TweetAggregator with an exact, array-backed set of
+        tweeter ids, for bounded memory on high-volume keywords
+      - 'approximate': a TweetAggregator with a fixed-size Bloom filter of
+        tweeter ids ("twitter_bloom_bits" sets its size)
+    If "twitter_aggregation_check" is true, a streaming or approximate
+    aggregator is checked against an exact TweetTally.
+    :param state: the rolling state from a previous run, or None
+    :return: a TweetTally, TweetAggregator or CheckedTally object
+    """
+    mode = get_setting('twitter_aggregation', 'exact')
+    if mode == 'exact':
+        return TweetTally(max_tweets=MAX_TWEETS, state=state)
+    aggregator = TweetAggregator(
+        max_tweets=MAX_TWEETS,
+        approximate=(mode == 'approximate'),
+        bloom_bits=get_setting('twitter_bloom_bits', DEFAULT_BLOOM_BITS)
+    )
+    if get_setting('twitter_aggregation_check', False):
+        return CheckedTally(aggregator, TweetTally(max_tweets=MAX_TWEETS))
+    return aggregator
+
+
+def yesterday():
+    """
+    :return: yesterday's date (in UTC), as a datetime.date. A replayed run
+    uses the day before its recording (see cassettes.utcnow), so that it
+    keeps the same days' tweets whenever it's replayed.
+    """
+    return cassettes.utcnow().date() - datetime.timedelta(1)
+
+
+def tweet_day(tweet):
+    """
+    Return the day (in UTC) on which a tweet was created.
+    :param tweet: a tweet (dict) from the search api
+    :return: the day as a 'YYYY-MM-DD' str
+    """
+    try:
+        created = datetime.datetime.strptime(tweet["created_at"],
+                                             '%a %b %d %H:%M:%S %z %Y')
+    except (KeyError, ValueError):
+        return cassettes.utcnow().date().isoformat()
+    return created.astimezone(datetime.timezone.utc).date().isoformat()
+
+
+class SessionTwitterSearch(TwitterSearch):
+    """
+    A TwitterSearch whose requests go through the shared Session (see
+    http_client.py), for pooled connections and cassettes (see
+    cassettes.py). TwitterSearch itself calls the module-level requests.get,
+    which opens a new connection for every call, so the methods which send
+    requests are overridden (only searches are used here).
+    """
+    def __init__(self, consumer_key, consumer_secret, access_token,
+                 access_token_secret, verify=True):
+        """
+        Initialize the SessionTwitterSearch.
+        :param consumer_key: the app's consumer key
+        :param consumer_secret: the app's consumer secret
+        :param access_token: the user's access token
+        :param access_token_secret: the user's access token secret
+        :param verify: if True, check the credentials now
+        """
+        self.oauth = OAuth1(consumer_key, client_secret=consumer_secret,
+                            resource_owner_key=access_token,
+                            resource_owner_secret=access_token_secret)
+        self.metadata = {}
+        super().__init__(consumer_key, consumer_secret, access_token,
+                         access_token_secret, verify=verify)
+
+    def authenticate(self, verify=True):
+        super().authenticate(verify=False)
+        if verify:
+            response = get_session().get(self._base_url + self._verify_url,
+                                         auth=self.oauth)
+            self.check_http_status(response.status_code)
+
+    def search_tweets(self, order):
+        """
+        Send one search (without following further pages).
+        :param order: a TwitterSearchOrder object
+        :return: a dict with the response's headers ('meta') and its JSON
+        ('content'); raises TwitterSearchException for error statuses
+        """
+        response = get_session().get(
+            self._base_url + self._search_url + order.create_search_url(),
+            auth=self.oauth
+        )
+        self.metadata = response.headers
+        self.check_http_status(response.status_code)
+        return {'meta': response.headers, 'content': response.json()}
+
+    def get_metadata(self):
+        """
+        :return: the headers of the most recent response
+        """
+        return self.metadata
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide SessionTwitterSearch object (using this app's
+    tokens), creating it if needed. Calls made with it must hold the
+    'twitter' rate limiter, since it keeps the most recent response's
+    metadata.
+    :return: a SessionTwitterSearch object shared by all threads
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SessionTwitterSearch(
+                consumer_key=tw.CONSUMER_KEY,
+                consumer_secret=tw.CONSUMER_SECRET,
+                access_token=tw.ACCESS_TOKEN,
+                access_token_secret=tw.ACCESS_TOKEN_SECRET
+            )
+        return _client
+
+
+def search_pages(ts, tso, max_tweets):
+    """
+    Call the search api repeatedly (for paginated results) and yield each
+    page of tweets, until there are no more tweets to retrieve or until
+    max_tweets tweets have been yielded.
+    Each call is scheduled against the process-wide twitter ApiBudget (see
+    rate_limit.py), which is shared by the searches of all sites and only
+    sleeps when the budget is used up, until the window resets.
+    :param ts: a TwitterSearch object
+    :param tso: a TwitterSearchOrder object with the query
+    :param max_tweets: the maximum number of tweets to retrieve
+    :return: yields lists of tweets (dicts)
+    """
+    budget = get_budget('twitter')
+    more_tweets = True  # are there more tweets to retrieve?
+    tweets = 0  # count of tweets retrieved
+    min_id = 0  # next tweet for paginated results, when multiple api calls
+    while more_tweets and tweets < max_tweets:
+        budget.acquire()
+        # Call the search api (holding the twitter rate limiter, since other
+        # sites may be searching at the same time with the same client).
+        with get_limiter('twitter'):
+            response = ts.search_tweets(tso)
+            budget.update(ts.get_metadata())
+        statuses = response["content"]["statuses"]
+        # Are there no more tweets to retrieve?
+        if len(statuses) == 0:
+            more_tweets = False
+        else:  # there are more tweets to retrieve
+            for tweet in statuses:
+                if (min_id == 0) or (tweet["id"] < min_id):
+                    # Set min_id to the id of this tweet. The api returns
+                    # tweets in reverse chronological order (most recent is
+                    # first), so min_id is a lowering "ceiling" of which
+                    # tweet id to start from during subsequent api call.
+                    min_id = tweet["id"]
+            tweets += len(statuses)
+            yield statuses
+            # Set the next paginated result's start point (subtract one
+            # to avoid retrieving the last tweet from this batch twice).
+            tso.set_max_id(min_id - 1)
+
+
+def twitter_search(params, start_time, previous=None):
     """
     Retrieves most recent tweets since yesterday based on keywords.
     Retrieves as many tweets as api gives, up to the maximum set by max_tweets.
-    :param params: The keywords to search for, formatted as list of 
+    If previous holds the rolling state saved by an earlier run (see
+    TweetTally), only tweets newer than that run's since_id are retrieved,
+    and they're merged into the state to calculate the results.
+    :param params: The keywords to search for, formatted as list of
     strings. To search for a url, use this syntax:
         "url:\"gizmodo com\""
-    in which the domain is separated by spaces instead of dots and the 
+    in which the domain is separated by spaces instead of dots and the
     internal quotes are escaped with backspaces.
+    :param start_time: the UTC time (as a datetime object) at which
+    retrieving began, to calculate duration.
+    :param previous: the directive's existing data branch from the Site
+    (e.g. site.data['twitter1']), or None
     :return: Returns list of dicts containing:
       - tweets: the number of tweets, since yesterday, about the specified
       keywords (up to a maximum count of max_tweets)
@@ -30,99 +340,272 @@ def twitter_search(params, start_time):
       (above) who has the most followers
       - most_followed_count: the count of the number of followers who follow
       the tweeter with the most followers
+      - twitter_state: the rolling state for the next run
     """
     print('starting twitter_search')
-    # Set up flow control variables.
-    max_tweets = 10000  # maximum number of tweets to retrieve from api
-    more_tweets = True  # are there more tweets to retrieve?
-    need_to_sleep = False  # tells to sleep (if approaching api rate limit)
-
     error = 'ok'
+    state = latest_payload(previous, 'twitter_state')
+    tally = make_tally(state)
 
     try:
-        # create TwitterSearch object using this app's tokens.
-        ts = TwitterSearch(
-            consumer_key=tw.CONSUMER_KEY,
-            consumer_secret=tw.CONSUMER_SECRET,
-            access_token=tw.ACCESS_TOKEN,
-            access_token_secret=tw.ACCESS_TOKEN_SECRET
-        )
+        ts = get_client()
 
         # Create a TwitterSearchOrder object and add keywords to it.
         tso = TwitterSearchOrder()
         for param in params:
             tso.add_keyword(param)
-        # Only search for tweets since yesterday (in UTC).
-        yesterday = datetime.datetime.utcnow().date() - datetime.timedelta(1)
-        tso.set_since(yesterday)
-
-        # Set up counter variables.
-        tweets = 0  # count of tweets about keywords, since yesterday
-        unique_tweeters = {}  # dict of unique tweeters about keywords
-        tweets_followers = 0  # count of followers of unique_tweeters
-        min_id = 0  # next tweet for paginated results, when multiple api calls
-        max_followers = (0, 'null')  # the tweeter with the most followers
+        # Only search for tweets since yesterday (in UTC), and only for
+        # tweets newer than those already counted in the rolling state.
+        tso.set_since(yesterday())
+        if tally.since_id:
+            tso.set_since_id(tally.since_id)
 
         # Keep calling the api (for paginated results) until there are no
         # more tweets to retrieve, or until max_tweets limit has been reached.
-        while more_tweets and tweets < max_tweets:
-            # Sleep for 60 seconds, if needed, to avoid hitting api limit.
-            if need_to_sleep:
-                print("rate limit:", rate_limit)
-                time.sleep(60)
-            # Call the search api.
-            response = ts.search_tweets(tso)
-            # Are there no more tweets to retrieve?
-            if len(response["content"]["statuses"]) == 0:
-                more_tweets = False
-            else:  # there are more tweets to retrieve
-                # Iterate through the batch of tweets retrieved from this
-                # api call. Count the tweet and track all the unique tweeters.
-                for tweet in response["content"]["statuses"]:
-                    if tweets > max_tweets:
-                        break  # stop counting/tracking if reached max_tweets
-                    tweets += 1
-                    if (min_id == 0) or (tweet["id"] < min_id):
-                        # Set min_id to the id of this tweet. The api returns
-                        # tweets in reverse chronological order (most recent is
-                        # first), so min_id is a lowering "ceiling" of which
-                        # tweet id to start from during subsequent api call.
-                        min_id = tweet["id"]
-                    # Can uncomment the following lines to see who is tweeting.
-                    # print(str(tweets) + "\t" + str(tweet["id"])
-                    #       + "\t" + tweet["user"]["screen_name"]
-                    #       + "\t" + str(tweet["user"]["followers_count"]))
-                    if tweet["user"]["screen_name"] not in unique_tweeters:
-                        tweeter = tweet["user"]["screen_name"]
-                        tweeters_followers = tweet["user"]["followers_count"]
-                        # Add tweet's screen_name and followers_count to
-                        # unique_tweeters, iff this is first time seeing
-                        # this screen_name.
-                        unique_tweeters[tweeter] = tweeters_followers
-                # Set the next paginated result's start point (subtract one
-                # to avoid retrieving the last tweet from this batch twice).
-                tso.set_max_id(min_id - 1)
-            # If less than 15 api calls remaining then sleep during next loop.
-            # (Search api free tier allows 180 calls per 15 minute period.)
-            rate_limit = int(ts.get_metadata()["x-rate-limit-remaining"])
-            if rate_limit < 15:
-                need_to_sleep = True
-            else:
-                need_to_sleep = False
-        # After all tweets have been retrieved (up to max_tweets), calculate
-        # metrics on the followers of the tweeters in unique_tweeters.
-        for tweeter in unique_tweeters:
-            # Count how many followers there are in all the unique_tweeters.
-            tweets_followers += unique_tweeters[tweeter]
-            # Determine which tweeter from unique_tweeters has most followers.
-            if unique_tweeters[tweeter] > max_followers[0]:
-                max_followers = (unique_tweeters[tweeter], tweeter)
-
-    except TwitterSearchException as e:
-        tweets = None
-        tweets_followers = None
+        for statuses in search_pages(ts, tso, MAX_TWEETS):
+            for tweet in statuses:
+                tally.add(tweet)
+        results = tally.results()
+        state = tally.export_state()
+
+    except (TwitterSearchException,
+            requests.exceptions.RequestException) as e:
+        # Keep the previous state, since the retrieved tweets are incomplete.
+        results = (None, None, (0, 'null'))
         error = format_exception(ValueError, e, e.__traceback__)
 
+    return make_twitter_dicts(results, state, start_time, error)
+
+
+def twitter_batch_search(param_sets, start_time, batch_size=None,
+                         previous_branches=None):
+    """
+    Retrieves tweets since yesterday for many sites' keywords, combining the
+    sites into as few OR'd queries as possible (since every site's search
+    competes for the same 180-calls-per-15-minutes budget). Each returned
+    tweet is then attributed locally to the sites whose keywords it matches,
+    including each site's exclusions (e.g. "-from:recursecenter").
+    Only keyword sets with exactly one positive term, and whose terms can be
+    matched locally (see compile_term), can be combined. The others are left
+    out of the results so that the caller can use twitter_search for them.
+    Each OR'd query retrieves no more tweets than a single site's search
+    (MAX_TWEETS), so that one busy query can't use up the rate-limit budget.
+    If a query stops there, its sites which hadn't reached MAX_TWEETS of
+    their own are missing older tweets, so they're left out of the results
+    too (and searched for one by one).
+    :param param_sets: a list of twitter directives' parameters
+    :param start_time: the UTC time (as a datetime object) at which
+    retrieving began, to calculate duration.
+    :param batch_size: the maximum number of sites per query; defaults to the
+    "twitter_batch_size" setting in app_config.json
+    :param previous_branches: an optional list, parallel to param_sets, of
+    the directives' existing data branches (for their rolling states)
+    :return: a dict keyed by tuple(params), where each value is the same list
+    of dicts that twitter_search returns
+    """
+    print('starting twitter batch')
+    if batch_size is None:
+        batch_size = get_setting('twitter_batch_size', DEFAULT_BATCH_SIZE)
+
+    # Work out which keyword sets can be combined.
+    if previous_branches is None:
+        previous_branches = [None] * len(param_sets)
+    members = []
+    states = {}
+    for params, previous in zip(param_sets, previous_branches):
+        key = tuple(params)
+        compiled = compile_keywords(params)
+        if compiled is not None and key not in states:
+            members.append((key, compiled[0], compiled[1]))
+            states[key] = latest_payload(previous, 'twitter_state')
+
+    results = {}
+    for group in group_queries(members, batch_size):
+        # Only one positive term is combined per site, so a site's query
+        # matches a tweet iff its positive term does.
+        tallies = {key: make_tally(states[key]) for key, _, _ in group}
+        error = 'ok'
+        retrieved = 0
+        try:
+            ts = get_client()
+            tso = TwitterSearchOrder()
+            tso.add_keyword([positive_term(key) for key, _, _ in group],
+                            or_operator=True)
+            tso.set_since(yesterday())
+            # Each tally skips the tweets it already counted, so the query
+            # only needs tweets newer than the oldest since_id in the group.
+            since_id = min(tally.since_id for tally in tallies.values())
+            if since_id:
+                tso.set_since_id(since_id)
+            for statuses in search_pages(ts, tso, MAX_TWEETS):
+                retrieved += len(statuses)
+                for tweet in statuses:
+                    for key, positive, exclusions in group:
+                        if positive(tweet) and \
+                                not any(excl(tweet) for excl in exclusions):
+                            tallies[key].add(tweet)
+                if all(tally.full for tally in tallies.values()):
+                    break
+        except (TwitterSearchException,
+                requests.exceptions.RequestException) as e:
+            error = format_exception(ValueError, e, e.__traceback__)
+        capped = retrieved >= MAX_TWEETS
+        for key, _, _ in group:
+            if error == 'ok' and capped and not tallies[key].full:
+                continue  # incomplete; see above
+            if error == 'ok':
+                site_results = tallies[key].results()
+                state = tallies[key].export_state()
+            else:
+                site_results = (None, None, (0, 'null'))
+                state = states[key]
+            results[key] = make_twitter_dicts(site_results, state,
+                                              start_time, error)
+    return results
+
+
+def group_queries(members, batch_size):
+    """
+    Split members into groups whose OR'd query fits within MAX_QUERY_LENGTH.
+    :param members: a list of (key, positive, exclusions) tuples
+    :param batch_size: the maximum number of members per group
+    :return: a list of lists of members
+    """
+    groups = []
+    group = []
+    length = 0
+    for member in members:
+        # TwitterSearchOrder joins the terms with ' OR ' and url-encodes the
+        # result with quote_plus, which encodes each character on its own,
+        # so the query's length is the sum of its parts' encoded lengths.
+        term_length = len(quote_plus(positive_term(member[0])))
+        added_length = term_length + \
+            (len(quote_plus(' OR ')) if group else 0)
+        if group and (len(group) >= batch_size or
+                      length + added_length > MAX_QUERY_LENGTH):
+            groups.append(group)
+            group = []
+            added_length = term_length
+            length = 0
+        group.append(member)
+        length += added_length
+    if group:
+        groups.append(group)
+    return groups
+
+
+def positive_term(params):
+    """
+    Return the single keyword of params which isn't an exclusion.
+    :param params: a twitter directive's parameters (list or tuple of str)
+    :return: the positive keyword (str)
+    """
+    return [param for param in params if not param.startswith('-')][0]
+
+
+def compile_keywords(params):
+    """
+    Compile a site's keywords into predicates for matching tweets locally.
+    :param params: a twitter directive's parameters (list of str)
+    :return: a tuple of (positive predicate, list of exclusion predicates),
+    or None if the keywords can't be combined with other sites' keywords
+    """
+    positives = [param for param in params if not param.startswith('-')]
+    exclusions = [param[1:] for param in params if param.startswith('-')]
+    if len(positives) != 1:
+        return None
+    positive = compile_term(positives[0])
+    exclusions = [compile_term(exclusion) for exclusion in exclusions]
+    if positive is None or None in exclusions:
+        return None
+    return positive, exclusions
+
+
+def compile_term(term):
+    """
+    Compile a single search term into a predicate which tells whether a
+    tweet matches it. Supported terms are url:, from:, #hashtags,
+    @mentions, "quoted phrases" and plain words.
+    :param term: the search term (str), without any leading '-'
+    :return: a function which takes a tweet and returns True/False, or None
+    if the term isn't supported
+    """
+    term = term.strip()
+    if term.startswith('url:'):
+        tokens = re.findall(r'[a-z0-9]+', term[4:].lower())
+        if not tokens:
+            return None
+        pattern = re.compile(r'(?<![a-z0-9])' + r'[^a-z0-9]+'.join(tokens) +
+                             r'(?![a-z0-9])')
+        return lambda tweet: any(pattern.search(url.lower())
+                                 for url in tweet_urls(tweet))
+    if term.startswith('from:'):
+        name = term[5:].lower()
+        return lambda tweet: tweet['user']['screen_name'].lower() == name
+    if ':' in term:
+        return None  # other operators can't be matched locally
+    if term.startswith('"') and term.endswith('"') and len(term) > 1:
+        words = re.findall(r'\w+', term[1:-1].lower())
+    elif re.match(r'^[#@]?\w+$', term):
+        words = [term.lower()]
+    else:
+        return None
+    if not words:
+        return None
+    pattern = re.compile(r'(?<![\w#@])' + r'\W+'.join(
+        re.escape(word) for word in words) + r'(?!\w)')
+    return lambda tweet: pattern.search(tweet_text(tweet).lower()) is not None
+
+
+def tweet_parts(tweet):
+    """
+    Yield a tweet and the retweeted/quoted tweets embedded within it.
+    :param tweet: a tweet (dict) from the search api
+    :return: yields tweets (dicts)
+    """
+    yield tweet
+    for embedded in ('retweeted_status', 'quoted_status'):
+        if embedded in tweet:
+            yield tweet[embedded]
+
+
+def tweet_urls(tweet):
+    """
+    Return all of the urls within a tweet (and retweeted/quoted tweets).
+    :param tweet: a tweet (dict) from the search api
+    :return: a list of urls (str)
+    """
+    urls = []
+    for part in tweet_parts(tweet):
+        for url in part.get('entities', {}).get('urls', []):
+            urls.append(url.get('expanded_url') or url.get('url') or '')
+    return urls
+
+
+def tweet_text(tweet):
+    """
+    Return all of the text within a tweet (and retweeted/quoted tweets).
+    :param tweet: a tweet (dict) from the search api
+    :return: the text (str)
+    """
+    return ' '.join(part.get('full_text') or part.get('text', '')
+                    for part in tweet_parts(tweet))
+
+
+def make_twitter_dicts(results, state, start_time, error):
+    """
+    Turn a site's tweet results into the standard-formatted dicts.
+    :param results: a tuple of (tweets, tweets_followers, max_followers), as
+    returned by TweetTally.results
+    :param state: the rolling state to save for the next run, or None
+    :param start_time: the UTC time (as a datetime object) at which
+    retrieving began, to calculate duration.
+    :param error: the status to record with the values
+    :return: a list of dicts: tweets, tweets_followers, most_followed_name,
+    most_followed_count, twitter_state
+    """
+    tweets, tweets_followers, max_followers = results
+
     tweets = make_dict(
         value=tweets,
         data_name='tweets',
@@ -151,4 +634,12 @@ def twitter_search(params, start_time):
         status=error
     )
 
-    return [tweets, tweets_followers, most_followed_name, most_followed_count]
+    twitter_state = make_dict(
+        value=state,
+        data_name='twitter_state',
+        start_time=start_time,
+        status=error
+    )
+
+    return [tweets, tweets_followers, most_followed_name, most_followed_count,
+            twitter_state]
@@ -1,6 +1,8 @@
 """
 Simple functions to operate on Site.url dict.
 """
+import hashlib
+import json
 import re
 
 
@@ -43,6 +45,9 @@ def tidy_url(url):
 def generate_filename(url):
     """
     Generate the filename to be used for local caching if test_mode = True.
+    The readable part of the name can be the same for different urls (e.g.
+    'a.b' and 'a_b', or paths which differ only in punctuation), so it ends
+    with a hash of the url's components.
     :return: filename of type str, and ending in ".html"
     """
     # Replace '.' in subdomain with '_'
@@ -62,6 +67,10 @@ def generate_filename(url):
 
     # Concatenate filename.
     domain = '_'.join(url['domain'].split('.'))
-    filename = '../html_cached_files/' + subdomain + domain + path + '.html'
+    digest = hashlib.blake2b(json.dumps(
+        [url.get('protocol'), url['subdomain'], url['domain'], url['path']]
+    ).encode('utf-8'), digest_size=8).hexdigest()
+    filename = '../html_cached_files/' + subdomain + domain + path + '-' + \
+        digest + '.html'
 
     return filename
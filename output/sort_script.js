@@ -1,28 +1,36 @@
+// The rows' sort orders, precomputed by the render step (see
+// functions/sort_orders.py), and the rows in the order they were written.
+var sortOrders = null;
+var sitesRows = null;
+
 function sortRows(dataAttrToSortBy) {
-    /** Hat tip to https://stackoverflow.com/a/14131059 for this function.
-    I adapted the SO code to the needs of top_sites, but it's based on that
-    example code. **/
+    /** Each sortable column has a precomputed permutation: the indices of
+    the rows in ascending order of that column. Sorting applies it (or its
+    reverse, when the column is clicked again) instead of comparing rows. **/
     var tbody = document.getElementsByTagName("tbody")[0];
-    currentSort = tbody.getAttribute("data-sorted-by");
-    var elems = document.getElementsByClassName('sitesRow');
-    var rows = [];
-    for (var i = 0; i < elems.length; i++) {
-        rows.push(elems[i]);
+    if (sortOrders === null) {
+        sortOrders = JSON.parse(
+            document.getElementById("sortOrders").textContent
+        );
+        sitesRows = Array.prototype.slice.call(
+            document.getElementsByClassName('sitesRow')
+        );
     }
-    if (currentSort.length == 0 || currentSort != dataAttrToSortBy) {
-        rows.sort(function(a, b) {
-            a = String(a.getAttribute(dataAttrToSortBy))
-            b = String(b.getAttribute(dataAttrToSortBy))
-            return a.localeCompare(b, 'en', {numeric: true})
-        });
-    } else {
-        rows.reverse();
+    var order = sortOrders[dataAttrToSortBy];
+    if (!order) {
+        return;
     }
+    var currentSort = tbody.getAttribute("data-sorted-by");
+    var descending = currentSort == dataAttrToSortBy &&
+        tbody.getAttribute("data-sort-descending") != "true";
 
-    rows.forEach(function(el) {
-        tbody.appendChild(el);
-    });
+    var fragment = document.createDocumentFragment();
+    var last = order.length - 1;
+    for (var i = 0; i <= last; i++) {
+        fragment.appendChild(sitesRows[order[descending ? last - i : i]]);
+    }
+    tbody.appendChild(fragment);
 
     tbody.setAttribute("data-sorted-by", dataAttrToSortBy);
-    currentSort = tbody.getAttribute("data-sorted-by");
+    tbody.setAttribute("data-sort-descending", String(descending));
 }
@@ -0,0 +1,58 @@
+"""
+Shared setup for the tests.
+
+The modules in functions/ import each other (and credentials/) by name, as
+they do when run from functions/, so both directories are put on sys.path.
+"""
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(REPO_DIR, 'functions')
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'templates')
+for path in (REPO_DIR, FUNCTIONS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import config  # noqa: E402 (needs the paths above)
+import error_handling  # noqa: E402
+import moz_usage  # noqa: E402
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    """
+    Run a test with its own copy of app_config.json's settings, e.g.
+        def test_something(settings):
+            settings['directive_workers'] = 3
+    :return: the settings as a dict, which the test can change
+    """
+    values = dict(config.load_config())
+    monkeypatch.setattr(config, '_config', values)
+    return values
+
+
+@pytest.fixture(autouse=True)
+def error_reporter(monkeypatch, tmp_path):
+    """
+    Give each test its own ErrorReporter, whose error log is written to the
+    test's temporary directory.
+    :return: the ErrorReporter
+    """
+    reporter = error_handling.ErrorReporter(
+        {'file': str(tmp_path / 'errors.jsonl')}
+    )
+    monkeypatch.setattr(error_handling, '_reporter', reporter)
+    return reporter
+
+
+@pytest.fixture(autouse=True)
+def moz_rows(monkeypatch, tmp_path):
+    """
+    Count each test's Moz rows in its temporary directory.
+    :return: the MozUsage
+    """
+    usage = moz_usage.MozUsage(str(tmp_path / 'moz_usage.json'))
+    monkeypatch.setattr(moz_usage, '_usage', usage)
+    return usage
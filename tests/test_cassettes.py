@@ -0,0 +1,82 @@
+from decimal import Decimal
+import cassettes
+from cassettes import DEFAULT_SETTINGS, request_key
+from pipeline import Pipeline
+
+URL = 'https://api.twitter.com/1.1/search/tweets.json?q=x&since_id={i}'
+
+
+def key(url, body=None, headers=None,
+        match_headers=DEFAULT_SETTINGS['match_headers']):
+    return request_key('GET', url, body, headers or {},
+                       DEFAULT_SETTINGS['ignore_params'], match_headers)
+
+
+def test_request_key_ignores_params_which_change_every_run():
+    assert key(URL.format(i=1)) == key(URL.format(i=2))
+    assert key('https://lsapi.seomoz.com/linkscape/url-metrics/x.com'
+               '?Cols=1&AccessID=a&Expires=1&Signature=s') == \
+        key('https://lsapi.seomoz.com/linkscape/url-metrics/x.com'
+            '?Signature=t&Expires=2&AccessID=a&Cols=1')
+
+
+def test_request_key_depends_on_what_decides_the_response():
+    assert key('https://x.com/?a=1&b=2') == key('https://X.com/?b=2&a=1')
+    assert key('https://x.com/?a=1') != key('https://x.com/?a=2')
+    assert key('https://x.com/', body='a') != key('https://x.com/', body='b')
+    assert key('https://x.com/', headers={'If-None-Match': '"1"'}) != \
+        key('https://x.com/')
+    # Only the headers in match_headers count.
+    assert key('https://x.com/', headers={'User-Agent': 'a'}) == \
+        key('https://x.com/')
+
+
+def test_recorded_rows_are_replayed(settings, tmp_path):
+    settings['cassettes'] = {'mode': 'record', 'directory': str(tmp_path)}
+    rows = [{'title': 'a', 'rank': Decimal('1'), 'score': Decimal('0.25')},
+            {'title': 'b', 'data': {'moz1': {'mozrank': [
+                {'payload': Decimal('3.5')}]}}}]
+    assert list(cassettes.record_items(iter(rows), 'sites')) == rows
+    assert list(cassettes.replay_items('sites')) == rows
+
+
+def test_a_failed_scan_keeps_the_previous_recording(settings, tmp_path):
+    settings['cassettes'] = {'mode': 'record', 'directory': str(tmp_path)}
+    list(cassettes.record_items(iter([{'title': 'a'}]), 'sites'))
+
+    def failing_scan():
+        yield {'title': 'b'}
+        raise RuntimeError('connection reset')
+    try:
+        list(cassettes.record_items(failing_scan(), 'sites'))
+    except RuntimeError:
+        pass
+    assert list(cassettes.replay_items('sites')) == [{'title': 'a'}]
+
+
+class UnusedDynamo(object):
+    """
+    A Dynamo object which fails any use but the scan_failed flag.
+    """
+    profile_name = 'test'
+    scan_failed = False
+
+    def __getattr__(self, name):
+        raise AssertionError('DynamoDB used while replaying: ' + name)
+
+
+def test_a_replayed_run_neither_scans_nor_writes(settings, tmp_path):
+    settings['cassettes'] = {'mode': 'record', 'directory': str(tmp_path)}
+    settings['schedule_refreshes'] = True
+    rows = [{'title': title, 'directives': {}, 'project': 'p',
+             'url': {'protocol': 'https://', 'subdomain': '',
+                     'domain': title, 'path': ''}}
+            for title in ('a.com', 'b.com')]
+    list(cassettes.record_items(iter(rows), 'sites'))
+    settings['cassettes']['mode'] = 'replay'
+    pipeline = Pipeline(UnusedDynamo(), writer=UnusedDynamo(),
+                        history=UnusedDynamo())
+    assert pipeline.scheduler is None
+    sites = pipeline.run(render=False)
+    assert sorted(site.title for site in sites) == ['a.com', 'b.com']
+    assert pipeline.counts['persisted'] == 0
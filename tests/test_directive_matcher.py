@@ -0,0 +1,95 @@
+import pytest
+from directive_matcher import DirectiveMatcher
+from html_stream import DirectiveStreamParser
+
+# (page, params) fixtures, each run with every backend.
+FIXTURES = {
+    'nested': (
+        '<ul class="post-list"><li><div class="post-title">'
+        '<a href="/new">Newest &amp; best</a></div></li>'
+        '<li><div class="post-title"><a href="/old">Old</a></div></li></ul>',
+        [['class', 'post-list'], ['class', 'post-title'], 'a']
+    ),
+    'one_of_several_classes': (
+        '<h2 class="big public-article__title"><a href="/1">One</a></h2>',
+        [['class', 'public-article__title'], 'a']
+    ),
+    'several_classes_in_order': (
+        '<div class="x foo bar y"><a href="/1">one</a></div>'
+        '<div class="foo bar"><a href="/2">two</a></div>',
+        [['class', 'foo bar'], 'a']
+    ),
+    'several_classes_with_extra_spaces': (
+        '<div class="  foo   bar "><a href="/1">one</a></div>',
+        [['class', 'foo bar'], 'a']
+    ),
+    'script_style_and_template_text': (
+        '<div class="post"><a href="/1">one<script>var x = 1;</script>'
+        '<style>.a {}</style><template>T</template><!-- c --> two '
+        '<b>three</b></a></div>',
+        [['class', 'post'], 'a']
+    ),
+    'id_attribute': (
+        '<div id="main"><p><a href="/skip">skip</a></p></div>'
+        '<div id="latest"><a href="/1">Latest</a></div>',
+        [['id', 'latest'], 'a']
+    ),
+    'exact_value_of_single_valued_attribute': (
+        '<a data-kind="post new" href="/1">one</a>'
+        '<a data-kind="post" href="/2">two</a>',
+        [['data-kind', 'post'], ]
+    )
+}
+MISSING = {
+    'class_not_in_order': (
+        '<div class="bar foo"><a href="/1">one</a></div>',
+        [['class', 'foo bar'], 'a']
+    ),
+    'no_such_tag': (
+        '<div class="post"><span>one</span></div>',
+        [['class', 'post'], 'a']
+    )
+}
+
+
+def stream_match(page, params):
+    parser = DirectiveStreamParser(params)
+    parser.feed(page)
+    parser.close()
+    if parser.result is None:
+        raise ValueError("couldn't find params {p}".format(p=params))
+    return parser.result
+
+
+def match(page, params, backend):
+    if backend == 'stream':
+        return stream_match(page, params)
+    return DirectiveMatcher(params).match(page, backend=backend)
+
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+def test_backends_find_the_same_element(name):
+    pytest.importorskip('lxml')
+    page, params = FIXTURES[name]
+    found = {backend: match(page, params, backend)
+             for backend in ('html.parser', 'lxml', 'stream')}
+    results = {backend: (element.text, element['href'])
+               for backend, element in found.items()}
+    assert results['lxml'] == results['html.parser']
+    assert results['stream'] == results['html.parser']
+
+
+@pytest.mark.parametrize('backend', ['html.parser', 'lxml', 'stream'])
+@pytest.mark.parametrize('name', sorted(MISSING))
+def test_backends_agree_on_missing_elements(name, backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    page, params = MISSING[name]
+    with pytest.raises(ValueError):
+        match(page, params, backend)
+
+
+def test_text_leaves_out_scripts_and_styles():
+    pytest.importorskip('lxml')
+    page, params = FIXTURES['script_style_and_template_text']
+    assert match(page, params, 'lxml').text == 'one two three'
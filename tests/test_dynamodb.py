@@ -0,0 +1,233 @@
+import threading
+import pytest
+from botocore.exceptions import ClientError
+import dynamodb
+from dynamodb import Dynamo
+
+KEY_SCHEMA = [{'AttributeName': 'title', 'KeyType': 'HASH'}]
+
+
+class FakeTable(object):
+    """
+    A table whose scan gives each segment two pages of rows, and fails for
+    the segments in fail_segments.
+    """
+    def __init__(self, fail_segments=(), error=None):
+        self.key_schema = KEY_SCHEMA
+        self.fail_segments = fail_segments
+        self.error = error or RuntimeError('connection reset')
+
+    def scan(self, Segment=0, TotalSegments=1, ExclusiveStartKey=None):
+        if Segment in self.fail_segments:
+            raise self.error
+        page = 0 if ExclusiveStartKey is None else 1
+        response = {'Items': [
+            {'title': 'site {s}-{p}-{n}'.format(s=Segment, p=page, n=n)}
+            for n in range(3)
+        ]}
+        if page == 0:
+            response['LastEvaluatedKey'] = {'title': 'page 0'}
+        return response
+
+
+class FakeResource(object):
+    def __init__(self, table):
+        self.table = table
+
+    def Table(self, name):
+        return self.table
+
+
+@pytest.fixture
+def make_dynamo(monkeypatch):
+    """
+    :return: a function which makes a Dynamo object whose boto3 sessions'
+    resources have the given table
+    """
+    def make(table):
+        class FakeSession(object):
+            def __init__(self, profile_name=None):
+                pass
+
+            def resource(self, name):
+                return FakeResource(table)
+
+        monkeypatch.setattr(dynamodb.boto3.session, 'Session', FakeSession)
+        return Dynamo(profile_name='test')
+    return make
+
+
+def test_segments_are_scanned_in_parallel(make_dynamo):
+    dynamo = make_dynamo(FakeTable())
+    rows = list(dynamo.iter_rows('sites', total_segments=4))
+    assert len(rows) == 4 * 2 * 3
+    assert len({row['title'] for row in rows}) == len(rows)
+    assert not dynamo.scan_failed
+
+
+def test_a_failed_segment_is_raised_after_the_other_rows(make_dynamo):
+    dynamo = make_dynamo(FakeTable(fail_segments=(2,)))
+    rows = []
+    with pytest.raises(RuntimeError):
+        for row in dynamo.iter_rows('sites', total_segments=4):
+            rows.append(row)
+    assert len(rows) == 3 * 2 * 3
+    assert dynamo.scan_failed
+
+
+def test_a_failed_single_scan_sets_scan_failed(make_dynamo):
+    dynamo = make_dynamo(FakeTable(fail_segments=(0,)))
+    with pytest.raises(RuntimeError):
+        list(dynamo.iter_rows('sites', total_segments=1))
+    assert dynamo.scan_failed
+
+
+def test_get_all_rows_returns_none_for_a_partial_scan(make_dynamo):
+    assert make_dynamo(FakeTable(fail_segments=(1,))).get_all_rows(
+        'sites', total_segments=4) is None
+    error = ClientError({'Error': {'Code': 'ResourceNotFoundException'}},
+                        'Scan')
+    dynamo = make_dynamo(FakeTable(fail_segments=(3,), error=error))
+    assert dynamo.get_all_rows('sites', total_segments=4) is None
+    assert dynamo.scan_failed
+    assert len(make_dynamo(FakeTable()).get_all_rows(
+        'sites', total_segments=4)) == 24
+
+
+def test_no_segment_threads_are_left_running(make_dynamo):
+    before = threading.active_count()
+    dynamo = make_dynamo(FakeTable(fail_segments=(0, 1)))
+    with pytest.raises(RuntimeError):
+        list(dynamo.iter_rows('sites', total_segments=4))
+    assert threading.active_count() == before
+
+
+def value(payload, accessed='2026-10-15T06:00:00', duration='0.5',
+          status='ok'):
+    return {'accessed': accessed, 'data_name': 'tweets',
+            'duration': duration, 'payload': payload, 'status': status}
+
+
+def site_item(payload=3, **kwargs):
+    return {
+        'title': 'X',
+        'project': 'test_blogs',
+        'elapsed_seconds': kwargs.pop('elapsed_seconds', '1.2'),
+        'data': {
+            'twitter1': {'tweets': [value(payload, **kwargs)]},
+            'moz1': {'mozrank': [value(5)]}
+        }
+    }
+
+
+def test_diff_item_skips_values_which_were_only_retrieved_again():
+    loaded = site_item()
+    item = site_item(accessed='2026-10-16T06:00:00', duration='0.7',
+                     elapsed_seconds='2.5')
+    assert dynamodb.diff_item(loaded, item, ['title']) is None
+
+
+def test_diff_item_sets_only_the_changed_data_branch():
+    update = dynamodb.diff_item(site_item(), site_item(payload=4,
+                                accessed='2026-10-16T06:00:00'), ['title'])
+    names = update['ExpressionAttributeNames']
+    assert sorted(names.values()) == ['data', 'twitter1']
+    assert update['UpdateExpression'] == 'SET #n0.#n1 = :v0'
+    assert update['ExpressionAttributeValues'][':v0'] == {
+        'tweets': [value(4, accessed='2026-10-16T06:00:00')]
+    }
+
+
+def test_diff_item_writes_a_changed_status():
+    update = dynamodb.diff_item(site_item(), site_item(status='timed out'),
+                                ['title'])
+    assert update is not None
+
+
+def test_diff_item_can_compare_accessed_times():
+    loaded = site_item()
+    item = site_item(accessed='2026-10-16T06:00:00')
+    assert dynamodb.diff_item(loaded, item, ['title'],
+                              volatile_fields=('duration',)) is not None
+
+
+def test_diff_item_writes_volatile_attributes_with_other_changes():
+    loaded = site_item()
+    item = site_item(elapsed_seconds='2.5')
+    item['project'] = 'other_blogs'
+    update = dynamodb.diff_item(loaded, item, ['title'])
+    assert sorted(update['ExpressionAttributeNames'].values()) == \
+        ['elapsed_seconds', 'project']
+
+
+def test_diff_item_removes_attributes_and_branches():
+    loaded = site_item()
+    item = site_item()
+    del item['project']
+    del item['data']['moz1']
+    update = dynamodb.diff_item(loaded, item, ['title'])
+    assert update['UpdateExpression'] == 'REMOVE #n0.#n1, #n2'
+    assert list(update['ExpressionAttributeNames'].values()) == \
+        ['data', 'moz1', 'project']
+    assert 'ExpressionAttributeValues' not in update
+
+
+def test_diff_item_never_sets_the_key():
+    loaded = site_item()
+    item = site_item()
+    item['title'] = 'Y'
+    assert dynamodb.diff_item(loaded, item, ['title']) is None
+
+
+class RecordingTable(object):
+    """
+    A table which records the writes sent to it.
+    """
+    def __init__(self):
+        self.key_schema = KEY_SCHEMA
+        self.batched = []
+        self.updated = []
+
+    def batch_writer(self):
+        table = self
+
+        class BatchWriter(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def put_item(self, Item):
+                table.batched.append(Item)
+
+        return BatchWriter()
+
+    def update_item(self, Key, **update):
+        self.updated.append(Key)
+
+
+class Row(object):
+    def __init__(self, item, loaded=True):
+        self.__dict__.update(item)
+        if loaded:
+            self._loaded_item = site_item()
+
+    def to_item(self):
+        return {key: value for key, value in vars(self).items()
+                if not key.startswith('_')}
+
+
+def test_update_changed_rows_batches_puts_and_skips_unchanged(make_dynamo):
+    table = RecordingTable()
+    dynamo = make_dynamo(table)
+    new = Row(dict(site_item(), title='New'), loaded=False)
+    unchanged = Row(site_item(accessed='2026-10-16T06:00:00'))
+    changed = Row(site_item(payload=9))
+    assert dynamo.update_changed_rows('sites', [new, unchanged, changed])
+    assert [item['title'] for item in table.batched] == ['New']
+    assert table.updated == [{'title': 'X'}]
+    assert (dynamo.write_stats['puts'], dynamo.write_stats['updates'],
+            dynamo.write_stats['skipped']) == (1, 1, 1)
+    # A put or update makes the written item the one to compare with.
+    assert new._loaded_item == new.to_item()
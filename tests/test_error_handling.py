@@ -0,0 +1,63 @@
+import json
+from error_handling import ErrorReporter, error_context, handle_error
+
+
+def make_reporter(tmp_path, **settings):
+    settings.setdefault('file', str(tmp_path / 'errors.jsonl'))
+    return ErrorReporter(settings)
+
+
+def report(reporter, err='timed out', host='x.com'):
+    return reporter.report(exc=ValueError, err=err, msg='none',
+                           caller='test', stack='test:1/', host=host)
+
+
+def records(reporter):
+    with open(reporter.settings['file']) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_only_the_first_errors_of_a_kind_are_written(tmp_path, capsys):
+    reporter = make_reporter(tmp_path, records_per_error=2)
+    for _ in range(5):
+        report(reporter)
+    report(reporter, host='y.com')
+    assert [record['host'] for record in records(reporter)] == \
+        ['x.com', 'x.com', 'y.com']
+    assert reporter.summary()[0]['count'] == 5
+    reporter.close()
+    summaries = [record for record in records(reporter)
+                 if record['type'] == 'summary']
+    assert [summary['count'] for summary in summaries] == [5, 1]
+
+
+def test_only_the_first_error_of_a_kind_is_printed(tmp_path, capsys):
+    reporter = make_reporter(tmp_path, console_per_error=1)
+    for _ in range(3):
+        report(reporter)
+    report(reporter, err='refused')
+    out = capsys.readouterr().out
+    assert out.count('timed out') == 1
+    assert '(2 more errors not printed' in out
+    assert reporter.suppressed == 0
+
+
+def test_prints_are_rate_limited_overall(tmp_path, capsys):
+    reporter = make_reporter(tmp_path, console_per_second=0,
+                             console_burst=3)
+    for n in range(10):
+        report(reporter, err='error {n}'.format(n=n))
+    assert capsys.readouterr().out.count('caller:') == 3
+    assert reporter.suppressed == 7
+    assert len(reporter.summary()) == 10
+
+
+def test_errors_are_tagged_with_their_context(error_reporter):
+    with error_context(host='x.com', directive='scrape1'):
+        handle_error(exc=ValueError, err='bad html')
+    handle_error(exc=ValueError, err='bad html')
+    kinds = error_reporter.summary()
+    assert {(kind['host'], kind['directive']) for kind in kinds} == \
+        {(None, None), ('x.com', 'scrape1')}
+    assert all(kind['caller'] == 'test_errors_are_tagged_with_their_context'
+               for kind in kinds)
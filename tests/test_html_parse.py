@@ -0,0 +1,84 @@
+import datetime
+import pytest
+import requests.exceptions as requests_exc
+import html_parse
+
+URL = {'full_url': 'https://a.com/blog', 'protocol': 'https://',
+       'subdomain': '', 'domain': 'a.com', 'path': '/blog'}
+PAGE = (b'<html><body><h2><a href="/first">First post</a></h2>' +
+        b'<p>' + b'x' * 1000 + b'</p></body></html>')
+
+
+class FakeResponse(object):
+    status_code = 200
+    url = URL['full_url']
+
+    def __init__(self, body, error=None):
+        self.body = body
+        self.error = error
+        self.headers = {'Content-Type': 'text/html; charset=utf-8'}
+        self.closed = False
+
+    @property
+    def content(self):
+        return self.body
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def scrape(monkeypatch, response, previous=None):
+    monkeypatch.setattr(html_parse, 'request_site',
+                        lambda url, **kwargs: response)
+    results = html_parse.scrape_newest(URL, ['h2', 'a'], False,
+                                       datetime.datetime.utcnow(), previous)
+    return {result['data_name']: result for result in results}
+
+
+def as_previous(results):
+    return {name: [result] for name, result in results.items()}
+
+
+def test_a_streamed_page_is_digested(monkeypatch, settings):
+    settings['scrape_mode'] = 'stream'
+    first = scrape(monkeypatch, FakeResponse(PAGE))
+    assert first['a_link_url']['status'] == 'ok'
+    assert first['a_link_url']['payload'] == 'https://a.com/first'
+    assert first['content_digest']['payload'] is not None
+    again = scrape(monkeypatch, FakeResponse(PAGE), as_previous(first))
+    assert again['a_link_url']['status'] == 'unchanged'
+    assert again['a_link_url']['payload'] == 'https://a.com/first'
+    assert again['content_digest']['payload'] == \
+        first['content_digest']['payload']
+    changed = scrape(monkeypatch,
+                     FakeResponse(PAGE.replace(b'First', b'Second')),
+                     as_previous(first))
+    assert changed['a_link_text']['status'] == 'ok'
+    assert changed['a_link_text']['payload'] == 'Second post'
+
+
+def test_a_stream_which_breaks_off_is_an_error(monkeypatch, settings):
+    settings['scrape_mode'] = 'stream'
+    response = FakeResponse(b'<html><body><p>no target yet',
+                            error=requests_exc.ChunkedEncodingError('reset'))
+    results = scrape(monkeypatch, response)
+    assert results['a_link_url']['payload'] is None
+    assert 'reset' in ''.join(results['a_link_url']['status'])
+    assert response.closed
+
+
+class TimingOutSession(object):
+    def get(self, url, **kwargs):
+        raise requests_exc.ReadTimeout('read timed out')
+
+
+def test_a_timed_out_request_is_an_error(monkeypatch, settings):
+    monkeypatch.setattr(html_parse, 'get_session', TimingOutSession)
+    with pytest.raises(ValueError):
+        html_parse.request_site(URL['full_url'])
@@ -0,0 +1,32 @@
+from requests import Response
+from requests.adapters import BaseAdapter
+import http_client
+
+
+class TimeoutRecorder(BaseAdapter):
+    def __init__(self):
+        super().__init__()
+        self.timeouts = []
+
+    def send(self, request, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        response = Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def test_requests_have_a_default_timeout(monkeypatch, settings):
+    settings['http_timeout'] = [2, 10]
+    monkeypatch.setattr(http_client, '_session', None)
+    session = http_client.get_session()
+    adapter = TimeoutRecorder()
+    session.mount('https://', adapter)
+    session.get('https://a.com/')
+    session.post('https://a.com/', json=[])
+    # A request's own timeout is kept.
+    session.get('https://a.com/', timeout=1)
+    assert adapter.timeouts == [(2, 10), (2, 10), 1]
@@ -0,0 +1,99 @@
+import copy
+from pipeline import Pipeline
+from sites import Site, SiteSummary
+
+
+def make_item(title, mozrank, rank=None, score=None):
+    item = {
+        'directives': {'moz1': {'type': 'moz', 'parameters': title}},
+        'project': 'test_blogs',
+        'title': title,
+        'url': {'protocol': 'https://', 'subdomain': '',
+                'domain': title, 'path': ''},
+        'data': {'moz1': {'mozrank': [
+            {'payload': mozrank, 'status': 'ok', 'accessed': 'now'},
+            {'payload': 1, 'status': 'ok', 'accessed': 'before'}
+        ]}}
+    }
+    if rank is not None:
+        item.update(rank=rank, score=score)
+    return item
+
+
+class FakeWriter(object):
+    def __init__(self, succeeds=True):
+        self.succeeds = succeeds
+        self.written = []
+        self.attribute_updates = []
+
+    def batch_update_rows(self, table_name, items, volatile_fields):
+        self.written.extend(items)
+        return self.succeeds
+
+    def update_attributes(self, table_name, updates):
+        self.attribute_updates.extend(updates)
+        return True
+
+
+class FakeHistory(object):
+    key_names = ['title']
+
+    def __init__(self):
+        self.saved = []
+
+    def save_sites(self, sites):
+        self.saved.extend(sites)
+        return len(sites)
+
+
+class FakeScan(object):
+    profile_name = 'test'
+    scan_failed = False
+
+    def iter_rows(self, table_name):
+        return iter(())
+
+
+def make_pipeline(settings, writer):
+    settings['schedule_refreshes'] = False
+    return Pipeline(FakeScan(), writer=writer, history=FakeHistory())
+
+
+def test_summary_keeps_only_the_newest_payloads():
+    site = Site(make_item('a.com', 5, rank=2, score=0.5))
+    site.data['twitter1'] = {'twitter_state': [{'payload': {'since_id': 1}}]}
+    summary = SiteSummary(site, ['title'])
+    assert summary.key == {'title': 'a.com'}
+    assert summary.data == {'moz1': {'mozrank': [{'payload': 5}]},
+                            'twitter1': {}}
+    assert (summary.rank, summary.score) == (2, 0.5)
+    assert not summary.ranking_changed()
+
+
+def test_a_failed_write_is_counted_and_not_saved_to_history(settings):
+    writer = FakeWriter(succeeds=False)
+    pipeline = make_pipeline(settings, writer)
+    site = Site(make_item('a.com', 5))
+    site.new_records = [('moz1', {'payload': 5})]
+    pipeline.write_batch([site])
+    assert pipeline.counts['write_failed'] == 1
+    assert pipeline.counts['persisted'] == 0
+    assert pipeline.history.saved == []
+    # Its values are kept, and the site is still ranked and rendered.
+    assert site.new_records
+    assert [summary.title for summary in pipeline.sites] == ['a.com']
+
+
+def test_changed_ranks_are_written_back(settings):
+    writer = FakeWriter()
+    pipeline = make_pipeline(settings, writer)
+    items = [make_item('a.com', 5, rank=1, score=None),
+             make_item('b.com', 9, rank=2, score=None)]
+    pipeline.write_batch([Site(copy.deepcopy(item)) for item in items])
+    assert pipeline.counts['persisted'] == 2
+    sites = pipeline.run(render=False)
+    assert [site.title for site in sites] == ['b.com', 'a.com']
+    updates = dict((key['title'], attributes)
+                   for key, attributes in writer.attribute_updates)
+    assert updates['b.com']['rank'] == 1
+    assert updates['a.com']['rank'] == 2
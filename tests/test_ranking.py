@@ -0,0 +1,24 @@
+import numpy as np
+from ranking import composite_scores
+
+LOG_SCALED = np.array([False, True])
+WEIGHTS = np.array([1.0, 1.0])
+
+
+def test_missing_values_count_as_the_lowest():
+    current = np.array([[10.0, 100.0], [np.nan, 1000.0], [5.0, np.nan]])
+    scores, _, _ = composite_scores(current, np.full(current.shape, np.nan),
+                                    WEIGHTS, LOG_SCALED)
+    assert scores.tolist() == [0.5, 0.5, 0.0]
+
+
+def test_a_column_without_values_scores_zero():
+    current = np.array([[10.0, np.nan], [0.0, np.nan]])
+    previous = np.array([[5.0, np.nan], [np.nan, np.nan]])
+    scores, score_deltas, metric_deltas = composite_scores(
+        current, previous, WEIGHTS, LOG_SCALED
+    )
+    assert scores.tolist() == [0.5, 0.0]
+    assert score_deltas[0] == 0.25
+    assert np.isnan(score_deltas[1])
+    assert metric_deltas[0, 0] == 5.0
@@ -0,0 +1,96 @@
+import threading
+import time
+from rate_limit import ApiBudget, RateLimiter
+
+
+def make_budget(limit=2, window_seconds=900):
+    return ApiBudget(limit=limit, window_seconds=window_seconds,
+                     remaining_header='x-rate-limit-remaining',
+                     reset_header='x-rate-limit-reset', name='test')
+
+
+def test_rate_limiter_spaces_out_calls():
+    limiter = RateLimiter(min_interval=0.05, max_concurrent=1)
+    started = time.monotonic()
+    for _ in range(3):
+        with limiter:
+            pass
+    assert time.monotonic() - started >= 0.1
+
+
+def test_rate_limiter_limits_concurrent_calls():
+    limiter = RateLimiter(min_interval=0, max_concurrent=2)
+    lock = threading.Lock()
+    running = [0]
+    most = [0]
+
+    def call():
+        with limiter:
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most[0] == 2
+
+
+def test_budget_returns_at_once_while_calls_are_left():
+    budget = make_budget(limit=2)
+    assert budget.acquire() == 0
+    assert budget.acquire() == 0
+    assert budget.remaining == 0
+
+
+def test_budget_sleeps_until_the_window_resets():
+    budget = make_budget(limit=1)
+    budget.acquire()
+    budget.reset_at = time.time() + 0.1
+    slept = budget.acquire()
+    assert slept >= 0.05
+    assert budget.remaining == 0
+    assert budget.slept_seconds == slept
+
+
+def test_budget_update_only_lowers_the_count_within_a_window():
+    budget = make_budget(limit=180)
+    reset_at = time.time() + 900
+    budget.update({'x-rate-limit-remaining': '100',
+                   'x-rate-limit-reset': str(reset_at)})
+    assert (budget.remaining, budget.reset_at) == (100, reset_at)
+    # A response from before the last one mustn't raise the count again.
+    budget.update({'x-rate-limit-remaining': '150',
+                   'x-rate-limit-reset': str(reset_at)})
+    assert budget.remaining == 100
+
+
+def test_budget_update_takes_a_new_windows_count():
+    budget = make_budget(limit=180)
+    budget.update({'x-rate-limit-remaining': '3',
+                   'x-rate-limit-reset': str(time.time() + 10)})
+    later = time.time() + 900
+    budget.update({'x-rate-limit-remaining': '179',
+                   'x-rate-limit-reset': str(later)})
+    assert (budget.remaining, budget.reset_at) == (179, later)
+
+
+def test_budget_update_ignores_missing_headers():
+    budget = make_budget(limit=5)
+    budget.update({})
+    budget.update({'x-rate-limit-remaining': 'many',
+                   'x-rate-limit-reset': '0'})
+    assert (budget.remaining, budget.reset_at) == (5, None)
+
+
+def test_budget_without_headers_is_not_synced():
+    budget = ApiBudget(limit=5, window_seconds=900, remaining_header=None,
+                       reset_header=None)
+    budget.update({'x-rate-limit-remaining': '0',
+                   'x-rate-limit-reset': str(time.time() + 900)})
+    assert budget.remaining == 5
@@ -0,0 +1,85 @@
+import re
+from conftest import TEMPLATE_DIR
+import render
+from render import render_sites
+from sites import Site
+
+
+def payload(value):
+    return [{'payload': value, 'status': 'ok'}]
+
+
+def make_site(title, project='blogs', tweets_followers=1234,
+              most_followed_count=56789):
+    return Site({
+        'directives': {
+            'scrape1': {'type': 'scrape_newest', 'parameters': ['a']},
+            'twitter1': {'type': 'twitter', 'parameters': ['x']},
+            'moz1': {'type': 'moz', 'parameters': 'x.com'}
+        },
+        'project': project,
+        'title': title,
+        'url': {
+            'protocol': 'https://',
+            'subdomain': 'www',
+            'domain': 'x.com',
+            'path': '/blog'
+        },
+        'data': {
+            'scrape1': {
+                'a_link_text': payload('Newest post'),
+                'a_link_url': payload('https://www.x.com/blog/newest')
+            },
+            'twitter1': {
+                'tweets': payload(3),
+                'tweets_followers': payload(tweets_followers),
+                'most_followed_name': payload('someone'),
+                'most_followed_count': payload(most_followed_count)
+            },
+            'moz1': {
+                'mozrank': payload(5),
+                'authority': payload(40)
+            }
+        }
+    })
+
+
+def rows(filename):
+    with open(filename) as f:
+        page = f.read()
+    return re.findall(r'<tr class="sitesRow" data-rank="(\d+)" '
+                      r'data-title="([^"]*)"', page), page
+
+
+def test_a_failed_twitter_search_renders_as_missing_values(tmp_path):
+    failed = make_site('Failed', tweets_followers=None,
+                       most_followed_count=None)
+    written = render_sites([make_site('Fine'), failed],
+                           output_dir=str(tmp_path),
+                           template_dir=TEMPLATE_DIR, shard_by=None)
+    found, page = rows(written[0])
+    assert found == [('1', 'Fine'), ('2', 'Failed')]
+    assert '<td class="siteCell siteTweetsFollowers">1,234</td>' in page
+    assert '<td class="siteCell siteTweetsFollowers">{m}</td>'.format(
+        m=render.MISSING_VALUE) in page
+
+
+def test_project_pages_keep_the_overall_ranks(tmp_path):
+    sites = [make_site('A', project='one'), make_site('B', project='two'),
+             make_site('C', project='one')]
+    written = render_sites(sites, output_dir=str(tmp_path),
+                           template_dir=TEMPLATE_DIR, shard_by='project')
+    assert [path.rsplit('/', 1)[1] for path in written] == \
+        ['index.html', 'project-one.html', 'project-two.html']
+    assert rows(written[1])[0] == [('1', 'A'), ('3', 'C')]
+    assert rows(written[2])[0] == [('2', 'B')]
+
+
+def test_pages_continue_each_others_ranks(tmp_path):
+    sites = [make_site(title) for title in 'ABCDE']
+    written = render_sites(sites, output_dir=str(tmp_path),
+                           template_dir=TEMPLATE_DIR, shard_by='page',
+                           page_size=2)
+    assert [rows(path)[0] for path in written] == [
+        [('1', 'A'), ('2', 'B')], [('3', 'C'), ('4', 'D')], [('5', 'E')]
+    ]
@@ -0,0 +1,120 @@
+import datetime
+from scheduler import MAX_STALENESS, Scheduler
+
+NOW = datetime.datetime(2018, 5, 1, 12, 0, 0)
+DIRECTIVE = {'type': 'twitter'}
+
+
+def value(status='ok', hours_ago=12):
+    accessed = NOW - datetime.timedelta(hours=hours_ago)
+    return {'payload': 1, 'status': status,
+            'accessed': accessed.strftime('%Y-%m-%dT%H:%M:%S+0000')}
+
+
+def staleness(*values):
+    scheduler = Scheduler(intervals={'twitter': 24 * 60 * 60},
+                          slack_seconds=0, now=NOW)
+    branch = {'data_name_{n}'.format(n=n): [v] for n, v in enumerate(values)}
+    return scheduler.staleness(DIRECTIVE, branch)
+
+
+def test_staleness_is_the_age_over_the_interval():
+    assert staleness(value(hours_ago=12)) == 0.5
+    assert staleness(value(hours_ago=6), value(hours_ago=12)) == 0.25
+
+
+def test_unchanged_values_count_as_refreshed():
+    for status in ('unchanged', 'not modified', 'ok (cached)'):
+        assert staleness(value(status=status)) == 0.5
+
+
+def test_failed_or_missing_values_are_most_stale():
+    assert staleness() == MAX_STALENESS
+    assert staleness(value(status=None)) == MAX_STALENESS
+    # Moz and the scrapers save their error messages as the status.
+    assert staleness(value(status='moz response was missing pda')) == \
+        MAX_STALENESS
+    assert staleness(value(), value(status='Traceback...')) == MAX_STALENESS
+
+
+def test_monthly_moz_rows_default_to_the_quota(settings):
+    settings.pop('moz_monthly_rows', None)
+    assert Scheduler(now=NOW).moz_monthly_rows == 20000
+
+
+class FakeResponse(object):
+    status_code = 200
+    content = b'[]'
+
+    def __init__(self, targets):
+        self.targets = targets
+
+    def json(self):
+        return [{'pda': 50, 'upa': 40, 'umrp': 5, 'fmrp': 4}
+                for _ in self.targets]
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, params, json):
+        self.posts.append(json)
+        return FakeResponse(json)
+
+
+def test_a_due_moz_refresh_skips_the_cache(monkeypatch, settings, tmp_path):
+    import moz
+    import moz_cache
+    import sites
+    # The last refresh (30 days less the slack ago) was cached then, and
+    # the cache's TTL hasn't quite run out.
+    refreshed = NOW - datetime.timedelta(days=30) + \
+        datetime.timedelta(hours=1)
+    cache = moz_cache.MozCache(filename=str(tmp_path / 'moz_cache.json'))
+    monkeypatch.setattr(moz_cache.time, 'time',
+                        lambda: refreshed.timestamp())
+    cache.set('x.com', moz.bit_flags_sum(moz.FIELDS_TO_GET), 5, 50)
+    monkeypatch.setattr(moz_cache.time, 'time', lambda: NOW.timestamp())
+    monkeypatch.setattr(moz, 'get_moz_cache', lambda: cache)
+    session = FakeSession()
+    monkeypatch.setattr(moz, 'get_session', lambda: session)
+    settings['rate_limits'] = {'moz': {'min_interval': 0}}
+    item = {
+        'directives': {'moz1': {'type': 'moz', 'parameters': 'x.com'}},
+        'data': {'moz1': {'mozrank': [value('ok (cached)', hours_ago=719)]}}
+    }
+    plan = Scheduler(slack_seconds=60 * 60, now=NOW).plan([item])
+    assert plan == [{'moz1'}]
+    results = sites.prefetch_directives([item], due=plan)
+    assert session.posts == [['x.com']]
+    assert results['moz'][sites.directive_key('x.com')][0]['status'] == 'ok'
+    # An unscheduled run still uses the cache.
+    results = sites.prefetch_directives([item])
+    assert len(session.posts) == 1
+
+
+def test_moz_rows_are_counted_as_sent(monkeypatch, settings, moz_rows):
+    import moz
+    settings['moz_cache'] = {'enabled': False}
+    settings['rate_limits'] = {'moz': {'min_interval': 0}}
+    session = FakeSession()
+    monkeypatch.setattr(moz, 'get_session', lambda: session)
+    start = datetime.datetime.utcnow()
+    # The same target sent twice in a month uses two rows.
+    moz.moz_batch_search(['x.com', 'y.com', 'z.com'], start, batch_size=2)
+    moz.moz_batch_search(['x.com'], start)
+    assert moz_rows.rows() == 4
+    scheduler = Scheduler(moz_monthly_rows=10)
+    assert scheduler.budgets([])['moz'] == 6
+    # Only this month's rows count.
+    moz_rows.add(100, now=datetime.datetime(2000, 1, 1))
+    assert scheduler.budgets([])['moz'] == 6
+
+
+def test_moz_rows_are_kept_between_runs(tmp_path):
+    from moz_usage import MozUsage
+    usage = MozUsage(str(tmp_path / 'usage.json'))
+    usage.add(3, now=NOW)
+    usage.save()
+    assert MozUsage(str(tmp_path / 'usage.json')).rows(NOW) == 3
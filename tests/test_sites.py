@@ -0,0 +1,154 @@
+import datetime
+import time
+import metrics
+import sites
+from sites import Site
+
+ITEM = {
+    'directives': {
+        'scrape1': {'type': 'scrape_newest', 'parameters': ['a']},
+        'twitter1': {'type': 'twitter', 'parameters': ['url:"x com"']},
+        'moz1': {'type': 'moz', 'parameters': 'x.com'}
+    },
+    'project': 'test_blogs',
+    'title': 'X',
+    'url': {
+        'protocol': 'https://',
+        'subdomain': 'www',
+        'domain': 'x.com',
+        'path': '/blog'
+    }
+}
+
+
+def slow_directive(data_name, seconds=0.2):
+    """
+    :return: a directive function which takes seconds, and records its
+    parameters in a dict named after data_name
+    """
+    def func(params, start_time, **kwargs):
+        time.sleep(seconds)
+        return [{'data_name': data_name, 'payload': str(params),
+                 'status': 'ok', 'duration': seconds}]
+    return func
+
+
+def patch_directives(monkeypatch):
+    monkeypatch.setattr(sites, 'scrape_newest', slow_directive('a_link_text'))
+    monkeypatch.setattr(sites, 'twitter_search', slow_directive('tweets'))
+    monkeypatch.setattr(sites, 'moz_search', slow_directive('mozrank'))
+
+
+def test_fetch_follows_a_sites_directives_at_the_same_time(monkeypatch,
+                                                            settings):
+    settings['directive_workers'] = 3
+    settings['test_mode'] = False
+    patch_directives(monkeypatch)
+    started = time.monotonic()
+    responses = Site(ITEM).fetch()
+    assert time.monotonic() - started < 0.5
+    assert list(responses) == ['scrape1', 'twitter1', 'moz1']
+    assert responses['moz1'][0]['payload'] == 'x.com'
+    assert responses['scrape1'][0]['payload'] == "['a']"
+
+
+def test_fetch_follows_directives_one_at_a_time(monkeypatch, settings):
+    settings['directive_workers'] = 1
+    settings['test_mode'] = False
+    patch_directives(monkeypatch)
+    started = time.monotonic()
+    responses = Site(ITEM).fetch(due={'twitter1', 'moz1'})
+    assert time.monotonic() - started >= 0.4
+    assert list(responses) == ['twitter1', 'moz1']
+
+
+def test_fetch_uses_prefetched_results(monkeypatch, settings):
+    settings['directive_workers'] = 3
+    settings['test_mode'] = False
+    patch_directives(monkeypatch)
+    prefetched = {'moz': {sites.directive_key('x.com'): [
+        {'data_name': 'mozrank', 'payload': 5, 'status': 'ok'}
+    ]}}
+    responses = Site(ITEM).fetch(prefetched=prefetched)
+    assert responses['moz1'] == [
+        {'data_name': 'mozrank', 'payload': 5, 'status': 'ok'}
+    ]
+
+
+def test_batched_results_share_the_batchs_latency(monkeypatch, settings):
+    settings['directive_workers'] = 1
+    settings['test_mode'] = False
+    patch_directives(monkeypatch)
+    run_metrics = metrics.RunMetrics(per_host=False)
+    monkeypatch.setattr(metrics, '_metrics', run_metrics)
+    results = {
+        'x.com': [{'data_name': 'mozrank', 'payload': 5, 'status': 'ok',
+                   'duration': 4}],
+        'y.com': [{'data_name': 'mozrank', 'payload': 6, 'status': 'ok',
+                   'duration': 4}]
+    }
+    started = datetime.datetime.utcnow() - datetime.timedelta(seconds=4)
+    sites.observe_batch('moz', results, started)
+    latency = run_metrics.latency[('type', 'moz')]
+    assert latency.count == 2
+    assert 3.9 < latency.sum < 4.5
+    # A site using a copy of a batched result doesn't observe it again.
+    prefetched = {'moz': {sites.directive_key('x.com'): results['x.com']}}
+    Site(ITEM).fetch(prefetched=prefetched, due={'moz1'})
+    assert latency.count == 2
+
+
+def test_a_raising_directive_saves_an_error_and_keeps_the_others(
+        monkeypatch, settings):
+    settings['directive_workers'] = 3
+    settings['test_mode'] = False
+    patch_directives(monkeypatch)
+
+    def not_json(params, start_time, **kwargs):
+        raise ValueError('Expecting value: line 1 column 1 (char 0)')
+    monkeypatch.setattr(sites, 'moz_search', not_json)
+    site = Site(ITEM)
+    responses = site.fetch()
+    assert [d['data_name'] for d in responses['moz1']] == \
+        ['mozrank', 'authority']
+    assert all(d['payload'] is None and 'Expecting value' in ''.join(
+        d['status']) for d in responses['moz1'])
+    site.merge(responses)
+    assert site.data['scrape1']['a_link_text'][0]['payload'] == "['a']"
+    assert site.data['moz1']['mozrank'][0]['payload'] is None
+
+
+def test_moz_is_labelled_with_the_host_it_calls(monkeypatch, settings):
+    from urllib.parse import urlparse
+    import moz
+    settings['directive_workers'] = 1
+    settings['test_mode'] = False
+    patch_directives(monkeypatch)
+    run_metrics = metrics.RunMetrics(per_host=True)
+    monkeypatch.setattr(metrics, '_metrics', run_metrics)
+    Site(ITEM).fetch(due={'moz1'})
+    host = urlparse(moz.URL).hostname
+    assert metrics.API_HOSTS['moz'] == host
+    assert run_metrics.latency[('host', host)].count == 1
+
+
+def test_a_failing_scrape_is_reported(monkeypatch, settings):
+    from error_handling import get_reporter
+    import html_parse
+    settings['directive_workers'] = 1
+    settings['test_mode'] = False
+    settings['scrape_mode'] = 'tree'
+    patch_directives(monkeypatch)
+    monkeypatch.setattr(sites, 'scrape_newest', html_parse.scrape_newest)
+
+    def unreachable(url, **kwargs):
+        raise ValueError('requests package raised an exception when trying '
+                         'to get {u}'.format(u=url))
+    monkeypatch.setattr(html_parse, 'request_site', unreachable)
+    responses = Site(ITEM).fetch()
+    assert responses['scrape1'][0]['payload'] is None
+    assert responses['moz1'][0]['status'] == 'ok'
+    [summary] = get_reporter().summary()
+    assert (summary['host'], summary['directive'], summary['exception']) == \
+        ('x.com', 'scrape1', 'ValueError')
+    assert summary['error'].startswith('requests package raised')
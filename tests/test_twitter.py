@@ -0,0 +1,104 @@
+import datetime
+import importlib
+from TwitterSearch import TwitterSearchOrder
+import twitter
+
+
+class FakeResponse(object):
+    status_code = 200
+    headers = {'x-rate-limit-remaining': '179'}
+
+    def json(self):
+        return {'statuses': []}
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, auth=None):
+        self.urls.append(url)
+        return FakeResponse()
+
+
+def test_searches_go_through_the_shared_session(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(twitter, 'get_session', lambda: session)
+    module = importlib.import_module('TwitterSearch.TwitterSearch')
+    module_requests = module.requests
+    ts = twitter.SessionTwitterSearch('key', 'secret', 'token', 'secret')
+    tso = TwitterSearchOrder()
+    tso.add_keyword('xyz')
+    response = ts.search_tweets(tso)
+    assert response['content'] == {'statuses': []}
+    assert ts.get_metadata()['x-rate-limit-remaining'] == '179'
+    assert session.urls[0].endswith('account/verify_credentials.json')
+    assert 'search/tweets.json?q=xyz' in session.urls[1]
+    # The third-party module is left as it was.
+    assert module.requests is module_requests
+
+
+def test_groups_fit_the_encoded_query_length(monkeypatch):
+    monkeypatch.setattr(twitter, 'MAX_QUERY_LENGTH', 60)
+    terms = ['url:"site{n} com"'.format(n=n) for n in range(10)]
+    members = [((term,), None, []) for term in terms]
+    groups = twitter.group_queries(members, batch_size=20)
+    assert sum(len(group) for group in groups) == len(terms)
+    for group in groups:
+        tso = TwitterSearchOrder()
+        tso.add_keyword([positive for (positive,), _, _ in group],
+                        or_operator=True)
+        query = tso.create_search_url().split('q=')[1].split('&')[0]
+        assert len(query) <= 60
+    # Each group is as full as the limit allows.
+    assert len(groups[0]) == 2
+
+
+def tweet(tweet_id, screen_name):
+    return {'id': tweet_id,
+            'created_at': 'Tue May 01 10:00:00 +0000 2018',
+            'user': {'id_str': screen_name, 'screen_name': screen_name,
+                     'followers_count': 10}}
+
+
+def test_a_busy_batched_query_is_capped(monkeypatch, settings):
+    settings['twitter_aggregation'] = 'exact'
+    monkeypatch.setattr(twitter, 'MAX_TWEETS', 5)
+    monkeypatch.setattr(twitter, 'get_client', lambda: None)
+    # alice tweets far more than bob, whose one tweet is the oldest.
+    tweets = [tweet(100 - n, 'alice') for n in range(8)] + \
+        [tweet(1, 'bob')]
+    requested = []
+
+    def search_pages(ts, tso, max_tweets):
+        requested.append(max_tweets)
+        for start in range(0, min(len(tweets), max_tweets), 2):
+            yield tweets[start:start + 2]
+    monkeypatch.setattr(twitter, 'search_pages', search_pages)
+    results = twitter.twitter_batch_search(
+        [['from:alice'], ['from:bob']], start_time=datetime.datetime.utcnow()
+    )
+    assert requested == [5]
+    # alice's tally filled up; bob's missed older tweets, so bob is left
+    # for a search of its own.
+    assert list(results) == [('from:alice',)]
+    assert results[('from:alice',)][0]['payload'] == 5
+
+
+def test_a_replayed_window_is_pinned_to_the_recording(settings, tmp_path):
+    import cassettes
+    import json
+    settings['cassettes'] = {'mode': 'record', 'directory': str(tmp_path)}
+    list(cassettes.record_items(iter([{'title': 'a.com'}]), 'sites'))
+    with open(cassettes.clock_filename(), 'w') as f:
+        json.dump({'recorded_at': '2018-05-01T12:00:00'}, f)
+    state = {'since_id': 1, 'tweeters': {},
+             'days': {'2018-04-29': 3, '2018-04-30': 2}}
+    # Recording (or not replaying) uses the time now...
+    assert twitter.yesterday() == \
+        datetime.datetime.utcnow().date() - datetime.timedelta(1)
+    assert twitter.TweetTally(state=state).days == {}
+    # ...and replaying keeps the days which the recorded run kept.
+    settings['cassettes']['mode'] = 'replay'
+    assert twitter.yesterday() == datetime.date(2018, 4, 30)
+    assert twitter.TweetTally(state=state).days == {'2018-04-30': 2}